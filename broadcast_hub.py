@@ -0,0 +1,450 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Broadcast of frames to websocket clients
+
+Each frame is encoded once and queued to every client. Each client has its
+own sending thread and send buffer, so a slow client never blocks the task
+that broadcasts the frames or the other clients.
+
+When the buffer of a client reaches the high watermark, the client switches
+to latest-value-wins: the stale frames in the buffer are dropped whenever a
+new frame arrives, until the buffer drains to the low watermark. A client
+whose frames are delayed for long gets frames less often, and it is dropped
+if a send stays blocked for too long. Messages that must not be dropped,
+e.g. command results, are sent before the frames.
+
+A client chooses the encoding of frames when it connects. The JSON
+encoding sends the datapoints of all jobs with their names. The compact
+encoding sends a dictionary of job IDs and hostnames only when it changes,
+and each tick frame is an array of entries:
+
+    [job_index, rate, limit, host_index, host_rate, ...]
+
+A keyframe has the entries of all jobs and all hosts. A delta frame only
+has the jobs and the hosts whose values changed since the previous frame.
+A client gets a delta frame only if it got the previous frame, otherwise it
+gets the keyframe.
+"""
+import collections
+import json
+import logging
+import threading
+from geventwebsocket.exceptions import WebSocketError
+
+# local libs
+import utils
+
+# The number of buffered frames that switches a client to latest-value-wins
+BROADCAST_HIGH_WATERMARK = 8
+# The number of buffered frames that switches a client back
+BROADCAST_LOW_WATERMARK = 2
+# The lag (seconds from queued to sent) that makes a client slow
+BROADCAST_SLOW_LAG = 1.0
+# The lag below which a slow client becomes fast again
+BROADCAST_FAST_LAG = 0.2
+# The min interval of frames sent to a slow client, in seconds. Fast clients
+# get every frame.
+BROADCAST_SLOW_INTERVAL = 5
+# The max seconds a send can be blocked before the client is dropped
+BROADCAST_MAX_LAG = 60
+# The weight of the latest lag in the average lag
+BROADCAST_LAG_WEIGHT = 0.3
+# Frames are sent in verbose JSON
+ENCODING_JSON = "json"
+# Frames are sent in compact JSON with dictionary and deltas
+ENCODING_COMPACT = "compact"
+ENCODINGS = [ENCODING_JSON, ENCODING_COMPACT]
+# The separators of compact JSON
+COMPACT_SEPARATORS = (",", ":")
+
+
+class BroadcastFrame(object):
+    """
+    A frame of a tick, encoded once for all the clients
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, seq, version, dictionary, json_string, keyframe,
+                 delta):
+        # The sequence number of the tick
+        self.bf_seq = seq
+        # The version of the dictionary that the compact frames use
+        self.bf_version = version
+        self.bf_dictionary = dictionary
+        self.bf_json = json_string
+        self.bf_keyframe = keyframe
+        self.bf_delta = delta
+
+
+class RateStreamEncoder(object):
+    """
+    Encoder of the snapshots of rates to frames
+    """
+    def __init__(self):
+        self.rse_seq = 0
+        self.rse_version = 0
+        self.rse_jobs = []
+        self.rse_hosts = []
+        self.rse_dictionary = None
+        # Mapping from job ID to the entry sent in the previous frame
+        self.rse_entries = {}
+
+    def _rse_dictionary_update(self, jobs, hosts):
+        """
+        Update the dictionary if the jobs or the hosts changed
+        """
+        if jobs == self.rse_jobs and hosts == self.rse_hosts:
+            return
+        self.rse_version += 1
+        self.rse_jobs = jobs
+        self.rse_hosts = hosts
+        self.rse_dictionary = json.dumps({"type": "dictionary",
+                                          "version": self.rse_version,
+                                          "jobs": jobs,
+                                          "hosts": hosts},
+                                         separators=COMPACT_SEPARATORS)
+        # The indexes changed, so the next delta has everything
+        self.rse_entries = {}
+
+    def rse_encode(self, snapshot):
+        """
+        Encode a snapshot to a frame
+        """
+        # pylint: disable=too-many-locals
+        datapoints = []
+        hostnames = set()
+        for job_id, job_snapshot in snapshot["jobs"].iteritems():
+            datapoints.append({"job_id": job_id,
+                               "rate": job_snapshot["rate"]})
+            hostnames.update(job_snapshot["hosts"])
+        json_string = json.dumps({
+            "type": "datapoints",
+            "time": snapshot["time"],
+            "datapoints": datapoints})
+
+        self._rse_dictionary_update(list(snapshot["jobs"]),
+                                    sorted(hostnames))
+        host_indexes = {}
+        for host_index, hostname in enumerate(self.rse_hosts):
+            host_indexes[hostname] = host_index
+        key_entries = []
+        delta_entries = []
+        entries = {}
+        for job_index, (job_id, job_snapshot) in \
+                enumerate(snapshot["jobs"].iteritems()):
+            host_rates = {}
+            for hostname, host_rate in job_snapshot["hosts"].iteritems():
+                host_rates[host_indexes[hostname]] = int(round(host_rate))
+            entry = (int(round(job_snapshot["rate"])),
+                     job_snapshot["limit"], host_rates)
+            entries[job_id] = entry
+
+            key_entry = [job_index, entry[0], entry[1]]
+            for host_index in sorted(host_rates):
+                key_entry += [host_index, host_rates[host_index]]
+            key_entries.append(key_entry)
+
+            previous = self.rse_entries.get(job_id)
+            if previous is None:
+                delta_entries.append(key_entry)
+                continue
+            if previous == entry:
+                continue
+            delta_entry = [job_index, entry[0], entry[1]]
+            for host_index in sorted(host_rates):
+                if previous[2].get(host_index) != host_rates[host_index]:
+                    delta_entry += [host_index, host_rates[host_index]]
+            delta_entries.append(delta_entry)
+        self.rse_entries = entries
+        self.rse_seq += 1
+
+        keyframe = json.dumps({"t": "k", "s": self.rse_seq,
+                               "time": round(snapshot["time"], 3),
+                               "d": key_entries},
+                              separators=COMPACT_SEPARATORS)
+        delta = json.dumps({"t": "d", "s": self.rse_seq,
+                            "time": round(snapshot["time"], 3),
+                            "d": delta_entries},
+                           separators=COMPACT_SEPARATORS)
+        return BroadcastFrame(self.rse_seq, self.rse_version,
+                              self.rse_dictionary, json_string, keyframe,
+                              delta)
+
+
+class BroadcastClient(object):
+    """
+    Each websocket has an object of BroadcastClient
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, hub, websocket, encoding=ENCODING_JSON,
+                 high_watermark=BROADCAST_HIGH_WATERMARK,
+                 low_watermark=BROADCAST_LOW_WATERMARK):
+        # pylint: disable=too-many-arguments
+        self.bc_hub = hub
+        self.bc_websocket = websocket
+        self.bc_encoding = encoding
+        # The dictionary version and the sequence of the last compact frame
+        # sent
+        self.bc_version = None
+        self.bc_seq = None
+        # Buffered frames, each is a tuple of (queued_time, frame)
+        self.bc_frames = collections.deque()
+        # Buffered messages that must not be dropped
+        self.bc_messages = collections.deque()
+        self.bc_high_watermark = high_watermark
+        self.bc_low_watermark = low_watermark
+        self.bc_condition = threading.Condition()
+        self.bc_closed = False
+        # Whether stale frames are dropped when new frames arrive
+        self.bc_latest_only = False
+        # Whether the client gets frames every BROADCAST_SLOW_INTERVAL
+        self.bc_slow = False
+        # The time that the latest frame was queued
+        self.bc_queued_time = None
+        # The time that the current send started, None if not sending
+        self.bc_sending_time = None
+        # Number of frames sent to the websocket
+        self.bc_sent_count = 0
+        # Number of bytes sent to the websocket
+        self.bc_sent_bytes = 0
+        # Number of stale frames dropped in latest-value-wins mode
+        self.bc_stale_count = 0
+        # Number of frames skipped because the client is slow
+        self.bc_skipped_count = 0
+        # Seconds from queuing to sending of frames
+        self.bc_lag_last = 0
+        self.bc_lag_max = 0
+        self.bc_lag_average = 0
+
+    def bc_frame_put(self, frame):
+        """
+        Queue a frame to be sent. Return 0 if queued or skipped, -1 if the
+        client is closed or blocked for too long.
+        """
+        now = utils.monotonic_time()
+        self.bc_condition.acquire()
+        if self.bc_closed:
+            self.bc_condition.release()
+            return -1
+        if (self.bc_sending_time is not None and
+                now - self.bc_sending_time > BROADCAST_MAX_LAG):
+            self.bc_condition.release()
+            return -1
+        if (self.bc_slow and self.bc_queued_time is not None and
+                now - self.bc_queued_time < BROADCAST_SLOW_INTERVAL * 0.9):
+            self.bc_skipped_count += 1
+            self.bc_condition.release()
+            return 0
+        if len(self.bc_frames) >= self.bc_high_watermark:
+            if not self.bc_latest_only:
+                logging.debug("websocket client lags, dropping stale "
+                              "frames")
+            self.bc_latest_only = True
+        if self.bc_latest_only:
+            self.bc_stale_count += len(self.bc_frames)
+            self.bc_frames.clear()
+        self.bc_frames.append((now, frame))
+        self.bc_queued_time = now
+        self.bc_condition.notify()
+        self.bc_condition.release()
+        return 0
+
+    def bc_message_put(self, message):
+        """
+        Queue a message that will be sent before the buffered frames and
+        never dropped
+        """
+        self.bc_condition.acquire()
+        if self.bc_closed:
+            self.bc_condition.release()
+            return -1
+        self.bc_messages.append(message)
+        self.bc_condition.notify()
+        self.bc_condition.release()
+        return 0
+
+    def _bc_frame_encode(self, frame):
+        """
+        Return the list of strings to send for a frame
+        """
+        if self.bc_encoding != ENCODING_COMPACT:
+            return [frame.bf_json]
+        datas = []
+        if self.bc_version != frame.bf_version:
+            datas.append(frame.bf_dictionary)
+            self.bc_version = frame.bf_version
+            datas.append(frame.bf_keyframe)
+        elif self.bc_seq != frame.bf_seq - 1:
+            datas.append(frame.bf_keyframe)
+        else:
+            datas.append(frame.bf_delta)
+        self.bc_seq = frame.bf_seq
+        return datas
+
+    def _bc_lag_update(self, lag):
+        """
+        Update the lag statistics and the update rate of the client
+        """
+        self.bc_lag_last = lag
+        if lag > self.bc_lag_max:
+            self.bc_lag_max = lag
+        self.bc_lag_average = (BROADCAST_LAG_WEIGHT * lag +
+                               (1 - BROADCAST_LAG_WEIGHT) *
+                               self.bc_lag_average)
+        if not self.bc_slow and self.bc_lag_average > BROADCAST_SLOW_LAG:
+            logging.debug("websocket client is slow, sending frames every "
+                          "[%d] seconds", BROADCAST_SLOW_INTERVAL)
+            self.bc_slow = True
+        elif self.bc_slow and self.bc_lag_average < BROADCAST_FAST_LAG:
+            logging.debug("websocket client is fast again")
+            self.bc_slow = False
+        if (self.bc_latest_only and
+                len(self.bc_frames) <= self.bc_low_watermark):
+            self.bc_latest_only = False
+
+    def bc_send_thread(self):
+        """
+        The thread that sends the queued messages and frames to the
+        websocket
+        """
+        while True:
+            self.bc_condition.acquire()
+            while (not self.bc_closed and len(self.bc_messages) == 0 and
+                   len(self.bc_frames) == 0):
+                self.bc_condition.wait()
+            if self.bc_closed:
+                self.bc_condition.release()
+                return
+            if len(self.bc_messages) != 0:
+                queued_time = None
+                datas = [self.bc_messages.popleft()]
+            else:
+                queued_time, frame = self.bc_frames.popleft()
+                datas = self._bc_frame_encode(frame)
+            self.bc_sending_time = utils.monotonic_time()
+            self.bc_condition.release()
+            try:
+                for data in datas:
+                    self.bc_websocket.send(data)
+                    self.bc_sent_bytes += len(data)
+            except WebSocketError:
+                logging.debug("failed to send frame to websocket, closing")
+                self.bc_hub.bh_client_remove(self)
+                return
+            now = utils.monotonic_time()
+            self.bc_condition.acquire()
+            self.bc_sending_time = None
+            if queued_time is not None:
+                self.bc_sent_count += 1
+                self._bc_lag_update(now - queued_time)
+            self.bc_condition.release()
+
+    def bc_close(self):
+        """
+        Stop sending frames and close the websocket
+        """
+        # pylint: disable=bare-except
+        self.bc_condition.acquire()
+        if self.bc_closed:
+            self.bc_condition.release()
+            return
+        self.bc_closed = True
+        self.bc_frames.clear()
+        self.bc_messages.clear()
+        self.bc_condition.notify()
+        self.bc_condition.release()
+        try:
+            self.bc_websocket.close()
+        except:
+            pass
+
+    def bc_stats(self):
+        """
+        Return the statistics of the client
+        """
+        return {"encoding": self.bc_encoding,
+                "queued": len(self.bc_frames),
+                "latest_only": self.bc_latest_only,
+                "slow": self.bc_slow,
+                "sent": self.bc_sent_count,
+                "sent_bytes": self.bc_sent_bytes,
+                "stale": self.bc_stale_count,
+                "skipped": self.bc_skipped_count,
+                "lag_last": self.bc_lag_last,
+                "lag_max": self.bc_lag_max,
+                "lag_average": self.bc_lag_average}
+
+
+class BroadcastHub(object):
+    """
+    The hub that broadcasts frames to all websocket clients
+    """
+    def __init__(self, high_watermark=BROADCAST_HIGH_WATERMARK,
+                 low_watermark=BROADCAST_LOW_WATERMARK):
+        self.bh_clients = []
+        self.bh_high_watermark = high_watermark
+        self.bh_low_watermark = low_watermark
+        self.bh_condition = threading.Condition()
+        # Number of frames broadcasted
+        self.bh_frame_count = 0
+        # Number of clients dropped because their sends are blocked
+        self.bh_dropped_count = 0
+
+    def bh_client_add(self, websocket, encoding=ENCODING_JSON):
+        """
+        Add a websocket to broadcast frames to, return the client
+        """
+        if encoding not in ENCODINGS:
+            logging.error("unknown encoding [%s] of websocket, using [%s]",
+                          encoding, ENCODING_JSON)
+            encoding = ENCODING_JSON
+        client = BroadcastClient(self, websocket, encoding=encoding,
+                                 high_watermark=self.bh_high_watermark,
+                                 low_watermark=self.bh_low_watermark)
+        self.bh_condition.acquire()
+        self.bh_clients.append(client)
+        self.bh_condition.release()
+        utils.thread_start(client.bc_send_thread, ())
+        return client
+
+    def bh_client_remove(self, client):
+        """
+        Stop broadcasting frames to a client and close it
+        """
+        self.bh_condition.acquire()
+        if client in self.bh_clients:
+            self.bh_clients.remove(client)
+        self.bh_condition.release()
+        client.bc_close()
+
+    def bh_broadcast(self, frame):
+        """
+        Queue a frame to all clients. Clients whose sends are
+        blocked for too long are dropped.
+        """
+        self.bh_condition.acquire()
+        clients = list(self.bh_clients)
+        self.bh_condition.release()
+        self.bh_frame_count += 1
+        for client in clients:
+            ret = client.bc_frame_put(frame)
+            if ret and not client.bc_closed:
+                logging.error("dropping websocket client because sending "
+                              "to it is blocked for more than [%d] seconds",
+                              BROADCAST_MAX_LAG)
+                self.bh_dropped_count += 1
+                self.bh_client_remove(client)
+
+    def bh_stats(self):
+        """
+        Return the statistics of the hub
+        """
+        self.bh_condition.acquire()
+        clients = []
+        for client in self.bh_clients:
+            clients.append(client.bc_stats())
+        self.bh_condition.release()
+        return {"frames": self.bh_frame_count,
+                "dropped_clients": self.bh_dropped_count,
+                "clients": clients}
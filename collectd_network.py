@@ -0,0 +1,366 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Listener of the binary protocol of Collectd network plugin
+
+Instead of posting JSON through write_http, Collectd on OSS can send the
+job stats with its network plugin. The listener decodes only the value lists
+of job stats that LIME cares about and passes them to the rate state in
+batches, skipping HTTP, JSON and WSGI.
+"""
+import re
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import traceback
+
+# local libs
+import utils
+
+# The default UDP port of Collectd network plugin
+COLLECTD_NETWORK_PORT = 25826
+# The max size of a UDP packet
+COLLECTD_PACKET_SIZE = 65535
+# The max number of packets to decode before passing datapoints on
+COLLECTD_PACKET_BATCH = 256
+# The max number of cached identifiers
+COLLECTD_IDENTIFIER_CACHE_SIZE = 100000
+# The pattern of the identifiers of OST job stats, matched against
+# "host/plugin-plugin_instance/type-type_instance". It matches the
+# identifiers of the ost_jobstats entry in the definition file of the Lustre
+# plugin, i.e. plugin "lustre", plugin instance "${fs_name}-${ost_index}",
+# type "${optype}" and type instance "${job_id}".
+COLLECTD_IDENTIFIER_PATTERN = (r"^[^/]*/lustre-(?P<fs_name>[^/]+)-"
+                               r"(?P<ost_index>OST[0-9a-fA-F]+)/"
+                               r"(?P<optype>[^/-]+)-(?P<job_id>.+)$")
+
+# Part types of the protocol
+PART_HOST = 0x0000
+PART_TIME = 0x0001
+PART_PLUGIN = 0x0002
+PART_PLUGIN_INSTANCE = 0x0003
+PART_TYPE = 0x0004
+PART_TYPE_INSTANCE = 0x0005
+PART_VALUES = 0x0006
+PART_TIME_HR = 0x0008
+PART_SIGNATURE = 0x0200
+PART_ENCRYPTION = 0x0210
+
+# Data source types of values
+VALUE_COUNTER = 0
+VALUE_GAUGE = 1
+VALUE_DERIVE = 2
+VALUE_ABSOLUTE = 3
+
+# The unit of high resolution time is 2^-30 second
+TIME_HR_UNIT = float(1 << 30)
+
+PART_HEADER = struct.Struct(">HH")
+UINT16 = struct.Struct(">H")
+UINT64 = struct.Struct(">Q")
+INT64 = struct.Struct(">q")
+DOUBLE = struct.Struct("<d")
+
+# The identifier has not been matched against the pattern yet
+IDENTIFIER_UNKNOWN = object()
+
+
+class CollectdDecoder(object):
+    """
+    Decoder of the packets of Collectd network plugin
+    """
+    def __init__(self, optypes, identifier_pattern=COLLECTD_IDENTIFIER_PATTERN,
+                 cache_size=COLLECTD_IDENTIFIER_CACHE_SIZE):
+        # The operation types of job stats to decode
+        self.cd_optypes = frozenset(optypes)
+        self.cd_regular = re.compile(identifier_pattern)
+        # Mapping from identifier to (service_id, job_id, optype), or None
+        # if the identifier is not wanted
+        self.cd_cache = {}
+        self.cd_cache_size = cache_size
+        # Number of packets which are not valid or not supported
+        self.cd_invalid_count = 0
+
+    def cd_identify(self, identifier):
+        """
+        Return (service_id, job_id, optype) of an identifier tuple, or None
+        if the values of the identifier are not wanted
+        """
+        if identifier in self.cd_cache:
+            return self.cd_cache[identifier]
+        host, plugin, plugin_instance, type_name, type_instance = identifier
+        name = host + "/" + plugin
+        if plugin_instance:
+            name += "-" + plugin_instance
+        name += "/" + type_name
+        if type_instance:
+            name += "-" + type_instance
+        match = self.cd_regular.match(name)
+        result = None
+        if match and match.group("optype") in self.cd_optypes:
+            result = (intern(match.group("ost_index")),
+                      intern(match.group("job_id")),
+                      intern(match.group("optype")))
+        if len(self.cd_cache) >= self.cd_cache_size:
+            self.cd_cache.clear()
+        self.cd_cache[identifier] = result
+        return result
+
+    def cd_decode(self, data, datapoints):
+        """
+        Decode a packet and append its wanted datapoints, each datapoint is
+        a tuple of (service_id, job_id, timestamp, value, optype). Return -1
+        if the packet is invalid.
+        """
+        # pylint: disable=too-many-locals,too-many-branches
+        # pylint: disable=too-many-statements
+        end = len(data)
+        offset = 0
+        host = plugin = plugin_instance = type_name = type_instance = ""
+        timestamp = 0
+        identity = IDENTIFIER_UNKNOWN
+        unpack_header = PART_HEADER.unpack_from
+        while offset + 4 <= end:
+            part_type, length = unpack_header(data, offset)
+            if length < 4 or offset + length > end:
+                self.cd_invalid_count += 1
+                return -1
+            if part_type == PART_VALUES:
+                # Header, number of values, and at least one type and one
+                # value
+                if length < 6 + 1 + 8:
+                    self.cd_invalid_count += 1
+                    return -1
+                if identity is IDENTIFIER_UNKNOWN:
+                    identity = self.cd_identify((host, plugin,
+                                                 plugin_instance, type_name,
+                                                 type_instance))
+                if identity is not None:
+                    count = UINT16.unpack_from(data, offset + 4)[0]
+                    value_offset = offset + 6 + count
+                    if count < 1 or value_offset + 8 * count > offset + length:
+                        self.cd_invalid_count += 1
+                        return -1
+                    value_type = ord(data[offset + 6])
+                    if value_type == VALUE_DERIVE:
+                        value = INT64.unpack_from(data, value_offset)[0]
+                    elif value_type == VALUE_GAUGE:
+                        value = DOUBLE.unpack_from(data, value_offset)[0]
+                    else:
+                        value = UINT64.unpack_from(data, value_offset)[0]
+                    datapoints.append((identity[0], identity[1], timestamp,
+                                       value, identity[2]))
+            elif part_type == PART_TIME_HR:
+                if length < 12:
+                    self.cd_invalid_count += 1
+                    return -1
+                timestamp = (UINT64.unpack_from(data, offset + 4)[0] /
+                             TIME_HR_UNIT)
+            elif part_type == PART_TYPE_INSTANCE:
+                type_instance = data[offset + 4:offset + length - 1]
+                identity = IDENTIFIER_UNKNOWN
+            elif part_type == PART_PLUGIN_INSTANCE:
+                plugin_instance = data[offset + 4:offset + length - 1]
+                identity = IDENTIFIER_UNKNOWN
+            elif part_type == PART_TYPE:
+                type_name = data[offset + 4:offset + length - 1]
+                identity = IDENTIFIER_UNKNOWN
+            elif part_type == PART_PLUGIN:
+                plugin = data[offset + 4:offset + length - 1]
+                identity = IDENTIFIER_UNKNOWN
+            elif part_type == PART_HOST:
+                host = data[offset + 4:offset + length - 1]
+                identity = IDENTIFIER_UNKNOWN
+            elif part_type == PART_TIME:
+                if length < 12:
+                    self.cd_invalid_count += 1
+                    return -1
+                timestamp = UINT64.unpack_from(data, offset + 4)[0]
+            elif part_type == PART_ENCRYPTION:
+                # Encrypted packets are not supported
+                self.cd_invalid_count += 1
+                return -1
+            offset += length
+        return 0
+
+
+class CollectdListener(object):
+    """
+    The UDP listener of Collectd network plugin
+    """
+    def __init__(self, decoder, received_func, address="0.0.0.0",
+                 port=COLLECTD_NETWORK_PORT):
+        self.cl_decoder = decoder
+        # The function to call with a list of datapoints, each datapoint is
+        # a tuple of (service_id, job_id, timestamp, value, optype)
+        self.cl_received_func = received_func
+        self.cl_address = address
+        self.cl_port = port
+        self.cl_socket = None
+        # Number of packets received
+        self.cl_packet_count = 0
+        # Number of datapoints passed on
+        self.cl_datapoint_count = 0
+        # Number of exceptions when decoding or passing on the datapoints
+        self.cl_exception_count = 0
+
+    def cl_start(self):
+        """
+        Bind the socket and start the listening thread
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.cl_address, self.cl_port))
+        except socket.error as error:
+            logging.error("failed to bind UDP port [%s:%d]: %s",
+                          self.cl_address, self.cl_port, error)
+            sock.close()
+            return -1
+        self.cl_socket = sock
+        utils.thread_start(self.cl_listen_thread, ())
+        logging.info("listening Collectd network packets on [%s:%d]",
+                     self.cl_address, self.cl_port)
+        return 0
+
+    def cl_decode(self, data, datapoints):
+        """
+        Decode a packet, an exception is logged and counted instead of
+        ending the listening thread
+        """
+        # pylint: disable=bare-except
+        try:
+            self.cl_decoder.cd_decode(data, datapoints)
+        except:
+            logging.error("exception when decoding Collectd packet: [%s]",
+                          traceback.format_exc())
+            self.cl_exception_count += 1
+
+    def cl_listen_thread(self):
+        """
+        Receive packets, and pass the datapoints on in batches
+        """
+        sock = self.cl_socket
+        while True:
+            datapoints = []
+            data = sock.recv(COLLECTD_PACKET_SIZE)
+            self.cl_decode(data, datapoints)
+            packets = 1
+            # Decode the packets that are already waiting, so that the
+            # datapoints are passed on in larger batches
+            while packets < COLLECTD_PACKET_BATCH:
+                readable = select.select([sock], [], [], 0)[0]
+                if not readable:
+                    break
+                try:
+                    data = sock.recv(COLLECTD_PACKET_SIZE)
+                except socket.error as error:
+                    if error.errno in (errno.EAGAIN, errno.EINTR):
+                        break
+                    raise
+                self.cl_decode(data, datapoints)
+                packets += 1
+            self.cl_packet_count += packets
+            if len(datapoints) == 0:
+                continue
+            # pylint: disable=bare-except
+            try:
+                self.cl_received_func(datapoints)
+            except:
+                logging.error("exception when passing on Collectd "
+                              "datapoints: [%s]", traceback.format_exc())
+                self.cl_exception_count += 1
+                continue
+            self.cl_datapoint_count += len(datapoints)
+
+    def cl_stats(self):
+        """
+        Return the statistics of the listener
+        """
+        return {"packets": self.cl_packet_count,
+                "datapoints": self.cl_datapoint_count,
+                "invalid": self.cl_decoder.cd_invalid_count,
+                "exceptions": self.cl_exception_count}
+
+
+def string_part_encode(part_type, string):
+    """
+    Encode a string part
+    """
+    return PART_HEADER.pack(part_type, 4 + len(string) + 1) + string + "\0"
+
+
+def benchmark_packet(job_number, ost_index="OST0000"):
+    """
+    Build a packet of job stats like what Collectd sends
+    """
+    parts = [string_part_encode(PART_HOST, "server1"),
+             PART_HEADER.pack(PART_TIME_HR, 12) +
+             UINT64.pack(int(time.time() * TIME_HR_UNIT)),
+             string_part_encode(PART_PLUGIN, "lustre"),
+             string_part_encode(PART_PLUGIN_INSTANCE,
+                                "lustre-%s" % ost_index),
+             string_part_encode(PART_TYPE, "sum_write_bytes")]
+    for index in range(job_number):
+        parts.append(string_part_encode(PART_TYPE_INSTANCE,
+                                        "dd.%d" % index))
+        parts.append(PART_HEADER.pack(PART_VALUES, 15) + UINT16.pack(1) +
+                     chr(VALUE_DERIVE) + INT64.pack(index * 1048576))
+    return "".join(parts)
+
+
+def benchmark_decoder(seconds=3):
+    """
+    Measure the number of samples that the decoder decodes per second
+    """
+    decoder = CollectdDecoder(["sum_write_bytes"])
+    # Collectd fills packets up to 1452 bytes by default
+    packets = []
+    for ost_index in range(32):
+        packets.append(benchmark_packet(40, "OST%04x" % ost_index))
+    samples = 0
+    start_time = time.time()
+    while time.time() - start_time < seconds:
+        datapoints = []
+        for packet in packets:
+            decoder.cd_decode(packet, datapoints)
+        samples += len(datapoints)
+    duration = time.time() - start_time
+    print("packet size: %d bytes, decoded %d samples in %.2f seconds, "
+          "%d samples per second" %
+          (len(packets[0]), samples, duration, samples / duration))
+
+
+def check_truncated_parts():
+    """
+    Check that packets with truncated parts are counted as invalid instead
+    of raising exceptions
+    """
+    decoder = CollectdDecoder(["sum_write_bytes"])
+    packet = benchmark_packet(1)
+    truncated_parts = [PART_HEADER.pack(PART_TIME_HR, 4),
+                       PART_HEADER.pack(PART_TIME, 8) + "\0" * 4,
+                       PART_HEADER.pack(PART_VALUES, 4),
+                       PART_HEADER.pack(PART_VALUES, 15) + UINT16.pack(2) +
+                       chr(VALUE_DERIVE) * 2 + "\0" * 7]
+    for part in truncated_parts:
+        datapoints = []
+        if decoder.cd_decode(packet + part, datapoints) != -1:
+            print("truncated part %r is not detected" % part)
+            return -1
+    if decoder.cd_invalid_count != len(truncated_parts):
+        print("expected %d invalid packets, got %d" %
+              (len(truncated_parts), decoder.cd_invalid_count))
+        return -1
+    return 0
+
+
+if __name__ == "__main__":
+    if check_truncated_parts():
+        sys.exit(-1)
+    benchmark_decoder()
+    sys.exit(0)
@@ -0,0 +1,174 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Weighted max-min fair allocation of the rates of jobs on hosts
+
+Each (job, host) pair is a flow that goes through two shared resources: the
+host, whose capacity is shared by all jobs on it, and the job, whose target
+rate is shared by all its hosts. Each flow has a demand and the weight of
+its job. In a weighted max-min fair allocation, no flow can get more without
+taking from a flow with the same or a lower level, where the level of a
+flow is its rate divided by its weight.
+
+Each resource has a water level. A flow gets its demand, capped by its
+weight times the lower level of its host and its job:
+
+    allocation[j, h] = min(demand[j, h],
+                           weight[j] * min(host_level[h], job_level[j]))
+
+The level of a host is where the allocations on it sum up to its capacity,
+or infinite if the demands fit. The same goes for jobs and their targets.
+The levels of all hosts are solved at once with one sort and cumulative
+sums, then the levels of all jobs, and the two steps are repeated until the
+levels stop changing. The host levels only rise and the job levels only
+fall between the steps, so it converges, usually in a few iterations. The
+levels of the last solve can be passed back to start from.
+"""
+import sys
+import time
+import numpy
+
+# The max number of iterations of a solve
+SOLVE_ITERATIONS = 20
+# The relative change of levels under which the solve stops
+SOLVE_TOLERANCE = 1e-4
+
+
+def water_levels(caps, weights, capacities):
+    """
+    For each row i, return the level L so that
+    sum(min(caps[i], weights[i] * L)) == capacities[i], or infinite if
+    sum(caps[i]) is not more than capacities[i]. The weights are positive.
+    """
+    ratios = caps / weights
+    order = numpy.argsort(ratios, axis=1)
+    ratios = numpy.take_along_axis(ratios, order, axis=1)
+    caps = numpy.take_along_axis(caps, order, axis=1)
+    weights = numpy.take_along_axis(weights, order, axis=1)
+    # At the level of the k-th ratio, the flows before k get their caps and
+    # the others get their weights times the level
+    capped = numpy.cumsum(caps, axis=1) - caps
+    growing = (weights.sum(axis=1)[:, numpy.newaxis] -
+               numpy.cumsum(weights, axis=1) + weights)
+    used = capped + ratios * growing
+    capacities = capacities[:, numpy.newaxis]
+    full = used >= capacities
+    # The first flow that gets its level rather than its cap
+    first = numpy.argmax(full, axis=1)
+    rows = numpy.arange(len(caps))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        levels = ((capacities[:, 0] - capped[rows, first]) /
+                  growing[rows, first])
+    levels[~full[rows, first]] = numpy.inf
+    return numpy.maximum(levels, 0)
+
+
+def fair_share_solve(demands, weights, job_targets, host_capacities,
+                     job_levels=None, iterations=SOLVE_ITERATIONS,
+                     tolerance=SOLVE_TOLERANCE):
+    """
+    Return (allocations, job_levels, host_levels, iterations) of the demands
+    of jobs on hosts, an array of (job, host). The targets of jobs and the
+    capacities of hosts can be infinite. The weights of jobs are positive.
+    """
+    # pylint: disable=too-many-arguments
+    demands = numpy.maximum(demands, 0)
+    job_number, host_number = demands.shape
+    if job_number == 0 or host_number == 0:
+        return (numpy.zeros(demands.shape), numpy.full(job_number, numpy.inf),
+                numpy.full(host_number, numpy.inf), 0)
+    cell_weights = numpy.repeat(weights[:, numpy.newaxis], host_number,
+                                axis=1)
+    if job_levels is None:
+        job_levels = numpy.full(job_number, numpy.inf)
+    host_levels = numpy.zeros(host_number)
+    iteration = 0
+    while iteration < iterations:
+        iteration += 1
+        # The levels of hosts, with the flows capped by their jobs
+        caps = numpy.minimum(demands,
+                             cell_weights * job_levels[:, numpy.newaxis])
+        new_host_levels = water_levels(caps.T, cell_weights.T,
+                                       host_capacities)
+        # The levels of jobs, with the flows capped by their hosts
+        caps = numpy.minimum(demands,
+                             cell_weights * new_host_levels[numpy.newaxis, :])
+        new_job_levels = water_levels(caps, cell_weights, job_targets)
+        with numpy.errstate(invalid="ignore"):
+            converged = (levels_close(new_host_levels, host_levels,
+                                      tolerance) and
+                         levels_close(new_job_levels, job_levels, tolerance))
+        host_levels = new_host_levels
+        job_levels = new_job_levels
+        if converged:
+            break
+    levels = numpy.minimum(job_levels[:, numpy.newaxis],
+                           host_levels[numpy.newaxis, :])
+    allocations = numpy.minimum(demands, cell_weights * levels)
+    return allocations, job_levels, host_levels, iteration
+
+
+def levels_close(levels, old_levels, tolerance):
+    """
+    Whether the levels are close to the old levels, infinite levels are only
+    close to infinite levels
+    """
+    both_infinite = numpy.isinf(levels) & numpy.isinf(old_levels)
+    difference = numpy.abs(levels - old_levels)
+    close = difference <= tolerance * numpy.maximum(numpy.abs(levels), 1)
+    return bool(numpy.all(both_infinite | close))
+
+
+def benchmark_solve(job_number=1000, host_number=100, seconds=3):
+    """
+    Measure the time of solving random allocations, from scratch and from
+    the levels of the last solve, and check the constraints
+    """
+    # pylint: disable=too-many-locals
+    random = numpy.random.RandomState(0)
+    demands = random.exponential(100, (job_number, host_number))
+    # Most jobs only use some of the hosts
+    demands[random.random_sample((job_number, host_number)) < 0.7] = 0
+    weights = numpy.arange(job_number, 0, -1, dtype=numpy.float64)
+    job_targets = random.uniform(100, 3000, job_number)
+    job_targets[random.random_sample(job_number) < 0.5] = numpy.inf
+    host_capacities = random.uniform(1000, 5000, host_number)
+
+    solves = 0
+    total_iterations = 0
+    start_time = time.time()
+    while time.time() - start_time < seconds:
+        allocations, job_levels, _, iterations = fair_share_solve(
+            demands, weights, job_targets, host_capacities)
+        solves += 1
+        total_iterations += iterations
+    duration = time.time() - start_time
+    print("%d jobs x %d hosts: %.2f ms per solve from scratch, "
+          "%.1f iterations" % (job_number, host_number,
+                               duration * 1000 / solves,
+                               float(total_iterations) / solves))
+
+    slack = 1e-6 * host_capacities.max()
+    host_excess = (allocations.sum(axis=0) - host_capacities).max()
+    job_excess = (allocations.sum(axis=1) - job_targets).max()
+    demand_excess = (allocations - demands).max()
+    print("max excess over capacity %.6f, over target %.6f, over demand "
+          "%.6f" % (host_excess, job_excess, demand_excess))
+    if max(host_excess, job_excess, demand_excess) > slack:
+        print("constraints are violated")
+        return -1
+
+    # Demands change a little between ticks
+    demands = demands * random.uniform(0.95, 1.05, demands.shape)
+    start_time = time.time()
+    _, _, _, iterations = fair_share_solve(
+        demands, weights, job_targets, host_capacities,
+        job_levels=job_levels)
+    print("%.2f ms per solve from the last levels, %d iterations" %
+          ((time.time() - start_time) * 1000, iterations))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_solve())
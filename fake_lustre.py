@@ -0,0 +1,808 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Fake Lustre hosts that are emulated in process
+
+FakeLustreCluster is a HostTransport, so LustreHost runs its commands on the
+fake hosts rather than through SSH. The fake cluster has a MGS/MDS host, OSS
+hosts and client hosts. It answers the commands that LustreHost runs, i.e.
+"lctl dl", the NRS policy and TBF rule proc files, "lfs setstripe", dd and
+the collectd service. Each OSS host has a capacity in MB/s that is shared by
+the jobs writing to its OSTs, and a token bucket for each TBF rule. A thread
+does the I/O of the jobs in every interval, and posts the job stats of each
+OSS to /metric_post like the write_http plugin of Collectd.
+
+Besides the dd jobs started by LIME on the clients, a number of background
+jobs can write to the OSTs, so that the whole control plane can be tested
+with hundreds of OSS and thousands of jobs on one machine.
+"""
+import bisect
+import httplib
+import json
+import logging
+import re
+import socket
+import sys
+import threading
+import time
+import urllib2
+
+# local libs
+import lustre_config
+import metric_ingest
+import rate_engine
+import ssh_host
+import tbf_agent
+import utils
+
+# The Lustre version of the fake hosts
+FAKE_LUSTRE_VERSION = "2.10.0.0"
+# Default number of OSS hosts, OSTs on each OSS and client hosts
+FAKE_OSS_NUMBER = 2
+FAKE_OSTS_PER_OSS = 2
+FAKE_CLIENT_NUMBER = 2
+# Default capacity of each OSS, MB/s
+FAKE_CAPACITY = 1000
+# How many times faster an OSS is when fake I/O is enabled
+FAKE_IO_SPEEDUP = 4
+# The fail_loc that enables fake I/O on OSS
+FAIL_LOC_FAKE_IO = "0x238"
+# The rate that a dd process tries to write at, MB/s
+FAKE_DD_DEMAND = 10000
+# The process name of the I/O started by LIME
+FAKE_DD_NAME = "dd"
+# The exit status of a process killed by signal 9
+FAKE_EXIT_STATUS_KILLED = 137
+# The first uid of the users other than root
+FAKE_UID_BASE = 1000
+# Default number of background jobs, their rates in MB/s and their OSTs
+FAKE_JOB_NUMBER = 0
+FAKE_JOB_RATE = 10
+FAKE_JOB_OSTS = 4
+# The process name of the background jobs
+FAKE_JOB_NAME = "job"
+# Seconds between the job stats posts of Collectd
+FAKE_COLLECTD_INTERVAL = 1
+# The URL that Collectd posts the job stats to
+FAKE_METRIC_URL = "http://127.0.0.1:24/metric_post"
+# The longest time that a post should take
+FAKE_POST_TIMEOUT = 5
+# Default seconds that each command takes, like the round trip of SSH
+FAKE_LATENCY = 0
+# The Job ID variable that names jobs by process name and uid
+JOBID_VAR_PROCNAME_UID = "procname_uid"
+# Number of RPCs that a token bucket can save beyond one step
+TBF_DEPTH = 3
+
+
+class StepCurve(object):
+    """
+    A value that changes in steps over time
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ["sc_times", "sc_values"]
+
+    def __init__(self, steps):
+        if isinstance(steps, (int, long, float)):
+            steps = [[0, steps]]
+        steps = sorted(steps)
+        self.sc_times = [step[0] for step in steps]
+        self.sc_values = [step[1] for step in steps]
+
+    def sc_value(self, second):
+        """
+        Return the value at the second, or None before the first step
+        """
+        index = bisect.bisect_right(self.sc_times, second) - 1
+        if index < 0:
+            return None
+        return self.sc_values[index]
+
+
+class TokenBucket(object):
+    """
+    The token bucket of a TBF rule on a host, each token is a RPC
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ["tb_rate", "tb_tokens"]
+
+    def __init__(self, rate):
+        self.tb_rate = rate
+        self.tb_tokens = 0.0
+
+    def tb_refill(self, seconds):
+        """
+        Add the tokens of the seconds, and return the available tokens
+        """
+        fill = self.tb_rate * seconds
+        self.tb_tokens = min(self.tb_tokens + fill, fill + TBF_DEPTH)
+        return self.tb_tokens
+
+
+class SimJob(object):
+    """
+    A simulated job with its demand on OSTs and its job stats
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, job_id, service_demands, limit=None):
+        self.sj_job_id = job_id
+        # Mapping from service ID to the StepCurve of the demand in MB/s
+        self.sj_demands = service_demands
+        # The StepCurve of the limit, None if the job has no limit
+        self.sj_limit = limit
+        # Mapping from service ID to the bytes written
+        self.sj_counters = {}
+        for service_id in service_demands:
+            self.sj_counters[service_id] = 0
+
+
+class SimHost(object):
+    """
+    A simulated OSS host, with the interfaces of LustreHost that are used by
+    the policies and the actuator
+    """
+    def __init__(self, hostname, capacity, service_ids):
+        self.sh_hostname = hostname
+        self.smh_capacity = capacity
+        self.smh_service_ids = service_ids
+        # Mapping from TBF rule name to (expression, TokenBucket)
+        self.smh_rules = {}
+        # Mapping from job ID to TokenBucket
+        self.smh_buckets = {}
+        # Number of TBF operations applied
+        self.smh_operation_count = 0
+
+    def lh_tbf_operations(self, operations):
+        """
+        Apply TBF operations, return the list of the return values
+        """
+        rets = []
+        for operation in operations:
+            self.smh_operation_count += 1
+            rets.append(self.smh_tbf_operation(operation))
+        return rets
+
+    def smh_tbf_operation(self, operation):
+        """
+        Apply a TBF operation
+        """
+        name = operation.get("name")
+        if operation["op"] == tbf_agent.OPERATION_START:
+            if name in self.smh_rules:
+                return -1
+            bucket = TokenBucket(operation["rate"])
+            expression = operation["expression"]
+            self.smh_rules[name] = (expression, bucket)
+            self.smh_buckets[expression] = bucket
+        elif operation["op"] == tbf_agent.OPERATION_CHANGE:
+            if name not in self.smh_rules:
+                return -1
+            self.smh_rules[name][1].tb_rate = operation["rate"]
+        elif operation["op"] == tbf_agent.OPERATION_STOP:
+            if name not in self.smh_rules:
+                return -1
+            expression, _ = self.smh_rules.pop(name)
+            del self.smh_buckets[expression]
+        elif operation["op"] != tbf_agent.OPERATION_POLICY:
+            return -1
+        return 0
+
+    def smh_io(self, jobs, second, seconds):
+        """
+        Do the I/O of the jobs on this host for the seconds
+        """
+        offers = []
+        total = 0.0
+        for job in jobs:
+            service_offers = []
+            offered = 0.0
+            for service_id in self.smh_service_ids:
+                demand = job.sj_demands.get(service_id)
+                if demand is None:
+                    continue
+                rpcs = (demand.sc_value(second) or 0) * seconds
+                service_offers.append((service_id, rpcs))
+                offered += rpcs
+            if offered <= 0:
+                continue
+            bucket = self.smh_buckets.get(job.sj_job_id)
+            allowed = offered
+            if bucket is not None:
+                allowed = min(offered, bucket.tb_refill(seconds))
+            offers.append((job, bucket, service_offers, offered, allowed))
+            total += allowed
+
+        scale = 1.0
+        if total > self.smh_capacity * seconds:
+            scale = self.smh_capacity * seconds / total
+        for job, bucket, service_offers, offered, allowed in offers:
+            served = allowed * scale
+            if bucket is not None:
+                bucket.tb_tokens -= served
+            for service_id, rpcs in service_offers:
+                job.sj_counters[service_id] += int(
+                    served * rpcs / offered * rate_engine.RATE_UNIT)
+
+
+def tbf_command_operation(fname, command):
+    """
+    Return the TBF operation of a command string written into a proc file,
+    in either syntax of tbf_agent.tbf_operation_command(), or None if the
+    command is invalid
+    """
+    # pylint: disable=too-many-return-statements
+    if fname == tbf_agent.NRS_POLICIES:
+        return {"op": tbf_agent.OPERATION_POLICY, "policy": command}
+    if fname != tbf_agent.NRS_TBF_RULE:
+        return None
+    fields = command.split()
+    if len(fields) < 2:
+        return None
+    operation = {"op": fields[0], "name": fields[1]}
+    try:
+        if fields[0] == tbf_agent.OPERATION_START and len(fields) == 4:
+            expression = fields[2]
+            if expression.startswith("jobid="):
+                expression = expression[len("jobid="):]
+            rate = fields[3]
+            if rate.startswith("rate="):
+                rate = rate[len("rate="):]
+            if not (expression.startswith("{") and
+                    expression.endswith("}")):
+                return None
+            operation["expression"] = expression[1:-1]
+            operation["rate"] = int(rate)
+        elif fields[0] == tbf_agent.OPERATION_CHANGE and len(fields) == 3:
+            rate = fields[2]
+            if rate.startswith("rate="):
+                rate = rate[len("rate="):]
+            operation["rate"] = int(rate)
+        elif fields[0] != tbf_agent.OPERATION_STOP or len(fields) != 2:
+            return None
+    except ValueError:
+        return None
+    return operation
+
+
+class FakeWriter(object):
+    """
+    A process that writes to a file on a fake client until it is killed
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, job_id, fname, service_ids):
+        self.fw_job_id = job_id
+        self.fw_fname = fname
+        self.fw_service_ids = service_ids
+        self.fw_killed = threading.Event()
+
+
+class FakeHost(object):
+    """
+    A fake Lustre host
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, hostname):
+        self.fh_hostname = hostname
+        # The lines that "lctl dl" prints
+        self.fh_devices = []
+        # The lines of Lustre in /proc/mounts
+        self.fh_mounts = []
+        # Whether this host runs the MGS
+        self.fh_mgs = False
+        # The SimHost of the I/O on the OSTs, None if not an OSS
+        self.fh_sim = None
+        # Mapping from job ID to the SimJob that writes to the OSTs
+        self.fh_jobs = {}
+        # The process ID of collectd, None if not running
+        self.fh_collectd_pid = None
+        self.fh_fail_loc = "0"
+        # The NRS policy of ost_io
+        self.fh_nrs_policy = "fifo"
+        # The running FakeWriter list
+        self.fh_writers = []
+
+
+class FakeLustreCluster(ssh_host.HostTransport):
+    """
+    A fake Lustre cluster that runs the commands of LustreHost in process
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, fsname, oss_number=FAKE_OSS_NUMBER,
+                 osts_per_oss=FAKE_OSTS_PER_OSS,
+                 client_number=FAKE_CLIENT_NUMBER, capacity=FAKE_CAPACITY,
+                 job_number=FAKE_JOB_NUMBER, job_rate=FAKE_JOB_RATE,
+                 job_osts=FAKE_JOB_OSTS, interval=FAKE_COLLECTD_INTERVAL,
+                 url=FAKE_METRIC_URL, post_func=None, latency=FAKE_LATENCY):
+        # The name from the JSON config is unicode, but the output of
+        # commands is not
+        fsname = str(fsname)
+        self.flc_fsname = fsname
+        self.flc_capacity = capacity
+        self.flc_interval = interval
+        self.flc_url = url
+        self.flc_latency = latency
+        # The function to post a payload of Collectd, the payload is posted
+        # to the URL if None
+        self.flc_post_func = post_func
+        if post_func is None:
+            self.flc_post_func = self.flc_url_post
+        # Mapping from hostname to FakeHost
+        self.flc_hosts = {}
+        self.flc_hostnames = []
+        self.flc_oss_hosts = []
+        # Mapping from OST service ID to the FakeHost
+        self.flc_service_hosts = {}
+        self.flc_service_ids = []
+        # Mapping from job ID to SimJob
+        self.flc_jobs = {}
+        # Mapping from file name to the stripe count set by lfs setstripe
+        self.flc_stripes = {}
+        # Mapping from user name to uid
+        self.flc_uids = {"root": 0}
+        self.flc_jobid_var = "disable"
+        self.flc_pid = 1000
+        self.flc_collectd_started = False
+        self.flc_start_time = time.time()
+        self.flc_condition = threading.Condition()
+        self.flc_post_count = 0
+        self.flc_post_failure_count = 0
+        self.flc_tbf_operation_count = 0
+        self.flc_command_count = 0
+
+        mds = self.flc_host_add("fake-mds0")
+        mds.fh_mgs = True
+        mds.fh_devices.append("  0 UP mgs MGS MGS 7")
+        mds.fh_devices.append("  1 UP mdt %s-MDT0000 %s-MDT0000_UUID 9" %
+                              (fsname, fsname))
+        mds.fh_mounts.append("/dev/sdb /mnt/%s-mdt0 lustre ro 0 0" % fsname)
+        for oss_index in range(oss_number):
+            host = self.flc_host_add("fake-oss%d" % oss_index)
+            service_ids = []
+            for ost_index in range(osts_per_oss):
+                index = oss_index * osts_per_oss + ost_index
+                service_id = intern("OST%04x" % index)
+                service_ids.append(service_id)
+                self.flc_service_ids.append(service_id)
+                self.flc_service_hosts[service_id] = host
+                host.fh_devices.append(
+                    "  %d UP obdfilter %s-%s %s-%s_UUID 5" %
+                    (ost_index, fsname, service_id, fsname, service_id))
+                host.fh_mounts.append("/dev/sd%s /mnt/%s-ost%d lustre ro "
+                                      "0 0" % (chr(ord("b") + ost_index),
+                                               fsname, index))
+            host.fh_sim = SimHost(host.fh_hostname, capacity, service_ids)
+            self.flc_oss_hosts.append(host)
+        for client_index in range(client_number):
+            host = self.flc_host_add("fake-client%d" % client_index)
+            host.fh_mounts.append("10.0.1.%d@tcp:/%s /mnt/%s lustre "
+                                  "rw,flock,lazystatfs 0 0" %
+                                  (client_index + 1, fsname, fsname))
+        self.flc_jobs_add(job_number, job_rate, job_osts)
+
+        self.flc_commands = [
+            (r"^true$", self._flc_true),
+            (r"^cat /proc/fs/lustre/version \| grep lustre: \| awk",
+             self._flc_version),
+            (r"^lctl dl$", self._flc_devices),
+            (r"^cat /proc/fs/lustre/mgs/MGS/filesystems$",
+             self._flc_filesystems),
+            (r"^cat /proc/mounts \| grep lustre$", self._flc_mounts),
+            (r"^cat /sys/module/libcfs/parameters/cpu_npartitions$",
+             self._flc_cpt),
+            (r"^lctl set_param fail_loc=(?P<fail_loc>\S+)$",
+             self._flc_fail_loc),
+            (r"^lctl conf_param (?P<fsname>[^.\s]+)\.sys\.jobid_var="
+             r"(?P<jobid_var>\S+)$", self._flc_jobid_var),
+            (r"^ps aux \| grep /usr/sbin/collectd ", self._flc_collectd_ps),
+            (r"^kill -9 (?P<pid>\d+)$", self._flc_kill),
+            (r"^service collectd restart$", self._flc_collectd_restart),
+            (r"^rm -f (?P<fname>\S+)$", self._flc_remove),
+            (r"^lfs setstripe +(-c (?P<count>-?\d+) +)?(?P<fname>\S+)$",
+             self._flc_setstripe),
+            (r"^chmod 777 \S+$", self._flc_true),
+            (r"^dd if=/dev/zero of=(?P<fname>\S+) bs=1M count=\d+ 2>&1 \| "
+             r"awk ", self._flc_benchmark),
+            (r"^dd if=/dev/zero of=(?P<fname>\S+) bs=1M$", self._flc_write),
+            (r"^fuser -km (?P<mount_point>\S+)$", self._flc_fuser_kill),
+            (r"^echo -n .+; echo %s \d+ \$\?$" %
+             lustre_config.TBF_STATUS_PREFIX, self._flc_tbf)]
+        self.flc_commands = [(re.compile(pattern), func)
+                             for pattern, func in self.flc_commands]
+        self.flc_tbf_regular = re.compile(
+            r"echo -n (?P<command>.+?) > %s/(?P<fname>\S+); "
+            r"echo %s (?P<index>\d+) \$\?" %
+            (re.escape(lustre_config.TBF_PROC_DIR),
+             lustre_config.TBF_STATUS_PREFIX))
+
+    def flc_host_add(self, hostname):
+        """
+        Add a fake host
+        """
+        hostname = intern(hostname)
+        host = FakeHost(hostname)
+        self.flc_hosts[hostname] = host
+        self.flc_hostnames.append(hostname)
+        return host
+
+    def flc_jobs_add(self, job_number, job_rate, job_osts):
+        """
+        Add background jobs that keep writing to some of the OSTs
+        """
+        service_number = len(self.flc_service_ids)
+        if service_number == 0:
+            return
+        job_osts = min(job_osts, service_number)
+        for job_index in range(job_number):
+            job_id = intern("%s.%d" % (FAKE_JOB_NAME, FAKE_UID_BASE +
+                                       job_index))
+            start = job_index * job_osts
+            service_demands = {}
+            for ost_index in range(job_osts):
+                service_id = self.flc_service_ids[(start + ost_index) %
+                                                  service_number]
+                service_demands[service_id] = StepCurve(float(job_rate) /
+                                                        job_osts)
+            self.flc_job_demands_set(job_id, service_demands)
+
+    def flc_job_demands_set(self, job_id, service_demands):
+        """
+        Change the demands of a job, the job stats are kept
+        """
+        job = self.flc_jobs.get(job_id)
+        if job is None:
+            job = SimJob(job_id, {})
+            self.flc_jobs[job_id] = job
+        job.sj_demands = service_demands
+        for service_id in service_demands:
+            job.sj_counters.setdefault(service_id, 0)
+            self.flc_service_hosts[service_id].fh_jobs[job_id] = job
+
+    def ht_run(self, hostname, command, login_name="root", timeout=None):
+        """
+        Run a command on a fake host
+        """
+        host = self.flc_hosts.get(hostname)
+        if host is None:
+            return utils.CommandResult(
+                stderr=("ssh: Could not resolve hostname %s: Name or "
+                        "service not known\n" % hostname),
+                exit_status=ssh_host.SSH_EXIT_STATUS_ERROR)
+        start_time = time.time()
+        self.flc_command_count += 1
+        if self.flc_latency > 0:
+            time.sleep(self.flc_latency)
+        for regular, func in self.flc_commands:
+            match = regular.match(command)
+            if match is None:
+                continue
+            exit_status, stdout, stderr = func(host, match, login_name,
+                                               timeout)
+            return utils.CommandResult(stdout=stdout, stderr=stderr,
+                                       exit_status=exit_status,
+                                       duration=time.time() - start_time)
+        logging.error("command [%s] is not supported by fake host [%s]",
+                      command, hostname)
+        return utils.CommandResult(stderr="bash: command not found\n",
+                                   exit_status=127)
+
+    def _flc_true(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        return 0, "", ""
+
+    def _flc_version(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        return 0, FAKE_LUSTRE_VERSION + "\n", ""
+
+    def _flc_devices(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        return 0, "".join([line + "\n" for line in host.fh_devices]), ""
+
+    def _flc_filesystems(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        if not host.fh_mgs:
+            return (1, "", "cat: /proc/fs/lustre/mgs/MGS/filesystems: No "
+                    "such file or directory\n")
+        return 0, self.flc_fsname + "\n", ""
+
+    def _flc_mounts(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        if len(host.fh_mounts) == 0:
+            return 1, "", ""
+        return 0, "".join([line + "\n" for line in host.fh_mounts]), ""
+
+    def _flc_cpt(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        return 0, "1\n", ""
+
+    def _flc_fail_loc(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        host.fh_fail_loc = match.group("fail_loc")
+        if host.fh_sim is not None:
+            host.fh_sim.smh_capacity = self.flc_capacity
+            if host.fh_fail_loc == FAIL_LOC_FAKE_IO:
+                host.fh_sim.smh_capacity *= FAKE_IO_SPEEDUP
+        return 0, "fail_loc=%s\n" % host.fh_fail_loc, ""
+
+    def _flc_jobid_var(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        if not host.fh_mgs or match.group("fsname") != self.flc_fsname:
+            return 19, "", "error: conf_param: No such device\n"
+        self.flc_jobid_var = match.group("jobid_var")
+        return 0, "", ""
+
+    def _flc_collectd_ps(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        if host.fh_collectd_pid is None:
+            return 0, "", ""
+        return 0, "%d\n" % host.fh_collectd_pid, ""
+
+    def _flc_kill(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument,no-self-use
+        if int(match.group("pid")) != host.fh_collectd_pid:
+            return (1, "", "bash: kill: (%s) - No such process\n" %
+                    match.group("pid"))
+        host.fh_collectd_pid = None
+        return 0, "", ""
+
+    def _flc_collectd_restart(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        self.flc_pid += 1
+        host.fh_collectd_pid = self.flc_pid
+        if not self.flc_collectd_started:
+            self.flc_collectd_started = True
+            utils.thread_start(self.flc_collectd_thread, ())
+        return 0, "Starting collectd: [  OK  ]\n", ""
+
+    def _flc_remove(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        self.flc_stripes.pop(match.group("fname"), None)
+        return 0, "", ""
+
+    def _flc_setstripe(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        count = match.group("count")
+        if count is None:
+            count = 1
+        self.flc_stripes[match.group("fname")] = int(count)
+        return 0, "", ""
+
+    def flc_file_services(self, fname):
+        """
+        Return the OSTs that a file is striped over
+        """
+        service_number = len(self.flc_service_ids)
+        count = self.flc_stripes.get(fname, 1)
+        if count < 0 or count > service_number:
+            count = service_number
+        start = hash(fname) % service_number
+        return [self.flc_service_ids[(start + index) % service_number]
+                for index in range(count)]
+
+    def _flc_benchmark(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        if len(self.flc_service_ids) == 0:
+            return 0, "", ""
+        oss_hosts = set()
+        for service_id in self.flc_file_services(match.group("fname")):
+            oss_hosts.add(self.flc_service_hosts[service_id])
+        rate = 0.0
+        for oss_host in oss_hosts:
+            rate += oss_host.fh_sim.smh_capacity
+        return 0, "%.1f MB/s\n" % rate, ""
+
+    def flc_job_id(self, login_name):
+        """
+        Return the job ID of the dd process of a user
+        """
+        if self.flc_jobid_var != JOBID_VAR_PROCNAME_UID:
+            return intern(FAKE_DD_NAME)
+        if login_name not in self.flc_uids:
+            self.flc_uids[login_name] = FAKE_UID_BASE + len(self.flc_uids)
+        return intern("%s.%d" % (FAKE_DD_NAME, self.flc_uids[login_name]))
+
+    def flc_writers_update(self, job_id):
+        """
+        Update the demands of a job from its running writers
+        """
+        service_demands = {}
+        for host in self.flc_hosts.values():
+            for writer in host.fh_writers:
+                if writer.fw_job_id != job_id:
+                    continue
+                demand = float(FAKE_DD_DEMAND) / len(writer.fw_service_ids)
+                for service_id in writer.fw_service_ids:
+                    service_demands[service_id] = (
+                        service_demands.get(service_id, 0) + demand)
+        curves = {}
+        for service_id, demand in service_demands.iteritems():
+            curves[service_id] = StepCurve(demand)
+        self.flc_job_demands_set(job_id, curves)
+
+    def _flc_write(self, host, match, login_name, timeout):
+        """
+        Write to a file until killed
+        """
+        if len(self.flc_service_ids) == 0:
+            return 1, "", "dd: No space left on device\n"
+        job_id = self.flc_job_id(login_name)
+        writer = FakeWriter(job_id, match.group("fname"),
+                            self.flc_file_services(match.group("fname")))
+        host.fh_writers.append(writer)
+        self.flc_writers_update(job_id)
+        killed = writer.fw_killed.wait(timeout)
+        if writer in host.fh_writers:
+            host.fh_writers.remove(writer)
+            self.flc_writers_update(job_id)
+        if not killed:
+            return -1, "", "timeout when running command\n"
+        return FAKE_EXIT_STATUS_KILLED, "", ""
+
+    def _flc_fuser_kill(self, host, match, login_name, timeout):
+        # pylint: disable=unused-argument
+        mount_point = match.group("mount_point").rstrip("/") + "/"
+        killed = []
+        for writer in host.fh_writers[:]:
+            if not writer.fw_fname.startswith(mount_point):
+                continue
+            host.fh_writers.remove(writer)
+            writer.fw_killed.set()
+            killed.append(writer)
+        if len(killed) == 0:
+            return 1, "", ""
+        for job_id in set([writer.fw_job_id for writer in killed]):
+            self.flc_writers_update(job_id)
+        return 0, "", ""
+
+    def _flc_tbf(self, host, match, login_name, timeout):
+        """
+        Write the commands into the NRS proc files of ost_io
+        """
+        # pylint: disable=unused-argument
+        if host.fh_sim is None:
+            return 0, "", "No such file or directory\n"
+        lines = []
+        for command_match in self.flc_tbf_regular.finditer(match.group(0)):
+            self.flc_tbf_operation_count += 1
+            operation = tbf_command_operation(command_match.group("fname"),
+                                              command_match.group("command"))
+            status = 1
+            if operation is not None:
+                status = self.flc_tbf_operation(host, operation)
+            lines.append("%s %s %d\n" % (lustre_config.TBF_STATUS_PREFIX,
+                                         command_match.group("index"),
+                                         status))
+        return 0, "".join(lines), ""
+
+    def flc_tbf_operation(self, host, operation):
+        """
+        Apply a TBF operation on an OSS, return the exit status of the write
+        """
+        # pylint: disable=no-self-use
+        sim = host.fh_sim
+        if operation["op"] == tbf_agent.OPERATION_POLICY:
+            policy = operation["policy"]
+            if policy != "fifo" and not policy.startswith("tbf"):
+                return 1
+            if policy != host.fh_nrs_policy:
+                # The rules are gone with the old policy
+                sim.smh_rules = {}
+                sim.smh_buckets = {}
+            host.fh_nrs_policy = policy
+            return 0
+        if not host.fh_nrs_policy.startswith("tbf"):
+            return 1
+        if sim.lh_tbf_operations([operation])[0]:
+            return 1
+        return 0
+
+    def flc_collect(self, seconds):
+        """
+        Do the I/O of the seconds on all OSS, and post the job stats of the
+        OSS that run collectd
+        """
+        now = time.time()
+        second = now - self.flc_start_time
+        for host in self.flc_oss_hosts:
+            jobs = host.fh_jobs.values()
+            host.fh_sim.smh_io(jobs, second, seconds)
+            if host.fh_collectd_pid is None:
+                continue
+            metrics = []
+            for job in jobs:
+                for service_id in host.fh_sim.smh_service_ids:
+                    value = job.sj_counters.get(service_id)
+                    if not value:
+                        continue
+                    tags = ("optype=%s fs_name=%s ost_index=%s job_id=%s" %
+                            (metric_ingest.OPTYPE_SUM_WRITE_BYTES,
+                             self.flc_fsname, service_id, job.sj_job_id))
+                    metrics.append({
+                        "values": [value], "dstypes": ["derive"],
+                        "dsnames": ["value"], "time": now,
+                        "interval": self.flc_interval,
+                        "host": host.fh_hostname, "plugin": "lustre",
+                        "meta": {"tsdb_name":
+                                 metric_ingest.TSDB_NAME_OST_JOBSTATS,
+                                 "tsdb_tags": tags}})
+            if len(metrics) == 0:
+                continue
+            self.flc_post_count += 1
+            ret = self.flc_post_func(json.dumps(metrics))
+            if ret:
+                self.flc_post_failure_count += 1
+
+    def flc_url_post(self, payload):
+        """
+        Post a payload to the URL, return 0 if posted
+        """
+        request = urllib2.Request(self.flc_url, payload,
+                                  {"Content-Type": "application/json"})
+        try:
+            urllib2.urlopen(request, timeout=FAKE_POST_TIMEOUT).read()
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            # The web server might not be started yet
+            logging.debug("failed to post job stats to [%s]", self.flc_url)
+            return -1
+        return 0
+
+    def flc_collectd_thread(self):
+        """
+        The thread that does the I/O and posts the job stats in every
+        interval
+        """
+        next_time = time.time()
+        while True:
+            next_time += self.flc_interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()
+            self.flc_collect(self.flc_interval)
+
+    def flc_stats(self):
+        """
+        Return the statistics of the fake cluster
+        """
+        writers = 0
+        for host in self.flc_hosts.values():
+            writers += len(host.fh_writers)
+        return {"hosts": len(self.flc_hosts),
+                "oss": len(self.flc_oss_hosts),
+                "jobs": len(self.flc_jobs),
+                "writers": writers,
+                "commands": self.flc_command_count,
+                "posts": self.flc_post_count,
+                "post_failures": self.flc_post_failure_count,
+                "tbf_operations": self.flc_tbf_operation_count}
+
+
+def benchmark_collect(oss_number=500, job_number=5000, seconds=5):
+    """
+    Measure the time of doing the I/O and posting the job stats of one
+    interval, with the payloads decoded by an ingester in process
+    """
+    datapoints = []
+    ingester = metric_ingest.MetricIngester(datapoints.extend,
+                                            consume_thread=False)
+    cluster = FakeLustreCluster("lime", oss_number=oss_number,
+                                job_number=job_number,
+                                post_func=ingester.mi_post)
+    for host in cluster.flc_oss_hosts:
+        host.fh_collectd_pid = 0
+    rounds = 0
+    start_time = time.time()
+    while time.time() - start_time < seconds:
+        cluster.flc_collect(FAKE_COLLECTD_INTERVAL)
+        ingester.mi_consume(wait=False)
+        rounds += 1
+    duration = time.time() - start_time
+    print("%d OSS x %d jobs: %.1f ms per interval, %d datapoints per "
+          "interval" % (oss_number, job_number, duration * 1000 / rounds,
+                        len(datapoints) / rounds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_collect())
@@ -0,0 +1,419 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Discrete-time simulation of rate policies without a Lustre cluster
+
+The simulated cluster stands in for LustreCluster and LustreHost. Each OSS
+host has a capacity in RPC/s that is shared by the jobs doing I/O on its
+OSTs, and a token bucket for each TBF rule. In each step of one second, a
+job offers the RPCs of its demand curve, each host lets through what the
+token bucket of the job allows, and scales the RPCs down to its capacity if
+needed. The counters of the job stats are then fed into WatchedJobs, the
+current policy tunes the jobs, and the TBF rate changes are written to the
+simulated hosts synchronously.
+
+A scenario is a JSON file like:
+
+    {"hosts": 4, "osts_per_host": 2, "capacity": 1000, "duration": 600,
+     "jobs": [{"job_id": "dd.0", "limit": [[0, 1000], [300, 400]],
+               "demand": 1500, "osts": [0, 1, 2]}]}
+
+The limit and the demand of a job are either a number or a list of
+[second, value] steps. The demand is in MB/s and spread evenly over the OSTs
+of the job, all OSTs if not given. Each RPC is RATE_UNIT bytes, so the
+rates of jobs are in the same unit as the TBF rates.
+
+A recorded trace of the payloads that Collectd posted to /metric, one
+payload per line, can be replayed instead of the demands of the scenario.
+The rates of the jobs on the OSTs in the trace become the demand curves, so
+the jobs are still throttled by the simulated TBF rules.
+"""
+import json
+import logging
+import optparse
+import sys
+import time
+
+# local libs
+import fake_lustre
+import lime_web
+import metric_ingest
+import rate_engine
+import tbf_agent
+
+# Seconds of each step of the simulation
+SIM_STEP = 1
+# Default number of OSS hosts and OSTs on each host
+SIM_HOSTS = 4
+SIM_OSTS_PER_HOST = 2
+# Default capacity of each host, RPC/s
+SIM_CAPACITY = 1000
+# Default number of seconds to simulate
+SIM_DURATION = 600
+# The optype of the job stats fed into WatchedJobs
+SIM_OPTYPE = metric_ingest.OPTYPE_SUM_WRITE_BYTES
+# The websocket that watches the simulated jobs
+SIM_WEBSOCKET = "simulator"
+
+
+class SimCluster(object):
+    """
+    A simulated cluster, with the interfaces of LustreCluster that are used
+    by WatchedJobs
+    """
+    def __init__(self, host_number, osts_per_host, capacity):
+        self.sc_hosts = []
+        self.lc_map_service_host = {}
+        for host_index in range(host_number):
+            service_ids = []
+            for ost_index in range(osts_per_host):
+                index = host_index * osts_per_host + ost_index
+                service_ids.append("OST%04x" % index)
+            host = fake_lustre.SimHost("oss%d" % host_index, capacity,
+                                       service_ids)
+            self.sc_hosts.append(host)
+            for service_id in service_ids:
+                self.lc_map_service_host[service_id] = host
+        # A job striped over all OSTs can use all hosts
+        self.lc_max_real_iops = capacity * host_number
+        self.lc_max_fake_iops = capacity * host_number
+
+    def lc_oss_hosts(self):
+        """
+        Return the OSS hosts
+        """
+        return self.sc_hosts
+
+    def lc_tbf_operations(self, host_operations):
+        # pylint: disable=no-self-use
+        """
+        Apply TBF operations on hosts, host_operations is a list of (host,
+        operations)
+        """
+        results = {}
+        for host, operations in host_operations:
+            results[host.sh_hostname] = host.lh_tbf_operations(operations)
+        return results
+
+    def lc_oss_tbf_operations(self, operations):
+        """
+        Apply the same TBF operations on all OSS
+        """
+        host_operations = []
+        for host in self.sc_hosts:
+            host_operations.append((host, operations))
+        return self.lc_tbf_operations(host_operations)
+
+    def lc_start_tbf_rule(self, name, expression, rate):
+        """
+        Start a TBF rule
+        """
+        operation = {"op": tbf_agent.OPERATION_START, "name": name,
+                     "expression": expression, "rate": rate}
+        return self.sc_operation_status(operation)
+
+    def lc_stop_tbf_rule(self, name):
+        """
+        Stop a TBF rule
+        """
+        operation = {"op": tbf_agent.OPERATION_STOP, "name": name}
+        return self.sc_operation_status(operation)
+
+    def sc_operation_status(self, operation):
+        """
+        Apply a TBF operation on all OSS, return -1 if failed on any host
+        """
+        results = self.lc_oss_tbf_operations([operation])
+        for rets in results.values():
+            if rets[0]:
+                return -1
+        return 0
+
+    def lc_enable_fake_io_for_oss(self):
+        # pylint: disable=no-self-use
+        """
+        Fake I/O is the same as real I/O in simulation
+        """
+        return 0
+
+    def lc_clear_loc_for_oss(self):
+        # pylint: disable=no-self-use
+        """
+        Fake I/O is the same as real I/O in simulation
+        """
+        return 0
+
+    def sc_operation_count(self):
+        """
+        Return the number of TBF operations applied on all hosts
+        """
+        count = 0
+        for host in self.sc_hosts:
+            count += host.smh_operation_count
+        return count
+
+
+class Simulator(object):
+    """
+    The simulation of a scenario with a policy
+    """
+    def __init__(self, scenario, policy_name, trace_demands=None):
+        self.sim_cluster = SimCluster(
+            scenario.get("hosts", SIM_HOSTS),
+            scenario.get("osts_per_host", SIM_OSTS_PER_HOST),
+            scenario.get("capacity", SIM_CAPACITY))
+        # WatchedJobs uses the global cluster
+        lime_web.CLUSTER = self.sim_cluster
+        self.sim_duration = scenario.get("duration", SIM_DURATION)
+        self.sim_jobs = scenario_jobs(scenario, self.sim_cluster,
+                                      trace_demands)
+        self.sim_second = 0
+        # The simulated seconds start from now, so that the history of the
+        # rates is not expired immediately
+        self.sim_start_time = time.time()
+        self.sim_watched = lime_web.WatchedJobs(False)
+        self.sim_policy = None
+        for policy in self.sim_watched.wjs_rate_policies:
+            if policy.rp_name == policy_name:
+                self.sim_policy = policy
+        if self.sim_policy is None:
+            raise ValueError("unknown policy [%s]" % policy_name)
+        self.sim_watched.wjs_current_policy = self.sim_policy
+        for job in self.sim_jobs:
+            self.sim_watched.wjs_watch_job(job.sj_job_id, SIM_WEBSOCKET)
+
+    def sim_step(self):
+        """
+        Simulate one step
+        """
+        second = self.sim_second
+        for host in self.sim_cluster.sc_hosts:
+            host.smh_io(self.sim_jobs, second, SIM_STEP)
+        self.sim_second += SIM_STEP
+        now = self.sim_start_time + self.sim_second
+
+        datapoints = []
+        for job in self.sim_jobs:
+            for service_id, value in job.sj_counters.iteritems():
+                datapoints.append((service_id, job.sj_job_id, now, value,
+                                   SIM_OPTYPE))
+        watched = self.sim_watched
+        watched.wjs_metrics_received(datapoints)
+        for job in self.sim_jobs:
+            if job.sj_limit is None:
+                continue
+            limit = job.sj_limit.sc_value(self.sim_second)
+            watched_job = watched.wjs_jobs[job.sj_job_id]
+            if limit is not None:
+                limit = int(limit)
+            watched_job.wj_rate_limit = limit
+        watched.wjs_rates_update(now)
+        watched.wjs_tune(self.sim_second)
+        # The actuator writes the changes synchronously
+        for host_actuator in watched.wjs_actuator.ra_hosts.values():
+            host_actuator.ha_flush()
+
+    def sim_run(self):
+        """
+        Run the simulation, return the report
+        """
+        start_time = time.time()
+        while self.sim_second < self.sim_duration:
+            self.sim_step()
+        duration = time.time() - start_time
+        watched = self.sim_watched
+        writes = 0
+        for host_stats in watched.wjs_actuator.ra_stats().values():
+            writes += host_stats["writes"]
+        report = self.sim_policy.rp_report(watched.wjs_jobs,
+                                           now=self.sim_second)
+        report["policy"] = self.sim_policy.rp_name
+        report["tbf_writes"] = writes
+        report["tbf_operations"] = self.sim_cluster.sc_operation_count()
+        report["rates"] = dict((job_id, job.wj_rate)
+                               for job_id, job in watched.wjs_jobs.items())
+        report["seconds"] = self.sim_second
+        report["speed"] = self.sim_second / max(duration, 1e-6)
+        return report
+
+
+def scenario_jobs(scenario, cluster, trace_demands=None):
+    """
+    Return the SimJob list of a scenario. If trace_demands is not None, the
+    demands are replayed from it rather than from the scenario.
+    """
+    service_ids = sorted(cluster.lc_map_service_host.keys())
+    limits = {}
+    jobs = []
+    for config in scenario.get("jobs", []):
+        job_id = config["job_id"]
+        limit = config.get("limit")
+        if limit is not None:
+            limit = fake_lustre.StepCurve(limit)
+        limits[job_id] = limit
+        if trace_demands is not None:
+            continue
+        osts = config.get("osts")
+        if osts is None:
+            job_services = service_ids
+        else:
+            job_services = [service_ids[index % len(service_ids)]
+                            for index in osts]
+        demand = fake_lustre.StepCurve(config.get("demand", 0))
+        share = 1.0 / len(job_services)
+        steps = [[second, value * share] for second, value
+                 in zip(demand.sc_times, demand.sc_values)]
+        service_demands = {}
+        for service_id in job_services:
+            service_demands[service_id] = fake_lustre.StepCurve(steps)
+        jobs.append(fake_lustre.SimJob(job_id, service_demands, limit))
+
+    if trace_demands is not None:
+        # Map the OSTs in the trace to the simulated OSTs in order
+        trace_services = set()
+        for service_steps in trace_demands.values():
+            trace_services.update(service_steps.keys())
+        service_map = {}
+        for index, service_id in enumerate(sorted(trace_services)):
+            service_map[service_id] = service_ids[index % len(service_ids)]
+        for job_id in sorted(trace_demands.keys()):
+            service_demands = {}
+            for service_id, steps in trace_demands[job_id].iteritems():
+                service_demands[service_map[service_id]] = (
+                    fake_lustre.StepCurve(steps))
+            jobs.append(fake_lustre.SimJob(job_id, service_demands,
+                               limits.get(job_id)))
+    return jobs
+
+
+def trace_demands_load(fname, optypes=None):
+    """
+    Load a trace of Collectd payloads, return a mapping from job ID to a
+    mapping from service ID to the [second, MB/s] steps of the demand. The
+    seconds start from the first datapoint.
+    """
+    datapoints = []
+    ingester = metric_ingest.MetricIngester(datapoints.extend,
+                                            optypes=optypes,
+                                            consume_thread=False)
+    with open(fname) as trace:
+        for line in trace:
+            line = line.strip()
+            if not line:
+                continue
+            ingester.mi_post(line)
+            ingester.mi_consume(wait=False)
+    if len(datapoints) == 0:
+        return {}
+
+    start_time = min(datapoint[2] for datapoint in datapoints)
+    previous = {}
+    demands = {}
+    datapoints.sort(key=lambda datapoint: datapoint[2])
+    for service_id, job_id, timestamp, value, optype in datapoints:
+        key = (service_id, job_id, optype)
+        if key in previous:
+            last_time, last_value = previous[key]
+            if timestamp > last_time and value >= last_value:
+                rate = ((value - last_value) / (timestamp - last_time) /
+                        rate_engine.RATE_UNIT)
+                service_steps = demands.setdefault(job_id, {})
+                steps = service_steps.setdefault(service_id, [])
+                steps.append([last_time - start_time, rate])
+        previous[key] = (timestamp, value)
+    return demands
+
+
+def simulate(scenario, policy_names, trace_demands=None):
+    """
+    Simulate the scenario with each policy, return the reports
+    """
+    reports = []
+    for policy_name in policy_names:
+        simulator = Simulator(scenario, policy_name, trace_demands)
+        reports.append(simulator.sim_run())
+    return reports
+
+
+DEFAULT_SCENARIO = {
+    "hosts": SIM_HOSTS,
+    "osts_per_host": SIM_OSTS_PER_HOST,
+    "capacity": SIM_CAPACITY,
+    "duration": SIM_DURATION,
+    "jobs": [{"job_id": "dd.0", "limit": [[0, 2000], [300, 1000]],
+              "demand": 4000},
+             {"job_id": "dd.1", "limit": 1000, "demand": 2000},
+             {"job_id": "dd.2", "limit": 500, "demand": 2000,
+              "osts": [0, 2, 4, 6]},
+             {"job_id": "dd.3", "demand": [[0, 500], [200, 3000]]}]}
+
+
+def main():
+    """
+    Simulate the policies and print their reports
+    """
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--scenario", dest="scenario", default=None,
+                      help="JSON file of the scenario")
+    parser.add_option("--trace", dest="trace", default=None,
+                      help="file of Collectd payloads to replay")
+    parser.add_option("--policy", dest="policies", action="append",
+                      default=None, help="policy to simulate, can be "
+                      "repeated, all policies by default")
+    parser.add_option("--duration", dest="duration", type="int",
+                      default=None, help="seconds to simulate")
+    parser.add_option("--json", dest="json", action="store_true",
+                      default=False, help="print the reports as JSON")
+    options, args = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help()
+        return -1
+    logging.disable(logging.ERROR)
+
+    scenario = DEFAULT_SCENARIO
+    if options.scenario is not None:
+        with open(options.scenario) as scenario_file:
+            scenario = json.load(scenario_file)
+    if options.duration is not None:
+        scenario = dict(scenario)
+        scenario["duration"] = options.duration
+    trace_demands = None
+    if options.trace is not None:
+        trace_demands = trace_demands_load(options.trace)
+        if "duration" not in scenario and options.duration is None:
+            end = 0
+            for service_steps in trace_demands.values():
+                for steps in service_steps.values():
+                    end = max(end, steps[-1][0] + SIM_STEP)
+            scenario = dict(scenario)
+            scenario["duration"] = end
+    policy_names = options.policies
+    if policy_names is None:
+        policy_names = [policy.rp_name for policy
+                        in lime_web.WatchedJobs(False).wjs_rate_policies]
+
+    reports = simulate(scenario, policy_names, trace_demands)
+    if options.json:
+        print(json.dumps(reports, indent=4, sort_keys=True))
+        return 0
+    print("%-12s %10s %12s %10s %10s %12s" %
+          ("policy", "evaluation", "convergence", "overshoot", "writes",
+           "speed"))
+    for report in reports:
+        convergence = report.get("average_convergence_time")
+        if convergence is None:
+            convergence = "-"
+        else:
+            convergence = "%.1fs" % convergence
+        convergence = "%s %d/%d" % (convergence, report["converged"],
+                                    len(report["jobs"]))
+        print("%-12s %10.4f %12s %10.3f %10d %10.0fx" %
+              (report["policy"], report["evaluation"], convergence,
+               report.get("max_overshoot", 0), report["tbf_writes"],
+               report["speed"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@
 Web inteface of LIME
 """
 import collections
+import gc
 import json
 import os
 import threading
@@ -14,25 +15,140 @@ import logging.handlers
 import time
 import sys
 import random
+import numpy
 from gevent.wsgi import WSGIServer
-from gevent import monkey, sleep
+from gevent import monkey
 from geventwebsocket.handler import WebSocketHandler
-from geventwebsocket.exceptions import WebSocketError
 
 import utils
 import lustre_config
+import broadcast_hub
+import collectd_network
+import fair_share
+import fake_lustre
+import metric_ingest
+import rate_actuator
+import rate_engine
+import rate_history
+import rate_store
+import ssh_host
+import tbf_agent
 
 from flask import Flask, render_template, request
 APP = Flask(__name__)
 
 
 METRIC_INTERVAL = 1
+# Tolerance of comparing the scheduled times of ticks
+TICK_TIME_TOLERANCE = 0.001
+# The default seconds that a job without websocket is kept after its last
+# I/O, if jobs are discovered automatically
+JOB_TTL = 300
+# The default max number of tracked jobs
+MAX_JOBS = 10000
+# The max number of TBF rules started or stopped in one round trip
+LIFECYCLE_BATCH = 256
+# The max number of times to try starting the TBF rule of a discovered job
+# before giving up
+LIFECYCLE_START_ATTEMPTS = 5
+# The max number of counters of jobs that are not tracked yet
+CANDIDATE_CACHE_SIZE = 100000
+# The target of the resident bytes of each tracked (job, OST) pair, with
+# the history at full retention
+MEMORY_PAIR_TARGET = 512
 CLUSTER = None
 DEFAULT_RATE_LIMIT = 10000
 MIN_RATE_LIMIT = 10
 MIN_GRL_RATE = 1
 MAX_REAL_IOPS = 500
 MAX_FAKE_IOPS = 1500
+# A job is regarded as throttled on a host if its rate is higher than this
+# share of its TBF rate
+FAIR_SHARE_THROTTLED = 0.9
+# The demand of a throttled job is its TBF rate multiplied by this factor,
+# so that it is able to find out how much more it can get
+FAIR_SHARE_GROWTH = 1.5
+# The demand of a job that is not throttled is its rate multiplied by this
+# factor, plus MIN_RATE_LIMIT
+FAIR_SHARE_HEADROOM = 1.25
+# The decay of the observed peak rate of hosts per tick
+FAIR_SHARE_PEAK_DECAY = 0.999
+# The TBF rate is not changed if the relative change is smaller than this
+FAIR_SHARE_CHANGE = 0.05
+# A rate is regarded as converged if it stays within this share of the
+# limit for SETTLE_TIME seconds
+SETTLE_BAND = 0.1
+SETTLE_TIME = 3
+# The initial proportional, integral (per second) and derivative (seconds)
+# gains of the controllers of jobs
+PID_KP = 0.5
+PID_KI = 0.3
+PID_KD = 0.0
+# The bounds of the proportional gain when the gains are tuned
+PID_MIN_KP = 0.05
+PID_MAX_KP = 2.0
+# The gains are decreased if the overshoot is larger than this, and increased
+# if the rate converged slowly without overshoot
+PID_MAX_OVERSHOOT = 0.1
+PID_SLOW_CONVERGENCE = 10
+# The factor of changing the gains when tuning them
+PID_TUNE_FACTOR = 1.25
+# The hosts of a job without rate get this share of the average rate of the
+# hosts, so that the job is able to move its I/O to them
+PID_IDLE_SHARE = 0.1
+# The TBF rate is not changed if the relative change is smaller than this
+PID_CHANGE = 0.02
+
+class StepResponse(object):
+    """
+    The response of the rate of a job to a change of its rate limit
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ["sr_target", "sr_start_time", "sr_start_rate",
+                 "sr_overshoot", "sr_settled_time", "sr_tuned"]
+
+    def __init__(self, target, start_time, start_rate):
+        self.sr_target = target
+        self.sr_start_time = start_time
+        self.sr_start_rate = start_rate
+        # The max overshoot beyond the target, relative to the target
+        self.sr_overshoot = 0.0
+        # The time when the rate entered the band around the target, None if
+        # the rate is out of the band
+        self.sr_settled_time = None
+        # Whether the gains have been tuned according to this response
+        self.sr_tuned = False
+
+    def sr_update(self, rate, now):
+        """
+        Update the response with a measured rate
+        """
+        target = self.sr_target
+        if target <= 0:
+            return
+        if self.sr_start_rate <= target:
+            overshoot = float(rate - target) / target
+        else:
+            overshoot = float(target - rate) / target
+        if overshoot > self.sr_overshoot:
+            self.sr_overshoot = overshoot
+        if abs(rate - target) <= target * SETTLE_BAND:
+            if self.sr_settled_time is None:
+                self.sr_settled_time = now
+        else:
+            self.sr_settled_time = None
+
+    def sr_convergence_time(self, now):
+        """
+        Return the time that the rate took to converge, or None if the rate
+        hasn't stayed in the band long enough
+        """
+        if self.sr_settled_time is None:
+            return None
+        if now - self.sr_settled_time < SETTLE_TIME - TICK_TIME_TOLERANCE:
+            return None
+        return self.sr_settled_time - self.sr_start_time
+
 
 class RatePolicy(object):
     # pylint: disable=too-few-public-methods
@@ -46,10 +162,13 @@ class RatePolicy(object):
         self.rp_absum_diff = 0
         self.rp_sum_et = 0
         self.rp_eva = 0
+        # Mapping from job ID to the response to the last limit change
+        self.rp_responses = {}
 
     def rp_evaluate(self, job, fake_io):
         if job.wj_rate_limit is None:
-            logging.error("job rate limit is None.")
+            logging.debug("job rate limit is None.")
+            self.rp_responses.pop(job.wj_job_id, None)
             return
 
         if fake_io:
@@ -64,6 +183,47 @@ class RatePolicy(object):
         logging.debug("Evaluation: [%f] algo [%s]",
                       self.rp_eva, self.rp_name)
 
+        now = job.wj_jobs.wjs_tick_time
+        if now is None:
+            now = utils.monotonic_time()
+        response = self.rp_responses.get(job.wj_job_id)
+        if response is None or response.sr_target != job.wj_rate_limit:
+            response = StepResponse(job.wj_rate_limit, now, Rt)
+            self.rp_responses[job.wj_job_id] = response
+        response.sr_update(Rt, now)
+
+    def rp_report(self, jobs, now=None):
+        """
+        Return the report of the evaluation, the convergence times and the
+        overshoots of the jobs
+        """
+        if now is None:
+            now = utils.monotonic_time()
+        job_reports = {}
+        convergence_times = []
+        overshoots = []
+        for job_id in self.rp_responses.keys():
+            if job_id not in jobs:
+                del self.rp_responses[job_id]
+                continue
+            response = self.rp_responses[job_id]
+            convergence_time = response.sr_convergence_time(now)
+            if convergence_time is not None:
+                convergence_times.append(convergence_time)
+            overshoots.append(response.sr_overshoot)
+            job_reports[job_id] = {"target": response.sr_target,
+                                   "convergence_time": convergence_time,
+                                   "overshoot": response.sr_overshoot}
+        report = {"evaluation": self.rp_eva,
+                  "jobs": job_reports,
+                  "converged": len(convergence_times)}
+        if len(convergence_times) > 0:
+            report["average_convergence_time"] = (sum(convergence_times) /
+                                                  len(convergence_times))
+        if len(overshoots) > 0:
+            report["max_overshoot"] = max(overshoots)
+        return report
+
 class GlobalRatePolicy(RatePolicy):
     """
     The policy tries to maintain the aggregate bandwidth of
@@ -93,9 +253,7 @@ class GlobalRatePolicy(RatePolicy):
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
                 if host.hfj_rate_limit < DEFAULT_RATE_LIMIT:
-                    host.hfj_rate_limit = DEFAULT_RATE_LIMIT
-                    host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                     DEFAULT_RATE_LIMIT)
+                    host.hfj_change_tbf_rate(DEFAULT_RATE_LIMIT)
             return
         if job.wj_current_rate_limit != job.wj_rate_limit:
             # IMPROVE: not perfect algorithm, set on active hosts,
@@ -126,11 +284,9 @@ class GlobalRatePolicy(RatePolicy):
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
                 if host.hfj_rate > 0:
-                    host.hfj_rate_limit = rateLimit
+                    host.hfj_change_tbf_rate(rateLimit)
                 else:
-                    host.hfj_rate_limit = inRateLimit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 host.hfj_rate_limit)
+                    host.hfj_change_tbf_rate(inRateLimit)
             job.wj_current_rate_limit = job.wj_rate_limit
             return
 
@@ -159,9 +315,7 @@ class IndependentRatePolicy(RatePolicy):
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
                 if host.hfj_rate_limit < DEFAULT_RATE_LIMIT:
-                    host.hfj_rate_limit = DEFAULT_RATE_LIMIT
-                    host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                     DEFAULT_RATE_LIMIT)
+                    host.hfj_change_tbf_rate(DEFAULT_RATE_LIMIT)
             return
         if job.wj_current_rate_limit != job.wj_rate_limit:
             # IMPROVE: not perfect algorithm, need to set on active hosts,
@@ -173,9 +327,7 @@ class IndependentRatePolicy(RatePolicy):
                 rate_limit = DEFAULT_RATE_LIMIT
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                host.hfj_rate_limit = rate_limit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 rate_limit)
+                host.hfj_change_tbf_rate(rate_limit)
             job.wj_current_rate_limit = job.wj_rate_limit
             return
 
@@ -199,6 +351,10 @@ class IndependentRatePolicy(RatePolicy):
 class ActionHistory(object):
     """
     Action history
+
+    An action changes the TBF rate of one job on one host, so the action is
+    judged by the rates of the jobs on that host. Actions on different hosts
+    can then be judged at the same time.
     """
     # pylint: disable=too-many-instance-attributes
     RESULT_RISE = "rise"
@@ -210,13 +366,22 @@ class ActionHistory(object):
     STAGE_ORIGIN = "origin"
     STAGE_ACTED = "acted"
     STAGE_REGRETTED = "regretted"
+    __slots__ = ["ah_qos_task", "ah_job_id", "ah_rates_original", "ah_stage",
+                 "ah_action_good", "ah_action_job_id", "ah_action_hostname",
+                 "ah_action_limit_before", "ah_action_limit_after",
+                 "ah_rates_after_action", "ah_action_type",
+                 "ah_action_expected_result", "ah_rates_after_regret",
+                 "ah_regret_type", "ah_regret_expected_result",
+                 "ah_failure_time"]
 
     def __init__(self, qos_task, job_id, action_type, action_job_id,
                  action_hostname, limit_before, limit_after, expected_result):
         # pylint: disable=too-many-arguments
         self.ah_qos_task = qos_task
         self.ah_job_id = job_id
-        self.ah_rates_original = qos_task.wjs_save_rates(job_id, action_job_id)
+        self.ah_rates_original = qos_task.wjs_save_rates(job_id,
+                                                         action_job_id,
+                                                         action_hostname)
         self.ah_stage = ActionHistory.STAGE_ORIGIN
 
         self.ah_action_good = None
@@ -324,6 +489,8 @@ class ActionHistory(object):
         if ret:
             return ret
         self.ah_stage = ActionHistory.STAGE_REGRETTED
+        self.ah_qos_task.wjs_action_record(rate_store.KIND_ACTION, self,
+                                           "regret")
         return 0
 
     def ah_act(self):
@@ -352,35 +519,43 @@ class ActionHistory(object):
         else:
             assert 0
         self.ah_stage = ActionHistory.STAGE_ACTED
+        self.ah_qos_task.wjs_action_record(rate_store.KIND_ACTION, self,
+                                           self.ah_action_type)
         return 0
 
     def ah_process(self, qos_task):
         """
-        Return True if action processed, return false if the action ended
+        Return True if the action needs to be processed again in the next
+        cycle, return False if the action ended
         """
         job_id = self.ah_job_id
         action_id = self.ah_action_job_id
         logging.error("processing action with stage [%s]", self.ah_stage)
         if self.ah_stage == ActionHistory.STAGE_ACTED:
-            self.ah_rates_after_action = qos_task.wjs_save_rates(job_id,
-                                                                 action_id)
+            self.ah_rates_after_action = qos_task.wjs_save_rates(
+                job_id, action_id, self.ah_action_hostname)
             self_benefit = self.ah_expected_action_result()
+            regretted = False
             if (self.ah_prior_declined_after_action() or
                     ((not self_benefit) and
                      self.ah_acted_declined_after_action())):
                 self.ah_failure_time += 1
-                self.ah_regret()
+                regretted = self.ah_regret() == 0
                 self.ah_action_good = False
             elif not self_benefit:
                 self.ah_failure_time += 1
                 self.ah_action_good = False
             else:
                 self.ah_action_good = True
+            qos_task.wjs_action_record(rate_store.KIND_RESULT, self,
+                                       self.ah_action_type)
+            # Check whether the regret recovers the rates in the next cycle
+            return regretted
         else:
             assert (self.ah_stage ==
                     ActionHistory.STAGE_REGRETTED)
-            self.ah_rates_after_regret = qos_task.wjs_save_rates(job_id,
-                                                                 action_id)
+            self.ah_rates_after_regret = qos_task.wjs_save_rates(
+                job_id, action_id, self.ah_action_hostname)
             if self.ah_declined_after_regret():
                 logging.error("action caused declining and regetting "
                               "didn't recover it")
@@ -394,9 +569,13 @@ class PriorityRatePolicy(RatePolicy):
     """
     The policy that tries to satisfy the requests of jobs with highest priority
     first
+
+    Each action changes the rate of one job on one host. Actions on different
+    hosts are independent, so at most one action is in progress on each host
+    and the actions on all hosts are started and judged in the same cycle.
     """
-    # pylint: disable=too-few-public-methods
-    def __init__(self):
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, max_actions=None):
         comment = ("The policy that tries to satisfy the limits of jobs "
                    "with highest priority first. If the job with highest "
                    "priority doesn't "
@@ -404,14 +583,25 @@ class PriorityRatePolicy(RatePolicy):
                    "1) Increase rate limitation of itself\n"
                    "2) Decrease rate limitation of others\n"
                    "Option 1) will be tried first, and if it fails, option 2)"
-                   "will be tried.")
+                   "will be tried. Actions on different hosts are tried at "
+                   "the same time.")
         super(PriorityRatePolicy, self).__init__("priority", comment,
                                                  self.prp_tune)
-        self.prp_last_action = None
+        # Mapping from hostname to the action in progress on the host
+        self.prp_actions = collections.OrderedDict()
+        # Mapping from job ID to the last ended action for the job
+        self.prp_job_actions = {}
         self.prp_max_failures = 3
-        # Interval of changing rate
+        # The max number of actions in progress, None if only limited by the
+        # number of hosts
+        self.prp_max_actions = max_actions
+        # Seconds between changing rates
         self.prp_interval = 2
-        self.prp_count = 0
+        # The scheduled time of the tick that changed rates last time
+        self.prp_last_time = None
+        self.prp_started_count = 0
+        self.prp_good_count = 0
+        self.prp_bad_count = 0
 
     def prp_rate_limit_update(self, qos_task):
         """
@@ -433,14 +623,23 @@ class PriorityRatePolicy(RatePolicy):
                 rate_limit = DEFAULT_RATE_LIMIT
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                host.hfj_rate_limit = rate_limit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 rate_limit)
+                host.hfj_change_tbf_rate(rate_limit)
                 changed = True
                 logging.error("updated rate limit of job [%s] on host [%s] "
                               "from GUI", job_id, hostname)
         return changed
 
+    def prp_action_start(self, action):
+        """
+        Do the action and keep it in progress on its host
+        """
+        ret = action.ah_act()
+        if ret:
+            return ret
+        self.prp_actions[action.ah_action_hostname] = action
+        self.prp_started_count += 1
+        return 0
+
     def prp_increase_self(self, qos_task, job, job_id, failure_time):
         """
         Try to increase the rate of itself
@@ -448,6 +647,8 @@ class PriorityRatePolicy(RatePolicy):
         hosts = job.wj_hosts_random()
         selected = None
         for host in hosts:
+            if host.hfj_host.sh_hostname in self.prp_actions:
+                continue
             logging.error("checking host [%s] with total throughput [%d]",
                           host.hfj_host.sh_hostname, host.hfj_rate)
             diff = MIN_RATE_LIMIT * 2
@@ -473,11 +674,7 @@ class PriorityRatePolicy(RatePolicy):
                       "increasing its limitation",
                       job_id)
         new_act.ah_failure_time = failure_time
-        ret = new_act.ah_act()
-        if ret:
-            return ret
-        self.prp_last_action = new_act
-        return 0
+        return self.prp_action_start(new_act)
 
     def prp_decrease_others(self, qos_task, job, job_id, failure_time):
         """
@@ -487,14 +684,11 @@ class PriorityRatePolicy(RatePolicy):
                       "decreasing rates of other jobs", job_id)
         host = None
         for hostname in job.wj_hosts:
+            if hostname in self.prp_actions:
+                continue
             logging.error("checking any job to decrease rate on host [%s] ",
                           hostname)
             higher_priority = True
-            if hostname not in job.wj_hosts:
-                logging.error("not going to decrease jobs on host [%s] "
-                              "because job [%s] has no rate on host [%s]",
-                              hostname, job_id, hostname)
-                continue
             for tmp_job_id in qos_task.wjs_jobs:
                 tmp_job = qos_task.wjs_jobs[tmp_job_id]
                 if tmp_job_id == job_id:
@@ -514,6 +708,8 @@ class PriorityRatePolicy(RatePolicy):
                                   hostname)
                     continue
                 tmp_host = tmp_job.wj_hosts[hostname]
+                if tmp_host.hfj_rate_limit == MIN_RATE_LIMIT:
+                    continue
                 if host is None or host.hfj_rate < tmp_host.hfj_rate:
                     host = tmp_host
         if host is None:
@@ -532,10 +728,6 @@ class PriorityRatePolicy(RatePolicy):
         #if limit_after < MIN_RATE_LIMIT:
         #    limit_after = MIN_RATE_LIMIT
         limit_after = MIN_RATE_LIMIT
-        if host.hfj_rate_limit == limit_after:
-            logging.error("no job to decrease rate in order to "
-                          "increase rate of job [%s]", job_id)
-            return -1
         new_act = ActionHistory(qos_task, job_id,
                                 ActionHistory.ACTION_DECREASE_OTHERS,
                                 host.hfj_job.wj_job_id,
@@ -543,10 +735,40 @@ class PriorityRatePolicy(RatePolicy):
                                 host.hfj_rate_limit, limit_after,
                                 ActionHistory.RESULT_RISE)
         new_act.ah_failure_time = failure_time
-        ret = new_act.ah_act()
+        return self.prp_action_start(new_act)
+
+    def prp_decrease_self(self, qos_task, job, job_id, failure_time):
+        """
+        Decrease the rate of itself on the host with highest throughput
+        """
+        host = None
+        for hostname, tmp_host in job.wj_hosts.iteritems():
+            if hostname in self.prp_actions:
+                continue
+            if host is None or host.hfj_rate < tmp_host.hfj_rate:
+                host = tmp_host
+        if host is None or host.hfj_rate < MIN_RATE_LIMIT:
+            logging.error("not able to start a decrease action for job "
+                          "[%s] because all host has very small rate",
+                          job_id)
+            return -1
+
+        diff = job.wj_rate - job.wj_rate_limit
+        limit_after = host.hfj_rate - diff
+        if limit_after < MIN_RATE_LIMIT:
+            limit_after = MIN_RATE_LIMIT
+        new_act = ActionHistory(qos_task, job_id,
+                                ActionHistory.ACTION_DECREASE_MYSELF,
+                                job_id, host.hfj_host.sh_hostname,
+                                host.hfj_rate_limit, limit_after,
+                                ActionHistory.RESULT_DECLINE)
+
+        new_act.ah_failure_time = failure_time
+        ret = self.prp_action_start(new_act)
         if ret:
             return ret
-        self.prp_last_action = new_act
+        logging.error("trying to decrease rate of job [%s]",
+                      job_id)
         return 0
 
     def prp_start_action(self, qos_task, job_id, failure_time):
@@ -562,33 +784,17 @@ class PriorityRatePolicy(RatePolicy):
         rate = job.wj_rate
         if (job.wj_rate_limit is not None and
                 rate > job.wj_rate_limit * 11 / 10):
-            host = job.wj_highest_throughput_host()
-            if host is None or host.hfj_rate < MIN_RATE_LIMIT:
-                logging.error("not able to start a decrease action for job "
-                              "[%s] because all host has very small rate",
-                              job_id)
-                return -1
-
-            diff = rate - job.wj_rate_limit
-            limit_after = host.hfj_rate - diff
-            if limit_after < MIN_RATE_LIMIT:
-                limit_after = MIN_RATE_LIMIT
-            new_act = ActionHistory(qos_task, job_id,
-                                    ActionHistory.ACTION_DECREASE_MYSELF,
-                                    job_id, host.hfj_host.sh_hostname,
-                                    host.hfj_rate_limit, limit_after,
-                                    ActionHistory.RESULT_DECLINE)
-
-            new_act.ah_failure_time = failure_time
-            ret = new_act.ah_act()
-            if ret:
-                return ret
-            self.prp_last_action = new_act
-            logging.error("trying to decrease rate of job [%s]",
-                          job_id)
-            return 0
-
-        action = self.prp_last_action
+            # The decrease is computed from the total rate of the job, so
+            # only one decrease is in progress for a job
+            for action in self.prp_actions.itervalues():
+                if (action.ah_job_id == job_id and
+                        action.ah_action_type ==
+                        ActionHistory.ACTION_DECREASE_MYSELF):
+                    return -1
+            return self.prp_decrease_self(qos_task, job, job_id,
+                                          failure_time)
+
+        action = self.prp_job_actions.get(job_id)
         if job.wj_rate_limit is None or rate < job.wj_rate_limit * 9 / 10:
             if job.wj_rate_limit is None or action is None:
                 increase = True
@@ -630,68 +836,458 @@ class PriorityRatePolicy(RatePolicy):
             return ret
         return -1
 
+    def prp_actions_process(self, qos_task):
+        """
+        Judge the actions in progress, and remember the ended actions
+        """
+        for hostname, action in self.prp_actions.items():
+            # Drop the action if its jobs are not tracked any more
+            if (action.ah_job_id not in qos_task.wjs_jobs or
+                    action.ah_action_job_id not in qos_task.wjs_jobs):
+                logging.error("dropping action of job [%s] since the job is "
+                              "not tracked any more", action.ah_job_id)
+                del self.prp_actions[hostname]
+                continue
+            ret = action.ah_process(qos_task)
+            if ret:
+                continue
+            del self.prp_actions[hostname]
+            if action.ah_action_good:
+                self.prp_good_count += 1
+            else:
+                self.prp_bad_count += 1
+            self.prp_job_actions[action.ah_job_id] = action
+
+        for job_id in self.prp_job_actions.keys():
+            if job_id not in qos_task.wjs_jobs:
+                del self.prp_job_actions[job_id]
+
     def prp_tune(self, qos_task):
-        # pylint: disable=too-many-branches
         """
         Tune the jobs
         """
         # If anything changed in the rate configuration, set the limitation
         # and loop back from top priority.
-        self.prp_count += 1
-        if self.prp_count < self.prp_interval:
+        tick_time = qos_task.wjs_tick_time
+        if (self.prp_last_time is not None and
+                tick_time - self.prp_last_time <
+                self.prp_interval - TICK_TIME_TOLERANCE):
             return
-        self.prp_count = 0
+        self.prp_last_time = tick_time
+
+        # Evaluate the algorithm.
+        for job_id in qos_task.wjs_jobs:
+            job = qos_task.wjs_jobs[job_id]
+            self.rp_evaluate(job, qos_task.wjs_current_fake_io)
+
         ret = self.prp_rate_limit_update(qos_task)
         if ret:
-            self.prp_last_action = None
+            self.prp_actions.clear()
+            self.prp_job_actions.clear()
             return
 
-        # Continue the action if there is one
-        job_id = None
-        if self.prp_last_action is not None:
-            action = self.prp_last_action
-            job_id = action.ah_job_id
-            ret = self.prp_last_action.ah_process(qos_task)
-            if ret:
-                return
-            else:
-                if action.ah_failure_time > self.prp_max_failures:
-                    self.prp_last_action = None
-                    logging.error("too many action failures for job [%s], "
-                                  "won't try any more", job_id)
-                else:
-                    ret = self.prp_start_action(qos_task, job_id,
-                                                action.ah_failure_time)
-                    if ret == 0:
-                        return
-                    else:
-                        self.prp_last_action = None
-
-        # Start an action if no on-going action
-        assert self.prp_last_action is None
-        found = False
-        if job_id is None:
-            found = True
-        for tmp_id in qos_task.wjs_jobs:
-            if found:
-                ret = self.prp_start_action(qos_task, tmp_id, 0)
-                if ret == 0:
-                    return
-            elif tmp_id == job_id:
-                found = True
+        self.prp_actions_process(qos_task)
 
-        # Evaluate the algorithm.
+        # Start actions on the hosts without action in progress, the jobs
+        # with higher priority pick their hosts first
         for job_id in qos_task.wjs_jobs:
-            job = qos_task.wjs_jobs[job_id]
+            last_action = self.prp_job_actions.get(job_id)
+            failure_time = 0
+            if last_action is not None:
+                failure_time = last_action.ah_failure_time
+            if failure_time > self.prp_max_failures:
+                logging.error("too many action failures for job [%s], "
+                              "won't try in this cycle", job_id)
+                del self.prp_job_actions[job_id]
+                continue
+            while (self.prp_max_actions is None or
+                   len(self.prp_actions) < self.prp_max_actions):
+                ret = self.prp_start_action(qos_task, job_id, failure_time)
+                if ret:
+                    break
+            if (self.prp_max_actions is not None and
+                    len(self.prp_actions) >= self.prp_max_actions):
+                break
+
+    def prp_stats(self):
+        """
+        Return the statistics of the actions
+        """
+        return {"in_progress": len(self.prp_actions),
+                "started": self.prp_started_count,
+                "good": self.prp_good_count,
+                "bad": self.prp_bad_count}
+
+
+class FairShareRatePolicy(RatePolicy):
+    """
+    The policy that allocates the rates of all jobs on all hosts at once
+    with weighted max-min fairness
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        comment = ("The policy that allocates the rates of all jobs on all "
+                   "hosts at once. The capacity of each host is shared by "
+                   "the jobs on it in proportion to their priorities, and "
+                   "the limit of each job is shared by its hosts. A job "
+                   "never gets more than it demands, and what one job "
+                   "doesn't use is shared by the other jobs.")
+        super(FairShareRatePolicy, self).__init__("fair share", comment,
+                                                  self.fsp_tune)
+        # The decayed peak of the total rate of each host
+        self.fsp_host_peaks = {}
+        # The total rate of each host when the host was the bottleneck
+        self.fsp_host_ceilings = {}
+        # The job levels of the last solve, used as the start of next solve
+        self.fsp_job_levels = {}
+        self.fsp_solve_count = 0
+        self.fsp_solve_time = 0
+        self.fsp_iterations = 0
+        self.fsp_change_count = 0
+
+    def fsp_host_capacity(self, hostname, total_rate, total_limit,
+                          throttled, fake_io, host_number):
+        """
+        Return the estimated capacity of a host, which is the decayed peak of
+        the total rate, or the share of the host in the benchmark result if
+        higher. The benchmark is a single job striped over all OSTs, so it
+        measures the rate of all the host_number OSS.
+
+        If some jobs on the host are throttled by TBF rather than by the
+        host, the host might be able to do more, so some headroom is added.
+        If the total rate is lower than the total TBF rate, the host is the
+        bottleneck and the total rate becomes a ceiling of the headroom. The
+        ceiling rises slowly so that the host is probed again later.
+        """
+        # pylint: disable=too-many-arguments
+        peak = max(total_rate,
+                   self.fsp_host_peaks.get(hostname, 0) *
+                   FAIR_SHARE_PEAK_DECAY)
+        self.fsp_host_peaks[hostname] = peak
+        if total_rate < total_limit * FAIR_SHARE_THROTTLED:
+            ceiling = total_rate
+        else:
+            ceiling = (self.fsp_host_ceilings.get(hostname, numpy.inf) /
+                       FAIR_SHARE_PEAK_DECAY)
+        self.fsp_host_ceilings[hostname] = ceiling
+        capacity = peak
+        if throttled:
+            capacity = max(peak, min(peak * FAIR_SHARE_HEADROOM, ceiling))
+        if fake_io:
+            benchmark = CLUSTER.lc_max_fake_iops
+        else:
+            benchmark = CLUSTER.lc_max_real_iops
+        if host_number > 0:
+            capacity = max(capacity, float(benchmark) / host_number)
+        if capacity <= 0:
+            return numpy.inf
+        return capacity
+
+    def fsp_tune(self, qos_task):
+        # pylint: disable=too-many-locals,too-many-branches
+        """
+        Tune the jobs
+        """
+        jobs = []
+        for job_id, job in qos_task.wjs_jobs.iteritems():
+            self.rp_evaluate(job, qos_task.wjs_current_fake_io)
+            if len(job.wj_hosts) > 0:
+                jobs.append(job)
+        if len(jobs) == 0:
+            return
+
+        host_indexes = {}
+        for job in jobs:
+            for hostname in job.wj_hosts:
+                if hostname not in host_indexes:
+                    host_indexes[hostname] = len(host_indexes)
+
+        # The jobs with higher priorities have higher weights
+        job_number = len(jobs)
+        weights = numpy.arange(job_number, 0, -1, dtype=numpy.float64)
+        demands = numpy.zeros((job_number, len(host_indexes)))
+        totals = numpy.zeros(len(host_indexes))
+        total_limits = numpy.zeros(len(host_indexes))
+        throttled = numpy.zeros(len(host_indexes), dtype=bool)
+        job_targets = numpy.full(job_number, numpy.inf)
+        job_levels = numpy.full(job_number, numpy.inf)
+        for job_index, job in enumerate(jobs):
+            if job.wj_rate_limit is not None:
+                job_targets[job_index] = job.wj_rate_limit
+            job_levels[job_index] = self.fsp_job_levels.get(job.wj_job_id,
+                                                            numpy.inf)
+            for hostname, host in job.wj_hosts.iteritems():
+                host_index = host_indexes[hostname]
+                rate = host.hfj_rate
+                totals[host_index] += rate
+                total_limits[host_index] += host.hfj_rate_limit
+                if rate >= host.hfj_rate_limit * FAIR_SHARE_THROTTLED:
+                    throttled[host_index] = True
+                    demand = (max(rate, host.hfj_rate_limit) *
+                              FAIR_SHARE_GROWTH)
+                else:
+                    demand = rate * FAIR_SHARE_HEADROOM + MIN_RATE_LIMIT
+                demands[job_index, host_index] = demand
+
+        host_capacities = numpy.zeros(len(host_indexes))
+        oss_number = len(CLUSTER.lc_oss_hosts())
+        for hostname, host_index in host_indexes.iteritems():
+            host_capacities[host_index] = self.fsp_host_capacity(
+                hostname, totals[host_index], total_limits[host_index],
+                throttled[host_index], qos_task.wjs_current_fake_io,
+                oss_number)
+
+        start_time = time.time()
+        allocations, job_levels, host_levels, iterations = \
+            fair_share.fair_share_solve(demands, weights, job_targets,
+                                        host_capacities,
+                                        job_levels=job_levels)
+        self.fsp_solve_time += time.time() - start_time
+        self.fsp_solve_count += 1
+        self.fsp_iterations += iterations
+
+        self.fsp_job_levels = {}
+        for job_index, job in enumerate(jobs):
+            job_level = job_levels[job_index]
+            self.fsp_job_levels[job.wj_job_id] = job_level
+            for hostname, host in job.wj_hosts.iteritems():
+                host_index = host_indexes[hostname]
+                # Not throttled if neither the job nor the host is full
+                if numpy.isinf(min(job_level, host_levels[host_index])):
+                    rate_limit = DEFAULT_RATE_LIMIT
+                else:
+                    rate_limit = int(allocations[job_index, host_index])
+                    rate_limit = min(max(rate_limit, MIN_RATE_LIMIT),
+                                     DEFAULT_RATE_LIMIT)
+                old = host.hfj_rate_limit
+                if rate_limit == old:
+                    continue
+                # Small changes are not worth a TBF command
+                if (rate_limit != DEFAULT_RATE_LIMIT and
+                        abs(rate_limit - old) <= old * FAIR_SHARE_CHANGE):
+                    continue
+                logging.debug("fair share: changing rate of host [%s] for "
+                              "job [%s] from [%d] to [%d]", hostname,
+                              job.wj_job_id, old, rate_limit)
+                host.hfj_change_tbf_rate(rate_limit)
+                self.fsp_change_count += 1
+
+    def fsp_stats(self):
+        """
+        Return the statistics of the solves
+        """
+        stats = {"solves": self.fsp_solve_count,
+                 "changes": self.fsp_change_count}
+        if self.fsp_solve_count > 0:
+            stats["average_solve_time"] = (self.fsp_solve_time /
+                                           self.fsp_solve_count)
+            stats["average_iterations"] = (float(self.fsp_iterations) /
+                                           self.fsp_solve_count)
+        return stats
+
+
+class JobController(object):
+    """
+    The PID controller of the rate of a job. The output is the total TBF
+    rate of the job on all hosts.
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    __slots__ = ["jc_kp", "jc_ki", "jc_kd", "jc_integral", "jc_error",
+                 "jc_time", "jc_output", "jc_saturated_count"]
+
+    def __init__(self):
+        self.jc_kp = PID_KP
+        self.jc_ki = PID_KI
+        self.jc_kd = PID_KD
+        self.jc_integral = 0.0
+        # The error and time of the last update, None if never updated
+        self.jc_error = None
+        self.jc_time = None
+        self.jc_output = None
+        # Number of updates that the output was saturated
+        self.jc_saturated_count = 0
+
+    def jc_update(self, target, rate, now, min_output, max_output):
+        # pylint: disable=too-many-arguments
+        """
+        Return the output according to the measured rate. The target is fed
+        forward, so the integral only needs to cover the difference between
+        the TBF rate and the measured rate. The integral is not accumulated
+        when the output is saturated in the direction of the error, so it
+        doesn't wind up when the job can't reach the target.
+        """
+        error = target - rate
+        if self.jc_time is None or now <= self.jc_time:
+            interval = METRIC_INTERVAL
+        else:
+            interval = now - self.jc_time
+        derivative = 0.0
+        if self.jc_error is not None:
+            derivative = (error - self.jc_error) / interval
+        self.jc_error = error
+        self.jc_time = now
+
+        proportional = self.jc_kp * error + self.jc_kd * derivative
+        integral = self.jc_integral + self.jc_ki * error * interval
+        output = target + proportional + integral
+        if ((output > max_output and error > 0) or
+                (output < min_output and error < 0)):
+            # Anti-windup, keep the integral unchanged
+            output = target + proportional + self.jc_integral
+            self.jc_saturated_count += 1
+        else:
+            self.jc_integral = integral
+        output = min(max(output, min_output), max_output)
+        self.jc_output = output
+        return output
+
+    def jc_gains_tune(self, response):
+        """
+        Tune the gains according to the response to the last limit change
+        """
+        if response.sr_overshoot > PID_MAX_OVERSHOOT:
+            factor = 1 / PID_TUNE_FACTOR
+        elif response.sr_overshoot < PID_MAX_OVERSHOOT / 5:
+            factor = PID_TUNE_FACTOR
+        else:
+            return
+        kp = min(max(self.jc_kp * factor, PID_MIN_KP), PID_MAX_KP)
+        factor = kp / self.jc_kp
+        self.jc_kp = kp
+        self.jc_ki *= factor
+        self.jc_kd *= factor
+
+
+class PidRatePolicy(RatePolicy):
+    """
+    The policy that controls the rate of each job with a PID controller
+    """
+    def __init__(self, autotune=True):
+        comment = ("The policy that controls the rate of each job with a "
+                   "PID controller regardless of other jobs. The total TBF "
+                   "rate of the job is distributed to the hosts according "
+                   "to the rate of the job on them. If autotune is enabled, "
+                   "the gains are decreased after a large overshoot and "
+                   "increased after a slow convergence.")
+        super(PidRatePolicy, self).__init__("PID", comment, self.pid_tune)
+        self.pid_autotune = autotune
+        # Mapping from job ID to the controller
+        self.pid_controllers = {}
+
+    def pid_job_tune(self, job, now):
+        """
+        Tune the TBF rates of a job on its hosts
+        """
+        job_id = job.wj_job_id
+        if job.wj_rate_limit is None:
+            self.pid_controllers.pop(job_id, None)
+            for host in job.wj_hosts.itervalues():
+                if host.hfj_rate_limit < DEFAULT_RATE_LIMIT:
+                    host.hfj_change_tbf_rate(DEFAULT_RATE_LIMIT)
+            return
+        host_number = len(job.wj_hosts)
+        if host_number == 0 or job.wj_rate is None:
+            return
+
+        controller = self.pid_controllers.get(job_id)
+        if controller is None:
+            controller = JobController()
+            self.pid_controllers[job_id] = controller
+
+        if self.pid_autotune:
+            response = self.rp_responses.get(job_id)
+            if (response is not None and not response.sr_tuned and
+                    response.sr_convergence_time(now) is not None):
+                response.sr_tuned = True
+                convergence_time = response.sr_convergence_time(now)
+                if (response.sr_overshoot > PID_MAX_OVERSHOOT or
+                        convergence_time > PID_SLOW_CONVERGENCE):
+                    controller.jc_gains_tune(response)
+                    logging.debug("PID: gains of job [%s] are tuned to "
+                                  "[%f] [%f] [%f]", job_id, controller.jc_kp,
+                                  controller.jc_ki, controller.jc_kd)
+
+        output = controller.jc_update(job.wj_rate_limit, job.wj_rate, now,
+                                      MIN_RATE_LIMIT * host_number,
+                                      DEFAULT_RATE_LIMIT * host_number)
+
+        # Distribute the output in proportion to the rates on the hosts
+        hosts = job.wj_hosts.values()
+        total_rate = 0
+        for host in hosts:
+            total_rate += host.hfj_rate
+        idle_share = PID_IDLE_SHARE * total_rate / host_number
+        total_weight = total_rate + idle_share * host_number
+        for host in hosts:
+            if total_weight > 0:
+                rate_limit = (output * (host.hfj_rate + idle_share) /
+                              total_weight)
+            else:
+                rate_limit = output / host_number
+            rate_limit = int(min(max(rate_limit, MIN_RATE_LIMIT),
+                                 DEFAULT_RATE_LIMIT))
+            old = host.hfj_rate_limit
+            if abs(rate_limit - old) <= old * PID_CHANGE:
+                continue
+            logging.debug("PID: changing rate of host [%s] for job [%s] "
+                          "from [%d] to [%d]", host.hfj_host.sh_hostname,
+                          job_id, old, rate_limit)
+            host.hfj_change_tbf_rate(rate_limit)
+
+    def pid_tune(self, qos_task):
+        """
+        Tune the jobs
+        """
+        now = qos_task.wjs_tick_time
+        if now is None:
+            now = utils.monotonic_time()
+        for job_id in self.pid_controllers.keys():
+            if job_id not in qos_task.wjs_jobs:
+                del self.pid_controllers[job_id]
+        for job in qos_task.wjs_jobs.itervalues():
             self.rp_evaluate(job, qos_task.wjs_current_fake_io)
+            self.pid_job_tune(job, now)
 
+    def pid_stats(self):
+        """
+        Return the gains and states of the controllers
+        """
+        controllers = {}
+        for job_id, controller in self.pid_controllers.iteritems():
+            controllers[job_id] = {"kp": controller.jc_kp,
+                                   "ki": controller.jc_ki,
+                                   "kd": controller.jc_kd,
+                                   "integral": controller.jc_integral,
+                                   "output": controller.jc_output,
+                                   "saturated": controller.jc_saturated_count}
+        return controllers
 
 
 class WatchedJobs(object):
     """
     All the watched Jobs will be group here
+
+    The rates, the datapoints sent to websockets, the tuning of the policy and
+    the writes of TBF rates are done by separate periodic tasks. The rate task
+    takes a snapshot of the rates, which the other tasks use without holding
+    the lock of the jobs while the rates are being computed.
+
+    If jobs are discovered automatically, a job is tracked once its job stats
+    change, even if no websocket watches it. The TBF rules of discovered jobs
+    are started in batches by the lifecycle task, and the jobs without
+    websocket are dropped when they have had no I/O for the TTL.
     """
-    def __init__(self, fake_io):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, fake_io, rate_interval=METRIC_INTERVAL,
+                 publish_interval=METRIC_INTERVAL,
+                 tune_interval=METRIC_INTERVAL,
+                 actuate_interval=METRIC_INTERVAL,
+                 history_retention=rate_history.RATE_HISTORY_RETENTION,
+                 history_tiers=None, store=None, auto_discover=False,
+                 job_ttl=JOB_TTL, max_jobs=MAX_JOBS,
+                 lifecycle_interval=METRIC_INTERVAL, actuate_threads=False,
+                 history_levels=None):
+        # pylint: disable=too-many-arguments,too-many-locals
         self.wjs_jobs = collections.OrderedDict()
         self.wjs_condition = threading.Condition()
 
@@ -702,9 +1298,125 @@ class WatchedJobs(object):
         self.wjs_rate_policies.append(self.wjs_independent_rate_policy)
         self.wjs_priority_policy = PriorityRatePolicy()
         self.wjs_rate_policies.append(self.wjs_priority_policy)
+        self.wjs_fair_share_policy = FairShareRatePolicy()
+        self.wjs_rate_policies.append(self.wjs_fair_share_policy)
+        self.wjs_pid_policy = PidRatePolicy()
+        self.wjs_rate_policies.append(self.wjs_pid_policy)
         self.wjs_current_policy = self.wjs_priority_policy
         self.wjs_current_fake_io = fake_io
-        utils.thread_start(self.wjs_datapoints_send, ())
+        # Rate changes of policies are written to hosts by the actuator. If
+        # actuate_threads is True, each host is written by its own thread,
+        # otherwise all hosts are written by the actuate task.
+        self.wjs_actuator = rate_actuator.RateActuator(
+            asynchronous=actuate_threads)
+        # Datapoints are broadcasted to websockets by the hub
+        self.wjs_hub = broadcast_hub.BroadcastHub()
+        self.wjs_encoder = broadcast_hub.RateStreamEncoder()
+        # The rates computed by the rate task are recorded in the history
+        self.wjs_history = rate_history.RateHistory(
+            retention=history_retention, interval=rate_interval,
+            tiers=history_tiers, levels=history_levels)
+        # The rates and actions are persisted by the store if not None
+        self.wjs_store = store
+        # The rates of all jobs on all services
+        self.wjs_engine = rate_engine.RateEngine(self._wjs_service_hostname)
+        self.wjs_auto_discover = auto_discover
+        self.wjs_job_ttl = job_ttl
+        self.wjs_max_jobs = max_jobs
+        # The discovered jobs whose TBF rules are not started yet
+        self.wjs_pending_jobs = collections.OrderedDict()
+        # Mapping from (job_id, service_id, optype) to the last counter of
+        # the jobs that are not tracked
+        self.wjs_candidates = {}
+        # Number of jobs discovered and expired, and number of times that
+        # discovered jobs are not tracked because of the max number of jobs
+        self.wjs_discovered_count = 0
+        self.wjs_expired_count = 0
+        self.wjs_overflow_count = 0
+        # Number of times that the TBF rules of discovered jobs failed to
+        # start, number of discovered jobs given up because of that, and
+        # number of TBF rules of expired jobs that failed to stop
+        self.wjs_start_failed_count = 0
+        self.wjs_abandoned_count = 0
+        self.wjs_stop_failed_count = 0
+        # The latest snapshot of rates, which is replaced as a whole by the
+        # rate task
+        self.wjs_snapshot = {"time": time.time(),
+                             "jobs": collections.OrderedDict()}
+        self.wjs_published_snapshot = None
+        # The monotonic time that the current tune tick is scheduled at
+        self.wjs_tick_time = None
+        self.wjs_tasks = collections.OrderedDict()
+        tasks = [("rate", self.wjs_rates_update, rate_interval),
+                 ("publish", self.wjs_datapoints_send, publish_interval),
+                 ("tune", self.wjs_tune, tune_interval),
+                 ("actuate", self.wjs_actuator.ra_flush, actuate_interval),
+                 ("lifecycle", self.wjs_lifecycle, lifecycle_interval)]
+        for name, func, period in tasks:
+            if name == "actuate" and actuate_threads:
+                continue
+            self.wjs_tasks[name] = utils.PeriodicTask(name, func, period)
+
+    def wjs_start(self):
+        """
+        Start the periodic tasks
+        """
+        for task in self.wjs_tasks.values():
+            task.pt_start()
+
+    def wjs_stats(self):
+        """
+        Return the statistics of the periodic tasks
+        """
+        stats = {}
+        for name, task in self.wjs_tasks.iteritems():
+            stats[name] = task.pt_stats()
+        return stats
+
+    def wjs_lifecycle_stats(self):
+        """
+        Return the statistics of the lifecycle of jobs
+        """
+        return {"jobs": len(self.wjs_jobs),
+                "pending": len(self.wjs_pending_jobs),
+                "candidates": len(self.wjs_candidates),
+                "discovered": self.wjs_discovered_count,
+                "expired": self.wjs_expired_count,
+                "overflow": self.wjs_overflow_count,
+                "start_failures": self.wjs_start_failed_count,
+                "abandoned": self.wjs_abandoned_count,
+                "stop_failures": self.wjs_stop_failed_count}
+
+    def wjs_action_record(self, kind, action, action_type):
+        """
+        Record an action or its result to the store
+        """
+        if self.wjs_store is None:
+            return
+        key = (action.ah_action_job_id, action.ah_action_hostname,
+               action.ah_job_id, action_type)
+        if kind == rate_store.KIND_RESULT:
+            value = 1 if action.ah_action_good else 0
+            aux = action.ah_failure_time
+        else:
+            if action_type == "regret":
+                value = action.ah_action_limit_before
+                aux = action.ah_action_limit_after
+            else:
+                value = action.ah_action_limit_after
+                aux = action.ah_action_limit_before
+        self.wjs_store.rst_action_record(kind, key, value, aux)
+
+    def _wjs_service_hostname(self, service_id):
+        """
+        Return the hostname of a service, or None if it is unknown
+        """
+        # pylint: disable=no-self-use
+        host = CLUSTER.lc_map_service_host.get(service_id)
+        if host is None:
+            logging.debug("datapoint of unknown service [%s]", service_id)
+            return None
+        return host.sh_hostname
 
     def _wjs_find_job(self, job_id):
         """
@@ -726,18 +1438,60 @@ class WatchedJobs(object):
 
     def wjs_watch_job(self, job_id, websocket):
         """
-        A websocket connected, so watch the job
+        A websocket connected, so watch the job. The TBF rule of the job is
+        started on the hosts that it has not been started on, so a later
+        watch of the job retries the hosts that failed, until starting has
+        failed for LIFECYCLE_START_ATTEMPTS times.
         """
+        # Share the string with the job IDs of the datapoints
+        job_id = metric_ingest.string_intern(job_id)
         self.wjs_condition.acquire()
         job = self._wjs_find_job(job_id)
         if job is None:
-            job = WatchedJob(job_id, WATCHED_JOBS)
+            # The job might be discovered but its rule not started yet
+            job = self.wjs_pending_jobs.pop(job_id, None)
+            if job is None:
+                job = WatchedJob(job_id, self)
+                self.wjs_engine.re_job_add(job_id)
             self.wjs_jobs[job_id] = job
-            tbf_name = lustre_config.tbf_escape_name(job_id)
-            CLUSTER.lc_start_tbf_rule(tbf_name, job_id, DEFAULT_RATE_LIMIT)
         job.wj_websockets.append(websocket)
+        hosts = []
+        if job.wj_start_attempts < LIFECYCLE_START_ATTEMPTS:
+            hosts = [host for host in CLUSTER.lc_oss_hosts()
+                     if host.sh_hostname not in job.wj_started_hostnames]
         self.wjs_condition.release()
 
+        # Start the rule without holding the lock, since it takes a while
+        if len(hosts) != 0:
+            self._wjs_rule_start(job, hosts)
+
+    def _wjs_rule_start(self, job, hosts):
+        """
+        Start the TBF rule of a watched job on the hosts, and record the
+        hosts that it has been started on
+        """
+        operations = [{"op": tbf_agent.OPERATION_START,
+                       "name": job.wj_tbf_name,
+                       "expression": job.wj_job_id,
+                       "rate": DEFAULT_RATE_LIMIT}]
+        host_operations = [(host, operations) for host in hosts]
+        results = CLUSTER.lc_tbf_operations(host_operations)
+        failed_hostnames = []
+        for host in hosts:
+            if results[host.sh_hostname][0] == 0:
+                job.wj_started_hostnames.add(host.sh_hostname)
+                self.wjs_actuator.ra_rule_started([host], job.wj_tbf_name,
+                                                  DEFAULT_RATE_LIMIT)
+            else:
+                failed_hostnames.append(host.sh_hostname)
+        if len(failed_hostnames) != 0:
+            job.wj_start_attempts += 1
+            self.wjs_start_failed_count += 1
+            logging.error("failed to start TBF rule [%s] of job [%s] on "
+                          "hosts %s for [%d] times", job.wj_tbf_name,
+                          job.wj_job_id, failed_hostnames,
+                          job.wj_start_attempts)
+
     def wjs_unwatch_job(self, job_id, websocket):
         """
         A websocket disconnected, so unwatch the job
@@ -749,61 +1503,290 @@ class WatchedJobs(object):
             return -1
         if websocket in job.wj_websockets:
             job.wj_websockets.remove(websocket)
-        if len(job.wj_websockets) == 0:
+        # Discovered jobs are kept until they expire
+        abandoned = (len(job.wj_websockets) == 0 and
+                     not self.wjs_auto_discover)
+        if abandoned:
+            del self.wjs_jobs[job_id]
+            self.wjs_engine.re_job_remove(job_id)
+        self.wjs_condition.release()
+
+        # Stop the rule without holding the lock, since it takes a while
+        if abandoned:
             tbf_name = lustre_config.tbf_escape_name(job_id)
+            self.wjs_actuator.ra_rule_stopped(tbf_name)
             CLUSTER.lc_stop_tbf_rule(tbf_name)
+        return 0
+
+    def wjs_metrics_received(self, datapoints):
+        """
+        Recived a batch of datapoints, each datapoint is a tuple of
+        (service_id, job_id, timestamp, value, optype)
+        """
+        self.wjs_condition.acquire()
+        if self.wjs_auto_discover:
+            self._wjs_jobs_discover(datapoints)
+        added = self.wjs_engine.re_datapoints_add(datapoints)
+        for job_id, service_id, _ in added:
+            job = self.wjs_jobs.get(job_id)
+            if job is None:
+                job = self.wjs_pending_jobs[job_id]
+            job.wj_service_add(service_id)
+        self.wjs_condition.release()
+
+    def _wjs_jobs_discover(self, datapoints):
+        """
+        Start to track the jobs whose counters changed. Jobs are not
+        discovered by their first datapoints, since Lustre keeps the job
+        stats of finished jobs for a while.
+        """
+        jobs = self.wjs_jobs
+        pending_jobs = self.wjs_pending_jobs
+        candidates = self.wjs_candidates
+        for service_id, job_id, _, value, optype in datapoints:
+            if job_id in jobs or job_id in pending_jobs:
+                continue
+            key = (job_id, service_id, optype)
+            previous = candidates.get(key)
+            if previous is None or value <= previous:
+                if len(candidates) >= CANDIDATE_CACHE_SIZE:
+                    candidates.clear()
+                candidates[key] = value
+                continue
+            del candidates[key]
+            if len(jobs) + len(pending_jobs) >= self.wjs_max_jobs:
+                self.wjs_overflow_count += 1
+                continue
+            logging.info("discovered job [%s]", job_id)
+            pending_jobs[job_id] = WatchedJob(job_id, self)
+            self.wjs_engine.re_job_add(job_id)
+            self.wjs_discovered_count += 1
+
+    def wjs_lifecycle(self):
+        """
+        Start the TBF rules of discovered jobs and stop the rules of expired
+        jobs, in batches. A discovered job is kept pending until its rule
+        has been started on all hosts, or given up after failing for
+        LIFECYCLE_START_ATTEMPTS times.
+        """
+        # pylint: disable=too-many-locals,too-many-branches
+        # pylint: disable=too-many-statements
+        if not self.wjs_auto_discover:
+            return
+        expired = []
+        self.wjs_condition.acquire()
+        before = time.time() - self.wjs_job_ttl
+        for job_id in self.wjs_engine.re_idle_jobs(before):
+            job = self.wjs_jobs.get(job_id)
+            if job is None or len(job.wj_websockets) != 0:
+                continue
+            if len(expired) >= LIFECYCLE_BATCH:
+                break
+            logging.info("job [%s] expired", job_id)
             del self.wjs_jobs[job_id]
+            self.wjs_engine.re_job_remove(job_id)
+            expired.append(job)
+        self.wjs_expired_count += len(expired)
+        starting = self.wjs_pending_jobs.values()[:LIFECYCLE_BATCH]
         self.wjs_condition.release()
-        return 0
+        if len(expired) == 0 and len(starting) == 0:
+            return
+
+        stop_operations = []
+        for job in expired:
+            self.wjs_actuator.ra_rule_stopped(job.wj_tbf_name)
+            stop_operations.append({"op": tbf_agent.OPERATION_STOP,
+                                    "name": job.wj_tbf_name})
+        # The rules are only started on the hosts that they have not been
+        # started on yet
+        hosts = CLUSTER.lc_oss_hosts()
+        host_operations = []
+        host_starting = {}
+        for host in hosts:
+            operations = list(stop_operations)
+            host_jobs = []
+            for job in starting:
+                if host.sh_hostname in job.wj_started_hostnames:
+                    continue
+                operations.append({"op": tbf_agent.OPERATION_START,
+                                   "name": job.wj_tbf_name,
+                                   "expression": job.wj_job_id,
+                                   "rate": DEFAULT_RATE_LIMIT})
+                host_jobs.append(job)
+            if len(operations) == 0:
+                continue
+            host_operations.append((host, operations))
+            host_starting[host.sh_hostname] = host_jobs
+        # Apply the operations without holding the lock, since it takes a
+        # while
+        results = CLUSTER.lc_tbf_operations(host_operations)
+        for host, operations in host_operations:
+            hostname = host.sh_hostname
+            rets = results[hostname]
+            stop_rets = rets[:len(stop_operations)]
+            failed_names = [job.wj_tbf_name
+                            for job, ret in zip(expired, stop_rets) if ret]
+            if len(failed_names) != 0:
+                logging.error("failed to stop TBF rules %s of expired jobs "
+                              "on host [%s]", failed_names, hostname)
+                self.wjs_stop_failed_count += len(failed_names)
+            start_rets = rets[len(stop_operations):]
+            for job, ret in zip(host_starting[hostname], start_rets):
+                if ret == 0:
+                    job.wj_started_hostnames.add(hostname)
+                    self.wjs_actuator.ra_rule_started([host], job.wj_tbf_name,
+                                                      DEFAULT_RATE_LIMIT)
 
-    def wjs_metric_received(self, service_id, job_id, timestamp, value):
+        hostnames = set(host.sh_hostname for host in hosts)
+        abandoned = []
+        self.wjs_condition.acquire()
+        for job in starting:
+            # The job might have been watched by a websocket meanwhile
+            if self.wjs_pending_jobs.get(job.wj_job_id) is not job:
+                continue
+            if hostnames <= job.wj_started_hostnames:
+                del self.wjs_pending_jobs[job.wj_job_id]
+                self.wjs_jobs[job.wj_job_id] = job
+                continue
+            # Keep the job pending, and retry on the failed hosts later
+            job.wj_start_attempts += 1
+            self.wjs_start_failed_count += 1
+            if job.wj_start_attempts < LIFECYCLE_START_ATTEMPTS:
+                continue
+            logging.error("failed to start TBF rule [%s] of job [%s] on "
+                          "hosts %s for [%d] times, giving up",
+                          job.wj_tbf_name, job.wj_job_id,
+                          sorted(hostnames - job.wj_started_hostnames),
+                          job.wj_start_attempts)
+            del self.wjs_pending_jobs[job.wj_job_id]
+            self.wjs_engine.re_job_remove(job.wj_job_id)
+            abandoned.append(job)
+        self.wjs_abandoned_count += len(abandoned)
+        self.wjs_condition.release()
+
+        if len(abandoned) != 0:
+            self._wjs_abandoned_rules_stop(hosts, abandoned)
+
+    def _wjs_abandoned_rules_stop(self, hosts, abandoned):
         """
-        Recived a datapoint
+        Stop the TBF rules of abandoned jobs on the hosts that they have
+        been started on, so the jobs can be discovered again cleanly
         """
+        host_operations = []
+        for host in hosts:
+            operations = []
+            for job in abandoned:
+                if host.sh_hostname in job.wj_started_hostnames:
+                    operations.append({"op": tbf_agent.OPERATION_STOP,
+                                       "name": job.wj_tbf_name})
+            if len(operations) != 0:
+                host_operations.append((host, operations))
+        for job in abandoned:
+            self.wjs_actuator.ra_rule_stopped(job.wj_tbf_name)
+        results = CLUSTER.lc_tbf_operations(host_operations)
+        for host, operations in host_operations:
+            rets = results[host.sh_hostname]
+            failed_names = [operation["name"]
+                            for operation, ret in zip(operations, rets)
+                            if ret]
+            if len(failed_names) != 0:
+                logging.error("failed to stop TBF rules %s of abandoned "
+                              "jobs on host [%s]", failed_names,
+                              host.sh_hostname)
+                self.wjs_stop_failed_count += len(failed_names)
+
+    def wjs_rates_update(self, now=None):
+        """
+        Compute the rates of jobs and replace the snapshot. The time of the
+        snapshot is the current time if now is None.
+        """
+        jobs = collections.OrderedDict()
         self.wjs_condition.acquire()
-        job = self._wjs_find_job(job_id)
-        if job is None:
-            self.wjs_condition.release()
-            return 1
-        job.wj_datapoint_add(service_id, timestamp, value)
+        job_rates = self.wjs_engine.re_job_rates()
+        for job_id, job in self.wjs_jobs.iteritems():
+            jobs[job_id] = job.wj_rates_snapshot(job_rates[job_id])
         self.wjs_condition.release()
-        return 0
+        if now is None:
+            now = time.time()
+        snapshot = {"time": now, "jobs": jobs}
+        self.wjs_snapshot = snapshot
+        self.wjs_history.rh_snapshot_record(snapshot)
+        self.wjs_history.rh_expire(now)
+        if self.wjs_store is not None:
+            self.wjs_store.rst_snapshot_record(snapshot)
 
     def wjs_datapoints_send(self):
         """
-        Send datapoints of jobs
+        Broadcast datapoints of all jobs in the latest snapshot as one frame
         """
-        while True:
-            logging.debug("sending datapoints of jobs")
-            self.wjs_condition.acquire()
-            deleted_jobs = []
-            for job_id, job in self.wjs_jobs.iteritems():
-                ret = job.wj_datapoint_send()
-                if ret == 1:
-                    deleted_jobs.append(job_id)
-
-            for job_id in deleted_jobs:
-                tbf_name = lustre_config.tbf_escape_name(job_id)
-                CLUSTER.lc_stop_tbf_rule(tbf_name)
-                del self.wjs_jobs[job_id]
+        snapshot = self.wjs_snapshot
+        if snapshot is self.wjs_published_snapshot:
+            return
+        self.wjs_published_snapshot = snapshot
+        frame = self.wjs_encoder.rse_encode(snapshot)
+        self.wjs_hub.bh_broadcast(frame)
+        logging.debug("broadcasted datapoints of [%d] jobs",
+                      len(snapshot["jobs"]))
+
+    def wjs_tune(self, tick_time=None):
+        """
+        Tune the jobs with the current policy according to the latest
+        snapshot. The tick time is the deadline of the tune task if not
+        given.
+        """
+        snapshot = self.wjs_snapshot
+        if tick_time is None:
+            tick_time = self.wjs_tasks["tune"].pt_tick_deadline
+        if tick_time is None:
+            tick_time = utils.monotonic_time()
+        failures = self.wjs_actuator.ra_failures_take()
+        self.wjs_condition.acquire()
+        self.wjs_tick_time = tick_time
+        if len(failures) != 0:
+            self._wjs_rate_failures_apply(failures)
+        for job_id, job in self.wjs_jobs.iteritems():
+            if job_id in snapshot["jobs"]:
+                job.wj_rates_apply(snapshot["jobs"][job_id])
+        self.wjs_current_policy.rp_tune_func(self)
+        self.wjs_condition.release()
 
-            self.wjs_current_policy.rp_tune_func(self)
-            self.wjs_condition.release()
-            logging.debug("sent datapoints of jobs")
-            sleep(METRIC_INTERVAL)
+    def _wjs_rate_failures_apply(self, failures):
+        """
+        The actuator gave up some rate changes, so restore the limits of
+        the jobs on those hosts to the rates before the changes. Then the
+        policy will change them again if still needed.
+        """
+        job_tbf_names = {}
+        for job in self.wjs_jobs.itervalues():
+            job_tbf_names[job.wj_tbf_name] = job
+        for host, name, rate, rate_before in failures:
+            job = job_tbf_names.get(name)
+            if job is None:
+                continue
+            host_for_job = job.wj_hosts.get(host.sh_hostname)
+            if host_for_job is None or host_for_job.hfj_rate_limit != rate:
+                continue
+            if rate_before is None:
+                rate_before = DEFAULT_RATE_LIMIT
+            logging.info("restoring limit of job [%s] on host [%s] from [%s] "
+                         "to [%s] since the change failed", job.wj_job_id,
+                         host.sh_hostname, rate, rate_before)
+            host_for_job.hfj_rate_limit = rate_before
 
-    def wjs_save_rates(self, end_job_id, action_job_id):
+    def wjs_save_rates(self, end_job_id, action_job_id, hostname=None):
         """
-        Save the rates before a job_id
+        Save the rates before a job_id. If hostname is not None, save the
+        rates of the jobs on the host rather than the rates of the jobs.
         """
         rates = collections.OrderedDict()
         for job_id in self.wjs_jobs:
             job = self.wjs_jobs[job_id]
-            rates[job_id] = job.wj_rate
+            rates[job_id] = job.wj_host_rate(hostname)
             if job_id == end_job_id:
                 break
         if action_job_id not in rates:
-            rates[action_job_id] = self.wjs_jobs[action_job_id].wj_rate
+            job = self.wjs_jobs[action_job_id]
+            rates[action_job_id] = job.wj_host_rate(hostname)
         return rates
 
     def wjs_update_config(self, config):
@@ -821,6 +1804,14 @@ class WatchedJobs(object):
                     logging.error("changing policy to %s", policy_name)
                     self.wjs_current_policy = policy
                     break
+        for config_job in jobs:
+            job_id = config_job["job_id"]
+            thoughput = config_job["throughput"]
+            job = self.wjs_jobs[job_id]
+            job.wj_rate_limit = int(thoughput)
+        self.wjs_condition.release()
+
+        # Change fake I/O without holding the lock, since it takes a while
         if fake_io != self.wjs_current_fake_io:
             logging.error("changing fake I/O to %s", fake_io)
             if fake_io:
@@ -831,12 +1822,6 @@ class WatchedJobs(object):
                 logging.error("failed to enable/disable fake I/O")
             else:
                 self.wjs_current_fake_io = fake_io
-        for config_job in jobs:
-            job_id = config_job["job_id"]
-            thoughput = config_job["throughput"]
-            job = self.wjs_jobs[job_id]
-            job.wj_rate_limit = int(thoughput)
-        self.wjs_condition.release()
 
 
 class HostForJob(object):
@@ -844,20 +1829,22 @@ class HostForJob(object):
     Each host has an object of HostForJob for each job
     """
     # pylint: disable=too-few-public-methods
+    __slots__ = ["hfj_host", "hfj_rate_limit", "hfj_rate", "hfj_job"]
+
     def __init__(self, job, host):
         self.hfj_host = host
-        # Array of services for job
-        self.hfj_services = {}
         self.hfj_rate_limit = DEFAULT_RATE_LIMIT
         self.hfj_rate = 0
         self.hfj_job = job
 
     def hfj_change_tbf_rate(self, rate_limit):
         """
-        Change the job's rate on this host
+        Change the job's rate on this host. The change is queued to the
+        actuator and written to the host asynchronously.
         """
-        ret = self.hfj_host.lh_change_tbf_rate(self.hfj_job.wj_tbf_name,
-                                               rate_limit)
+        actuator = self.hfj_job.wj_jobs.wjs_actuator
+        ret = actuator.ra_rate_change(self.hfj_host, self.hfj_job.wj_tbf_name,
+                                      rate_limit)
         if ret == 0:
             self.hfj_rate_limit = rate_limit
         return ret
@@ -865,84 +1852,79 @@ class HostForJob(object):
 
 class WatchedJob(object):
     """
-    Each wathed job has an object of WatchedJob
+    Each wathed job has an object of WatchedJob. The rates of the job on
+    services are kept by the rate engine rather than by objects.
     """
     # pylint: disable=too-many-instance-attributes
+    __slots__ = ["wj_websockets", "wj_job_id", "wj_jobs", "wj_rate_limit",
+                 "wj_current_rate_limit", "wj_rate", "wj_hosts",
+                 "wj_tbf_name", "wj_started_hostnames",
+                 "wj_start_attempts"]
+
     def __init__(self, job_id, jobs):
         self.wj_websockets = []
         self.wj_job_id = job_id
         self.wj_jobs = jobs
-        self.wj_value = None
-        self.wj_timestamp = None
-        self.wj_services = {}
         self.wj_rate_limit = None
         self.wj_current_rate_limit = None
         self.wj_rate = None
         # Host for each job
         self.wj_hosts = {}
         self.wj_tbf_name = lustre_config.tbf_escape_name(job_id)
+        # The hosts that the TBF rule of the job has been started on, and
+        # the number of times that starting it failed
+        self.wj_started_hostnames = set()
+        self.wj_start_attempts = 0
 
-    def wj_datapoint_add(self, service_id, timestamp, value):
+    def wj_service_add(self, service_id):
         """
-        Recived a datapoint of this job
+        Recived the first datapoint of this job on a service
         """
-        if service_id not in self.wj_services:
-            service = ServiceForJob()
-            host = CLUSTER.lc_map_service_host[service_id]
-            hostname = host.sh_hostname
-            if hostname not in self.wj_hosts:
-                logging.error("service [%s] is on host [%s]", service_id,
-                              hostname)
-                host_for_job = HostForJob(self, host)
-                self.wj_hosts[hostname] = host_for_job
-            else:
-                host_for_job = self.wj_hosts[hostname]
-            host_for_job.hfj_services[service_id] = service
-            self.wj_services[service_id] = service
-        else:
-            service = self.wj_services[service_id]
-        service.sfj_datapoint_add(timestamp, value)
-
-    def wj_datapoint_send(self):
-        """
-        Send a datapoint to clients
-        """
-        dead_websockets = []
-        rate = self.wj_rate_get()
-        json_string = json.dumps({
-            "type": "datapoint",
-            "time": time.time(),
-            "rate": rate,
-            "job_id": self.wj_job_id})
-        for websocket in self.wj_websockets:
-            try:
-                websocket.send(json_string)
-            except WebSocketError:
-                websocket.closed = True
-                dead_websockets.append(websocket)
-
-        for websocket in dead_websockets:
-            self.wj_websockets.remove(websocket)
-        if len(self.wj_websockets) == 0:
-            return 1
-        return 0
+        host = CLUSTER.lc_map_service_host[service_id]
+        hostname = host.sh_hostname
+        if hostname not in self.wj_hosts:
+            logging.error("service [%s] is on host [%s]", service_id,
+                          hostname)
+            self.wj_hosts[hostname] = HostForJob(self, host)
 
-    def wj_rate_get(self):
+    def wj_rates_snapshot(self, job_rates):
         """
-        Return the current rate according the datapoints
+        Return a snapshot of the rates computed by the rate engine, together
+        with the limits. The rates of all the tracked optypes are summed up
+        as the rate of the job.
         """
-        rate = 0
-        for hostname in self.wj_hosts:
-            host = self.wj_hosts[hostname]
-            host.hfj_rate = 0
-            for service_id in host.hfj_services:
-                service = host.hfj_services[service_id]
-                service_rate = service.sfj_rate
-                if service_rate is not None:
-                    rate += service_rate
-                    host.hfj_rate += service_rate
-        self.wj_rate = rate
-        return rate
+        host_rates = job_rates["hosts"]
+        host_limits = {}
+        for hostname, host in self.wj_hosts.iteritems():
+            if hostname not in host_rates:
+                host_rates[hostname] = 0
+            host_limits[hostname] = host.hfj_rate_limit
+        return {"rate": job_rates["rate"],
+                "limit": self.wj_rate_limit,
+                "hosts": host_rates,
+                "host_limits": host_limits,
+                "services": job_rates["services"]}
+
+    def wj_rates_apply(self, job_snapshot):
+        """
+        Update the rates of the job and its hosts from a snapshot
+        """
+        self.wj_rate = job_snapshot["rate"]
+        host_rates = job_snapshot["hosts"]
+        for hostname, host in self.wj_hosts.iteritems():
+            host.hfj_rate = host_rates.get(hostname, 0)
+
+    def wj_host_rate(self, hostname):
+        """
+        Return the rate of the job on a host, or the rate of the job if
+        hostname is None
+        """
+        if hostname is None:
+            return self.wj_rate
+        host = self.wj_hosts.get(hostname)
+        if host is None:
+            return 0
+        return host.hfj_rate
 
     def wj_highest_limit_host(self):
         """
@@ -1000,22 +1982,22 @@ class WatchedJob(object):
             logging.error("no selected host to decrease rate")
             return -1
         old = selected.hfj_rate_limit
+        rate_limit = old
         # The rate is lower than the limit, there is other bottleneck
         # Set the rate limit to the real limit to speedup the decrease process
         if old > selected.hfj_rate * 11 / 10:
-            selected.hfj_rate_limit = selected.hfj_rate
+            rate_limit = selected.hfj_rate
 
-        if diff + MIN_RATE_LIMIT > selected.hfj_rate_limit:
-            selected.hfj_rate_limit = MIN_RATE_LIMIT
+        if diff + MIN_RATE_LIMIT > rate_limit:
+            rate_limit = MIN_RATE_LIMIT
         else:
-            selected.hfj_rate_limit -= diff
+            rate_limit -= diff
         logging.info("decreasing rate of host [%s] for job [%s] from [%d] "
                      "to [%d]",
                      selected.hfj_host.sh_hostname,
                      self.wj_job_id,
-                     old, selected.hfj_rate_limit)
-        selected.hfj_host.lh_change_tbf_rate(self.wj_tbf_name,
-                                             selected.hfj_rate_limit)
+                     old, rate_limit)
+        selected.hfj_change_tbf_rate(rate_limit)
         return 0
 
     def wj_increase_lowest_host(self):
@@ -1035,46 +2017,24 @@ class WatchedJob(object):
             return
         old = selected.hfj_rate_limit
         diff = self.wj_rate_limit - self.wj_rate
-        selected.hfj_rate_limit += diff
-        if selected.hfj_rate_limit > DEFAULT_RATE_LIMIT:
-            selected.hfj_rate_limit = DEFAULT_RATE_LIMIT
+        rate_limit = old + diff
+        if rate_limit > DEFAULT_RATE_LIMIT:
+            rate_limit = DEFAULT_RATE_LIMIT
         logging.info("increasing rate of host [%s] for job [%s] from [%d] "
                      "to [%d]",
                      selected.hfj_host.sh_hostname,
                      self.wj_job_id,
-                     old, selected.hfj_rate_limit)
-        selected.hfj_host.lh_change_tbf_rate(self.wj_tbf_name,
-                                             selected.hfj_rate_limit)
+                     old, rate_limit)
+        selected.hfj_change_tbf_rate(rate_limit)
         return
 
 
-class ServiceForJob(object):
-    """
-    Each service (OST) has an object of ServiceForJob for each job
-    """
-    # pylint: disable=too-few-public-methods
-    def __init__(self):
-        # Data collected from collectd
-        self.sfj_value = None
-        self.sfj_timestamp = None
-        self.sfj_rate = None
-
-    def sfj_datapoint_add(self, timestamp, value):
-        """
-        A datapoint is recived for this job and this service
-        """
-        # If overflow happens, rate will be kept unchanged for one interval
-        if (self.sfj_timestamp is not None and
-                value >= self.sfj_value and
-                timestamp > self.sfj_timestamp):
-            diff = value - self.sfj_value
-            time_diff = timestamp - self.sfj_timestamp
-            self.sfj_rate = diff / time_diff / 1000000
-        self.sfj_timestamp = timestamp
-        self.sfj_value = value
-
-
 WATCHED_JOBS = None
+INGESTER = None
+COLLECTD_LISTENER = None
+FAKE_CLUSTER = None
+# The utils.DependencyResult of bootstrapping the cluster
+BOOTSTRAP_RESULT = None
 
 
 @APP.route("/")
@@ -1085,48 +2045,83 @@ def app_root():
     return render_template("index.html")
 
 
-def tsdb_tags_parse(tsdb_tags, tag_dict):
+@APP.route("/metric_post", methods=['POST'])
+def app_metric_post():
     """
-    Parse a TSDB tag string to dictionary
+    Metric datapoints are recieved from Collectd. The payload is only queued
+    here, and decoded by the ingester later.
     """
-    tags = tsdb_tags.split()
-    for tag in tags:
-        pair = tag.split("=")
-        if len(pair) != 2:
-            logging.error("tsdb tags [%s] is invalid", tsdb_tags)
-            return -1
-        tag_dict[pair[0]] = pair[1]
-    return 0
+    ret = INGESTER.mi_post(request.get_data())
+    if ret:
+        return "Failure"
+    return "Succeeded"
 
 
-@APP.route("/metric_post", methods=['POST'])
-def app_metric_post():
+@APP.route("/stats")
+def app_stats():
     """
-    A metric datapoint is recieved from Collectd
+    Statistics of the periodic tasks, the ingestion and the actuator
     """
-    logging.debug(json.dumps(request.json, indent=4))
-    for metric in request.json:
-        meta = metric["meta"]
-        tsdb_name = meta["tsdb_name"]
-        if tsdb_name != "ost_jobstats_samples":
-            continue
-        tsdb_tags = meta["tsdb_tags"]
-        tag_dict = {}
-        ret = tsdb_tags_parse(tsdb_tags, tag_dict)
-        if ret:
-            continue
-        logging.debug("tag_dict: %s", tag_dict)
-        if tag_dict["optype"] != "sum_write_bytes":
-            continue
-        service_id = tag_dict["ost_index"]
-        logging.debug(json.dumps(metric, indent=4))
-        job_id = tag_dict["job_id"]
-        value = metric["values"][0]
-        timestamp = metric["time"]
-        WATCHED_JOBS.wjs_metric_received(service_id, job_id, timestamp, value)
-        logging.debug("service_id :%s, job_id: %s, time: %d, value: %d",
-                      service_id, job_id, timestamp, value)
-    return "Succeeded"
+    policies = {}
+    for policy in WATCHED_JOBS.wjs_rate_policies:
+        policies[policy.rp_name] = policy.rp_report(WATCHED_JOBS.wjs_jobs)
+    stats = {"tasks": WATCHED_JOBS.wjs_stats(),
+             "ingester": INGESTER.mi_stats(),
+             "actuator": WATCHED_JOBS.wjs_actuator.ra_stats(),
+             "broadcast": WATCHED_JOBS.wjs_hub.bh_stats(),
+             "history": WATCHED_JOBS.wjs_history.rh_stats(),
+             "engine": WATCHED_JOBS.wjs_engine.re_stats(),
+             "lifecycle": WATCHED_JOBS.wjs_lifecycle_stats(),
+             "fair_share": WATCHED_JOBS.wjs_fair_share_policy.fsp_stats(),
+             "pid": WATCHED_JOBS.wjs_pid_policy.pid_stats(),
+             "priority": WATCHED_JOBS.wjs_priority_policy.prp_stats(),
+             "policies": policies}
+    if WATCHED_JOBS.wjs_store is not None:
+        stats["store"] = WATCHED_JOBS.wjs_store.rst_stats()
+    if COLLECTD_LISTENER is not None:
+        stats["collectd_network"] = COLLECTD_LISTENER.cl_stats()
+    if FAKE_CLUSTER is not None:
+        stats["fake_lustre"] = FAKE_CLUSTER.flc_stats()
+    if BOOTSTRAP_RESULT is not None:
+        stats["bootstrap"] = BOOTSTRAP_RESULT.dr_stats()
+    return json.dumps(stats, indent=4)
+
+
+@APP.route("/rate_history")
+def app_rate_history():
+    """
+    Datapoints of rates in the history, so that clients can fill their
+    charts in one request. Arguments:
+        start, end: the time range, end defaults to now
+        seconds: the seconds before end, used if start is not given
+        job_id: the job to query, can be given multiple times
+        level: "job", "host" or "ost", "host" and "ost" only if in
+               history_levels
+        host: the hostname to query
+        metric: "rate", "limit" or an optype for OST level
+        points: the number of points wanted, if given, the coarsest rollup
+                tier that keeps start and has that many points in the
+                range is used
+    """
+    end = request.args.get("end", time.time(), type=float)
+    seconds = request.args.get("seconds", 60, type=float)
+    start = request.args.get("start", end - seconds, type=float)
+    job_ids = request.args.getlist("job_id")
+    if len(job_ids) == 0:
+        job_ids = None
+    level = request.args.get("level")
+    if level is not None and level not in rate_history.LEVELS:
+        return json.dumps({"error": "invalid level [%s]" % level})
+    if (level is not None and
+            level not in WATCHED_JOBS.wjs_history.rh_levels):
+        return json.dumps({"error": "level [%s] is not recorded, see "
+                                    "history_levels" % level})
+    series = WATCHED_JOBS.wjs_history.rh_query(
+        start, end, job_ids=job_ids, level=level,
+        hostname=request.args.get("host"),
+        metric=request.args.get("metric"),
+        points=request.args.get("points", type=int))
+    return json.dumps({"start": start, "end": end, "series": series})
 
 
 @APP.route("/console_websocket")
@@ -1145,9 +2140,15 @@ def app_console_websocket():
         for job in jobs:
             job_id = job["job_id"]
             WATCHED_JOBS.wjs_watch_job(job_id, websocket)
+        encoding = config.get("encoding", broadcast_hub.ENCODING_JSON)
+        client = WATCHED_JOBS.wjs_hub.bh_client_add(websocket,
+                                                    encoding=encoding)
 
         while not websocket.closed:
             data = websocket.receive()
+            if data is None:
+                # The websocket is closed, possibly by the hub
+                break
             logging.debug("command: %s", data)
             config = json.loads(data)
             ret = WATCHED_JOBS.wjs_update_config(config)
@@ -1160,11 +2161,12 @@ def app_console_websocket():
                 "type": "command_result",
                 "command": "change_config",
                 "result": result})
-            logging.debug("sent result")
-            websocket.send(json_string)
+            client.bc_message_put(json_string)
+            logging.debug("queued result")
 
+        WATCHED_JOBS.wjs_hub.bh_client_remove(client)
         for job in jobs:
-            WATCHED_JOBS.wjs_unwatch_job(job_id, websocket)
+            WATCHED_JOBS.wjs_unwatch_job(job["job_id"], websocket)
         logging.debug("websocket is closed")
         return "Success"
     else:
@@ -1190,54 +2192,158 @@ def load_config():
     identity = cluster["ssh_identity_file"]
     fake_io = cluster["fake_io"]
     jobs = cluster["jobs"]
+    parallelism = cluster.get("parallelism", utils.PARALLEL_CONCURRENCY)
+    parallel_timeout = cluster.get("parallel_timeout", None)
+    transport = None
+    fake_config = cluster.get("fake_lustre", {})
+    if fake_config.get("enabled", False):
+        global FAKE_CLUSTER
+        FAKE_CLUSTER = fake_lustre.FakeLustreCluster(
+            fsname,
+            oss_number=fake_config.get("oss_number",
+                                       fake_lustre.FAKE_OSS_NUMBER),
+            osts_per_oss=fake_config.get("osts_per_oss",
+                                         fake_lustre.FAKE_OSTS_PER_OSS),
+            client_number=fake_config.get("client_number",
+                                          fake_lustre.FAKE_CLIENT_NUMBER),
+            capacity=fake_config.get("capacity", fake_lustre.FAKE_CAPACITY),
+            job_number=fake_config.get("job_number",
+                                       fake_lustre.FAKE_JOB_NUMBER),
+            job_rate=fake_config.get("job_rate", fake_lustre.FAKE_JOB_RATE),
+            job_osts=fake_config.get("job_osts", fake_lustre.FAKE_JOB_OSTS),
+            interval=fake_config.get("interval",
+                                     fake_lustre.FAKE_COLLECTD_INTERVAL),
+            url=fake_config.get("url", fake_lustre.FAKE_METRIC_URL),
+            latency=fake_config.get("latency", fake_lustre.FAKE_LATENCY))
+        transport = FAKE_CLUSTER
+        # The fake hosts replace the hosts in the config
+        hosts = FAKE_CLUSTER.flc_hostnames
     logging.debug("fsname: [%s], hosts: %s", fsname, hosts)
     CLUSTER = lustre_config.LustreCluster(fsname, hosts,
-                                          ssh_identity_file=identity)
-    logging.debug("detecting services")
-    global WATCHED_JOBS
-    WATCHED_JOBS = WatchedJobs(fake_io)
-    ret = CLUSTER.lc_detect_services()
-    if ret:
-        return -1
-
-    ret = CLUSTER.lc_benchmark()
-    if ret:
-        return -1
-
-    ret = CLUSTER.lc_restart_collectd()
-    if ret:
-        return -1
-
-    if fake_io:
-        ret = CLUSTER.lc_enable_fake_io_for_oss()
+                                          ssh_identity_file=identity,
+                                          parallelism=parallelism,
+                                          parallel_timeout=parallel_timeout,
+                                          transport=transport)
+    store = None
+    store_config = cluster.get("rate_store", {})
+    if store_config.get("enabled", False):
+        store = rate_store.RateStore(
+            directory=store_config.get("directory",
+                                       rate_store.STORE_DIRECTORY),
+            segment_rows=store_config.get("segment_rows",
+                                          rate_store.STORE_SEGMENT_ROWS),
+            segment_seconds=store_config.get(
+                "segment_seconds", rate_store.STORE_SEGMENT_SECONDS),
+            max_bytes=store_config.get("max_bytes",
+                                       rate_store.STORE_MAX_BYTES),
+            max_age=store_config.get("max_age", rate_store.STORE_MAX_AGE),
+            levels=store_config.get("levels"),
+            interval=store_config.get("interval",
+                                      rate_store.STORE_INTERVAL))
+        ret = store.rst_start()
         if ret:
             return -1
-    else:
-        ret = CLUSTER.lc_clear_loc_for_oss()
+    logging.debug("detecting services")
+    global WATCHED_JOBS
+    WATCHED_JOBS = WatchedJobs(
+        fake_io,
+        rate_interval=cluster.get("rate_interval", METRIC_INTERVAL),
+        publish_interval=cluster.get("publish_interval", METRIC_INTERVAL),
+        tune_interval=cluster.get("tune_interval", METRIC_INTERVAL),
+        actuate_interval=cluster.get("actuate_interval", METRIC_INTERVAL),
+        history_retention=cluster.get("history_retention",
+                                      rate_history.RATE_HISTORY_RETENTION),
+        history_tiers=cluster.get("history_tiers"),
+        history_levels=cluster.get("history_levels"), store=store,
+        auto_discover=cluster.get("auto_discover", False),
+        job_ttl=cluster.get("job_ttl", JOB_TTL),
+        max_jobs=cluster.get("max_jobs", MAX_JOBS),
+        lifecycle_interval=cluster.get("lifecycle_interval",
+                                       METRIC_INTERVAL),
+        actuate_threads=cluster.get("actuate_threads", True))
+    WATCHED_JOBS.wjs_start()
+    global INGESTER
+    optypes = cluster.get("optypes", metric_ingest.DEFAULT_OPTYPES)
+    INGESTER = metric_ingest.MetricIngester(
+        WATCHED_JOBS.wjs_metrics_received,
+        debug=cluster.get("metric_debug", False), optypes=optypes)
+    network = cluster.get("collectd_network", {})
+    if network.get("enabled", False):
+        decoder = collectd_network.CollectdDecoder(
+            optypes,
+            identifier_pattern=network.get(
+                "identifier_pattern",
+                collectd_network.COLLECTD_IDENTIFIER_PATTERN))
+        global COLLECTD_LISTENER
+        COLLECTD_LISTENER = collectd_network.CollectdListener(
+            decoder, WATCHED_JOBS.wjs_metrics_received,
+            address=network.get("address", "0.0.0.0"),
+            port=network.get("port", collectd_network.COLLECTD_NETWORK_PORT))
+        ret = COLLECTD_LISTENER.cl_start()
         if ret:
             return -1
-
-    ret = CLUSTER.lc_check_cpt_for_oss()
-    if ret:
+    global BOOTSTRAP_RESULT
+    BOOTSTRAP_RESULT = utils.dependency_run(
+        bootstrap_steps(CLUSTER, fake_io, jobs,
+                        cluster.get("tbf_agent", False)))
+    if BOOTSTRAP_RESULT is None:
         return -1
+    logging.info("bootstrap of cluster [%s]:\n%s", fsname,
+                 BOOTSTRAP_RESULT.dr_report())
+    return BOOTSTRAP_RESULT.dr_status()
 
-    ret = CLUSTER.lc_enable_fifo_for_ost_io()
-    if ret:
-        return -1
-
-    ret = CLUSTER.lc_enable_tbf_for_ost_io("jobid")
-    if ret:
-        return -1
-
-    ret = CLUSTER.lc_set_jobid_var("procname_uid")
-    if ret:
-        return -1
 
-    ret = CLUSTER.lc_start_io(jobs)
-    if ret:
-        return -1
+def bootstrap_steps(cluster, fake_io, jobs, tbf_agent_enabled):
+    """
+    Return the steps to bootstrap the cluster for utils.dependency_run().
+    The steps that only need the services run concurrently with the
+    benchmark, which changes the NRS policy and the fail_loc of OSS, so the
+    steps that set them run after it. The I/O is started only after all the
+    other steps succeeded.
+    """
+    def tbf_agents_start():
+        """
+        Start the TBF agents, the shell commands are used on the hosts
+        that failed
+        """
+        ret = cluster.lc_start_tbf_agents()
+        if ret:
+            logging.warning("failed to start TBF agents on some hosts, "
+                            "shell commands will be used on them instead")
+        return 0
 
-    return 0
+    detect = "detect_services"
+    steps = [utils.DependencyStep(detect, cluster.lc_detect_services),
+             utils.DependencyStep("benchmark", cluster.lc_benchmark,
+                                  dependencies=[detect]),
+             utils.DependencyStep("restart_collectd",
+                                  cluster.lc_restart_collectd,
+                                  dependencies=[detect]),
+             utils.DependencyStep("check_cpt", cluster.lc_check_cpt_for_oss,
+                                  dependencies=[detect]),
+             utils.DependencyStep("set_jobid_var", cluster.lc_set_jobid_var,
+                                  ("procname_uid",), dependencies=[detect])]
+    if fake_io:
+        steps.append(utils.DependencyStep(
+            "enable_fake_io", cluster.lc_enable_fake_io_for_oss,
+            dependencies=["benchmark"]))
+    else:
+        steps.append(utils.DependencyStep(
+            "clear_loc", cluster.lc_clear_loc_for_oss,
+            dependencies=["benchmark"]))
+    # Switching to FIFO and then TBF is done in one round trip to each OSS
+    steps.append(utils.DependencyStep("reset_tbf",
+                                      cluster.lc_reset_tbf_for_ost_io,
+                                      ("jobid",),
+                                      dependencies=["benchmark"]))
+    if tbf_agent_enabled:
+        steps.append(utils.DependencyStep("start_tbf_agents",
+                                          tbf_agents_start,
+                                          dependencies=["reset_tbf"]))
+    steps.append(utils.DependencyStep(
+        "start_io", cluster.lc_start_io, (jobs,),
+        dependencies=[step.ds_name for step in steps]))
+    return steps
 
 
 def start_web():
@@ -1262,5 +2368,104 @@ def start_web():
     sys.exit(0)
 
 
+def benchmark_memory(pair_number=100000, ost_number=200, host_number=8,
+                     ticks=10):
+    """
+    Measure the resident memory of each tracked (job, OST) pair, including
+    the snapshots and the history of the default process. Each job writes
+    to all the OSTs, and two intervals of datapoints are received so that
+    every pair has a rate. The arrays of the history are only touched when
+    their rings get to them, so the bytes of the history at full retention
+    are added to the budget instead of the resident bytes measured.
+    """
+    # pylint: disable=global-statement,too-many-locals
+    global CLUSTER
+    CLUSTER = lustre_config.LustreCluster("lime", [])
+    hosts = []
+    for host_index in range(host_number):
+        hosts.append(ssh_host.SSHHost(intern("oss%d" % host_index)))
+    service_ids = []
+    for ost_index in range(ost_number):
+        service_id = intern("OST%04x" % ost_index)
+        service_ids.append(service_id)
+        CLUSTER.lc_map_service_host[service_id] = hosts[ost_index %
+                                                        host_number]
+    job_ids = []
+    for job_index in range(pair_number / ost_number):
+        job_ids.append(intern("dd.%d" % job_index))
+    jobs = WatchedJobs(False)
+
+    gc.collect()
+    start_bytes = utils.resident_bytes()
+    for job_id in job_ids:
+        jobs.wjs_watch_job(job_id, None)
+    for interval in range(2):
+        for service_id in service_ids:
+            datapoints = []
+            for job_index, job_id in enumerate(job_ids):
+                datapoints.append((service_id, job_id, 1000.0 + interval,
+                                   interval * job_index * 1048576,
+                                   "sum_write_bytes"))
+            jobs.wjs_metrics_received(datapoints)
+    gc.collect()
+    tracked_bytes = utils.resident_bytes()
+    for tick in range(ticks):
+        jobs.wjs_rates_update(now=1001.0 + tick)
+    gc.collect()
+    snapshot_bytes = utils.resident_bytes()
+    history_stats = jobs.wjs_history.rh_stats()
+
+    pairs = len(job_ids) * ost_number
+    budget_bytes = (snapshot_bytes - start_bytes + history_stats["bytes"])
+    print("%d jobs x %d OSTs on %d hosts = %d pairs" %
+          (len(job_ids), ost_number, host_number, pairs))
+    print("tracking: %d bytes, %.1f bytes per pair" %
+          (tracked_bytes - start_bytes,
+           float(tracked_bytes - start_bytes) / pairs))
+    print("snapshots and history after %d ticks: %d bytes, %.1f bytes per "
+          "pair" % (ticks, snapshot_bytes - tracked_bytes,
+                    float(snapshot_bytes - tracked_bytes) / pairs))
+    print("history of levels %s at full retention: %d series, %d bytes, "
+          "%.1f bytes per pair" %
+          (",".join(history_stats["levels"]), history_stats["series"],
+           history_stats["bytes"], float(history_stats["bytes"]) / pairs))
+    print("budget: %d bytes, %.1f bytes per pair, target %d bytes per pair" %
+          (budget_bytes, float(budget_bytes) / pairs, MEMORY_PAIR_TARGET))
+    print("rate engine: %s" % jobs.wjs_engine.re_stats())
+    if budget_bytes > MEMORY_PAIR_TARGET * pairs:
+        print("budget is over the target")
+        return -1
+    return 0
+
+
+def benchmark_bootstrap(host_number=40, latency=0.2):
+    """
+    Measure the time of bootstrapping a fake cluster whose commands take
+    the latency of SSH, compared with running the commands one by one
+    """
+    client_number = 2
+    fake = fake_lustre.FakeLustreCluster(
+        "lime", oss_number=host_number - client_number - 1,
+        client_number=client_number, post_func=lambda payload: 0,
+        latency=latency)
+    start_time = time.time()
+    cluster = lustre_config.LustreCluster("lime", fake.flc_hostnames,
+                                          transport=fake)
+    print("detected versions of %d hosts: %.3f seconds" %
+          (len(fake.flc_hostnames), time.time() - start_time))
+    jobs = [{"job_id": "dd.0", "login_name": "root"}]
+    result = utils.dependency_run(bootstrap_steps(cluster, False, jobs,
+                                                  False))
+    print(result.dr_report())
+    print("total %.3f seconds, %d commands would take %.3f seconds if run "
+          "one by one" % (time.time() - start_time, fake.flc_command_count,
+                          fake.flc_command_count * latency))
+    return result.dr_status()
+
+
 if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "benchmark_memory":
+        sys.exit(benchmark_memory())
+    if len(sys.argv) == 2 and sys.argv[1] == "benchmark_bootstrap":
+        sys.exit(benchmark_bootstrap())
     start_web()
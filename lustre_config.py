@@ -5,13 +5,29 @@
 Config Lustre using SSH connection
 """
 
+import os
 import re
+import json
 import logging
+import threading
+import subprocess
+import gevent
 
 # local libs
 import ssh_host
+import tbf_agent
 import utils
 
+# The directory of the NRS proc files of ost_io
+TBF_PROC_DIR = "%s/%s" % (tbf_agent.PROC_ROOT, tbf_agent.OST_IO_DIR)
+# The path that the TBF agent is installed to on hosts
+TBF_AGENT_REMOTE_PATH = "/tmp/lime_tbf_agent.py"
+# The longest time that the TBF agent should take to reply a batch
+TBF_AGENT_TIMEOUT = 10
+# The prefix of the output lines that report status of TBF operations
+TBF_STATUS_PREFIX = "lime_tbf_status"
+
+
 class LustreService(object):
     # pylint: disable=too-few-public-methods
     """
@@ -21,6 +37,8 @@ class LustreService(object):
     TYPE_MDT = "MDT"
     TYPE_MGS = "MGS"
     TYPE_CLIENT = "CLIENT"
+    __slots__ = ["ls_cluster", "ls_service_type", "ls_service_name",
+                 "ls_host", "ls_mount_point"]
 
     def __init__(self, cluster, service_type, service_name, host,
                  mount_point=None):
@@ -54,13 +72,141 @@ def tbf_escape_name(name):
     return good_name
 
 
+class TBFAgentClient(object):
+    """
+    The connection to the TBF agent running on a host. The agent is run
+    through SSH, and batches are sent through the stdin/stdout of SSH.
+    """
+    def __init__(self, host):
+        self.tac_host = host
+        self.tac_subprocess = None
+        self.tac_batch_id = 0
+        self.tac_condition = threading.Condition()
+
+    def _tac_readline(self):
+        """
+        Read a line from the agent, return None if timeout or EOF
+        """
+        line = None
+        with gevent.Timeout(TBF_AGENT_TIMEOUT, False):
+            line = self.tac_subprocess.stdout.readline()
+        if line == "":
+            return None
+        return line
+
+    def tac_start(self):
+        """
+        Install and start the agent on the host
+        """
+        host = self.tac_host
+        local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "tbf_agent.py")
+        ret = host.sh_send_file(local_path, TBF_AGENT_REMOTE_PATH)
+        if ret:
+            logging.error("failed to send TBF agent to host [%s]",
+                          host.sh_hostname)
+            return -1
+
+        command = "python %s" % TBF_AGENT_REMOTE_PATH
+        if host.lh_tbf_legacy_syntax():
+            command += " --legacy-syntax"
+        full_command = ssh_host.ssh_command(
+            host.sh_hostname, command, identity_file=host.sh_identity_file,
+            control_path=host.sh_control_path("root"))
+        self.tac_subprocess = subprocess.Popen(full_command, shell=True,
+                                               stdin=subprocess.PIPE,
+                                               stdout=subprocess.PIPE)
+        line = self._tac_readline()
+        try:
+            ready = json.loads(line)["ready"]
+        except (TypeError, ValueError, KeyError):
+            ready = False
+        if not ready:
+            logging.error("TBF agent on host [%s] is not ready, got [%s]",
+                          host.sh_hostname, line)
+            self.tac_stop()
+            return -1
+        logging.debug("started TBF agent on host [%s]", host.sh_hostname)
+        return 0
+
+    def tac_batch(self, operations):
+        """
+        Send a batch of operations to the agent. Return the list of the
+        return values of the operations, or None if the agent is broken.
+        """
+        # pylint: disable=too-many-return-statements
+        self.tac_condition.acquire()
+        try:
+            if self.tac_subprocess is None:
+                return None
+            self.tac_batch_id += 1
+            batch_id = self.tac_batch_id
+            try:
+                self.tac_subprocess.stdin.write(
+                    json.dumps({"id": batch_id, "operations": operations}) +
+                    "\n")
+                self.tac_subprocess.stdin.flush()
+            except (IOError, OSError, ValueError):
+                # ValueError is raised if the pipe has been closed
+                logging.error("failed to send batch to TBF agent on host "
+                              "[%s]", self.tac_host.sh_hostname)
+                return None
+            line = self._tac_readline()
+            if line is None:
+                logging.error("no reply from TBF agent on host [%s]",
+                              self.tac_host.sh_hostname)
+                return None
+            try:
+                response = json.loads(line)
+                results = response["results"]
+            except (ValueError, KeyError, TypeError):
+                logging.error("invalid reply [%s] from TBF agent on host "
+                              "[%s]", line, self.tac_host.sh_hostname)
+                return None
+            if (response.get("id") != batch_id or
+                    len(results) != len(operations)):
+                logging.error("unexpected reply [%s] from TBF agent on "
+                              "host [%s]", line, self.tac_host.sh_hostname)
+                return None
+        finally:
+            self.tac_condition.release()
+
+        rets = []
+        for operation, result in zip(operations, results):
+            status = result.get("status", -1)
+            if status != 0:
+                logging.error("failed to apply TBF operation %s on host "
+                              "[%s] through agent: %s", operation,
+                              self.tac_host.sh_hostname,
+                              result.get("error"))
+                status = -1
+            rets.append(status)
+        return rets
+
+    def tac_stop(self):
+        """
+        Stop the agent
+        """
+        if self.tac_subprocess is None:
+            return
+        try:
+            self.tac_subprocess.stdin.close()
+        except (IOError, OSError, ValueError):
+            pass
+        utils.nuke_subprocess(self.tac_subprocess)
+        self.tac_subprocess = None
+
+
 class LustreHost(ssh_host.SSHHost):
     """
     Eacho host in a Lustre clustre has an object of LustreHost
     """
     # pylint: disable=too-many-public-methods,too-many-instance-attributes
-    def __init__(self, cluster, hostname, identity_file=None):
-        super(LustreHost, self).__init__(hostname, identity_file=identity_file)
+    def __init__(self, cluster, hostname, identity_file=None,
+                 transport=None, detect_version=True):
+        # pylint: disable=too-many-arguments
+        super(LustreHost, self).__init__(hostname, identity_file=identity_file,
+                                         transport=transport)
         self.lh_services = {}
         self.lh_cluster = cluster
         self.lh_lustre_version_string = None
@@ -69,7 +215,10 @@ class LustreHost(ssh_host.SSHHost):
         self.lh_lustre_version_patch = None
         self.lh_lustre_version_fix = None
         self.lh_version_value = None
-        self.lh_detect_lustre_version()
+        # The client of the TBF agent, None if the agent is not running
+        self.lh_tbf_agent = None
+        if detect_version:
+            self.lh_detect_lustre_version()
 
     def lh_detect_services(self, cluster_services, map_service_host):
         # pylint: disable=too-many-statements
@@ -97,7 +246,7 @@ class LustreHost(ssh_host.SSHHost):
             match = self.lh_cluster.lc_mdt_regular.match(line)
             if match:
                 mdt_index = match.group("mdt_index")
-                service_name = ("MDT%s" % (mdt_index))
+                service_name = intern("MDT%s" % (mdt_index))
                 logging.debug("service [%s] running on host [%s]",
                               service_name, self.sh_hostname)
                 if service_name in cluster_services:
@@ -118,7 +267,7 @@ class LustreHost(ssh_host.SSHHost):
             match = self.lh_cluster.lc_ost_regular.match(line)
             if match:
                 ost_index = match.group("ost_index")
-                service_name = ("OST%s" % (ost_index))
+                service_name = intern("OST%s" % (ost_index))
                 logging.debug("service [%s] running on host [%s]",
                               service_name, self.sh_hostname)
                 if service_name in cluster_services:
@@ -193,35 +342,15 @@ class LustreHost(ssh_host.SSHHost):
         """
         Change the OST IO NRS policy to TBF
         """
-        command = ("echo -n tbf %s > "
-                   "/proc/fs/lustre/ost/OSS/ost_io/nrs_policies" % tbf_type)
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
-        return 0
+        return self.lh_tbf_operation({"op": tbf_agent.OPERATION_POLICY,
+                                      "policy": "tbf %s" % tbf_type})
 
     def lh_enable_fifo_for_ost_io(self):
         """
         Change the OST IO NRS policy to FIFO
         """
-        command = ("echo -n fifo > "
-                   "/proc/fs/lustre/ost/OSS/ost_io/nrs_policies")
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
-        return 0
+        return self.lh_tbf_operation({"op": tbf_agent.OPERATION_POLICY,
+                                      "policy": "fifo"})
 
     def lh_set_jobid_var(self, jobid_var):
         """
@@ -244,66 +373,163 @@ class LustreHost(ssh_host.SSHHost):
         """
         Start an TBF rule
         """
-        if self.lh_version_value >= version_value(2, 8, 54):
-            command = ("echo -n start %s jobid={%s} rate=%d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, expression, rate))
-        else:
-            command = ("echo -n start %s {%s} %d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, expression, rate))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
-        return 0
+        return self.lh_tbf_operation({"op": tbf_agent.OPERATION_START,
+                                      "name": name,
+                                      "expression": expression,
+                                      "rate": rate})
 
     def lh_stop_tbf_rule(self, name):
         """
-        Start an TBF rule
+        Stop an TBF rule
         """
-        command = ("echo -n stop %s > "
-                   "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                   (name))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
-        return 0
+        return self.lh_tbf_operation({"op": tbf_agent.OPERATION_STOP,
+                                      "name": name})
 
     def lh_change_tbf_rate(self, name, rate):
         """
         Change the TBF rate of a rule
         """
-        if self.lh_version_value >= version_value(2, 8, 54):
-            command = ("echo -n change %s rate=%d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, rate))
-        else:
-            command = ("echo -n change %s %d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, rate))
+        return self.lh_tbf_operation({"op": tbf_agent.OPERATION_CHANGE,
+                                      "name": name,
+                                      "rate": rate})
+
+    def lh_tbf_legacy_syntax(self):
+        """
+        Whether the TBF commands use the syntax of Lustre older than 2.8.54
+        """
+        return not self.lh_version_value >= version_value(2, 8, 54)
+
+    def lh_tbf_operations_shell(self, operations):
+        """
+        Apply TBF operations on this host by running a single shell command,
+        return the list of the return values of the operations
+        """
+        rets = []
+        commands = []
+        command_indexes = []
+        for index, operation in enumerate(operations):
+            fname, tbf_command = tbf_agent.tbf_operation_command(
+                operation, self.lh_tbf_legacy_syntax())
+            if fname is None:
+                logging.error("invalid TBF operation %s", operation)
+                rets.append(-1)
+                continue
+            rets.append(None)
+            command_indexes.append(index)
+            commands.append("echo -n %s > %s/%s; echo %s %d $?" %
+                            (tbf_command, TBF_PROC_DIR, fname,
+                             TBF_STATUS_PREFIX, index))
+        if len(commands) == 0:
+            return rets
+
+        command = "; ".join(commands)
         retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
+        for line in retval.cr_stdout.splitlines():
+            fields = line.split()
+            if len(fields) != 3 or fields[0] != TBF_STATUS_PREFIX:
+                continue
+            try:
+                index = int(fields[1])
+                status = int(fields[2])
+            except ValueError:
+                continue
+            if index < 0 or index >= len(rets) or rets[index] is not None:
+                continue
+            rets[index] = status
+        failed = False
+        for index in command_indexes:
+            if rets[index] != 0:
+                rets[index] = -1
+                failed = True
+        if retval.cr_exit_status != 0 or failed:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
                           command, self.sh_hostname,
                           retval.cr_exit_status,
                           retval.cr_stdout,
                           retval.cr_stderr)
+        return rets
+
+    def lh_tbf_operations(self, operations):
+        """
+        Apply TBF operations on this host in one round trip, return the
+        list of the return values of the operations. The TBF agent is used
+        if it is running, otherwise a shell command is run.
+
+        If the agent breaks, e.g. times out, it might have applied the batch
+        already, so the batch is replayed by shell commands at least once.
+        """
+        if self.lh_tbf_agent is not None:
+            rets = self.lh_tbf_agent.tac_batch(operations)
+            if rets is not None:
+                return rets
+            logging.error("TBF agent on host [%s] is broken, falling back "
+                          "to shell commands", self.sh_hostname)
+            self.lh_tbf_agent_stop()
+            return self.lh_tbf_operations_replay(operations)
+        return self.lh_tbf_operations_shell(operations)
+
+    def lh_tbf_operations_replay(self, operations):
+        """
+        Apply TBF operations by shell commands, which might have been
+        applied already. Each START is followed by a CHANGE of the same
+        rate, and succeeds if either of them succeeds, so a rule that
+        exists already ends up with the same rate rather than failing. A
+        STOP of a rule that has been stopped fails, but the rule is gone
+        either way.
+        """
+        shell_operations = []
+        indexes = []
+        for operation in operations:
+            indexes.append(len(shell_operations))
+            shell_operations.append(operation)
+            if operation.get("op") == tbf_agent.OPERATION_START:
+                shell_operations.append({"op": tbf_agent.OPERATION_CHANGE,
+                                         "name": operation.get("name"),
+                                         "rate": operation.get("rate")})
+        shell_rets = self.lh_tbf_operations_shell(shell_operations)
+        rets = []
+        for operation, index in zip(operations, indexes):
+            ret = shell_rets[index]
+            if ret and operation.get("op") == tbf_agent.OPERATION_START:
+                ret = shell_rets[index + 1]
+            rets.append(ret)
+        return rets
+
+    def lh_tbf_operation(self, operation):
+        """
+        Apply a TBF operation on this host
+        """
+        return self.lh_tbf_operations([operation])[0]
+
+    def lh_tbf_agent_start(self):
+        """
+        Start the TBF agent on this host
+        """
+        if self.lh_tbf_agent is not None:
+            return 0
+        if self.sh_transport is not None:
+            logging.error("TBF agent needs SSH connection to host [%s]",
+                          self.sh_hostname)
             return -1
+        agent = TBFAgentClient(self)
+        ret = agent.tac_start()
+        if ret:
+            logging.error("failed to start TBF agent on host [%s]",
+                          self.sh_hostname)
+            return ret
+        self.lh_tbf_agent = agent
         return 0
 
+    def lh_tbf_agent_stop(self):
+        """
+        Stop the TBF agent on this host
+        """
+        if self.lh_tbf_agent is None:
+            return
+        self.lh_tbf_agent.tac_stop()
+        self.lh_tbf_agent = None
+
     def lh_detect_lustre_version(self):
         """
         Detect the Lustre version
@@ -631,9 +857,18 @@ class LustreCluster(object):
     Each Lustre cluster has an object of LustreCluster
     """
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, fsname, server_hostnames, ssh_identity_file=None):
+    def __init__(self, fsname, server_hostnames, ssh_identity_file=None,
+                 parallelism=utils.PARALLEL_CONCURRENCY,
+                 parallel_timeout=None, transport=None):
+        # pylint: disable=too-many-arguments
         self.lc_hosts = []
         self.lc_fsname = fsname
+        # The max number of hosts that cluster-wide operations run on
+        # concurrently
+        self.lc_parallelism = parallelism
+        # The deadline in seconds of each cluster-wide operation, None means
+        # waiting until all hosts finish
+        self.lc_parallel_timeout = parallel_timeout
         mdt_pattern = (r"^.+ UP mdt %s-MDT(?P<mdt_index>\S+) .+$" %
                        self.lc_fsname)
         logging.debug("mdt_pattern: [%s]", mdt_pattern)
@@ -650,9 +885,15 @@ class LustreCluster(object):
         self.lc_client_regular = re.compile(client_pattern)
         logging.debug("client_pattern: [%s]", client_pattern)
         for hostname in server_hostnames:
-            host = LustreHost(self, hostname, identity_file=ssh_identity_file)
+            # Hostnames from the JSON config are unicode
+            host = LustreHost(self, intern(str(hostname)),
+                              identity_file=ssh_identity_file,
+                              transport=transport, detect_version=False)
             self.lc_hosts.append(host)
+        self.lc_detect_versions()
         self.lc_services = {}
+        # The hosts that run OST services, updated when detecting services
+        self.lc_oss_host_list = []
         # Mapping from service name to host
         self.lc_map_service_host = {}
         self.lc_ost_number = 0
@@ -660,20 +901,50 @@ class LustreCluster(object):
         self.lc_max_real_iops = 0
         self.lc_max_fake_iops = 0
 
+    def lc_detect_versions(self):
+        """
+        Detect the Lustre versions of the hosts
+        """
+        result = self.lc_hosts_run(self.lc_hosts,
+                                   LustreHost.lh_detect_lustre_version, (),
+                                   "detect Lustre version")
+        return result.pr_status()
+
     def lc_detect_services(self):
         """
-        Detect the services in this Lustre cluster
+        Detect the services in this Lustre cluster. The hosts are probed
+        concurrently, and then their services are merged.
         """
+        key_args = []
+        for host in self.lc_hosts:
+            key_args.append((host.sh_hostname, (host, {}, {})))
+        result = utils.parallel_run(LustreHost.lh_detect_services, key_args,
+                                    concurrency=self.lc_parallelism,
+                                    timeout=self.lc_parallel_timeout)
+        for hostname in result.pr_failed_keys():
+            logging.error("failed to detect services on host [%s], %s",
+                          hostname, result.pr_failure_reason(hostname))
+        if result.pr_status():
+            return -1
+        logging.debug("detected services on [%d] hosts in [%f] seconds",
+                      len(self.lc_hosts), result.pr_duration)
+
         services = {}
         map_service_host = {}
         for host in self.lc_hosts:
-            ret = host.lh_detect_services(services, map_service_host)
-            if ret:
-                logging.error("failed to detect services on host [%s]",
-                              host.sh_hostname)
-                return ret
+            for service_name, service in host.lh_services.iteritems():
+                if service_name in services:
+                    logging.error("two hosts [%s] and [%s] for service [%s]",
+                                  services[service_name].ls_host.sh_hostname,
+                                  host.sh_hostname, service_name)
+                    return -1
+                services[service_name] = service
+                map_service_host[service_name] = host
         self.lc_services = services
         self.lc_map_service_host = map_service_host
+        self.lc_oss_host_list = self.lc_service_hosts(LustreService.TYPE_OST)
+        self.lc_ost_number = 0
+        self.lc_client_number = 0
         for service_name, service in self.lc_services.iteritems():
             logging.debug("itering on service [%s]", service_name)
             if service.ls_service_type == LustreService.TYPE_OST:
@@ -682,81 +953,82 @@ class LustreCluster(object):
                 self.lc_client_number += 1
         return 0
 
-    def lc_check_cpt_for_oss(self):
+    def lc_service_hosts(self, service_type=None):
         """
-        Check whether the cpu_npartitions module param of libcfs is 1
+        Return the hosts that run services of the type, or services of any
+        type if service_type is None. Each host is returned only once.
         """
+        hostnames = []
         hosts = []
         for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != "OST":
+            if (service_type is not None and
+                    service.ls_service_type != service_type):
                 continue
-            if service.ls_host.sh_hostname in hosts:
+            if service.ls_host.sh_hostname in hostnames:
                 continue
             logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_check_cpt()
-            if ret:
-                logging.error("failed to check CPT on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+            hostnames.append(service.ls_host.sh_hostname)
+            hosts.append(service.ls_host)
+        return hosts
+
+    def lc_oss_hosts(self):
+        """
+        Return the hosts that run OST services. The list is kept since
+        the services are detected, and should not be changed.
+        """
+        return self.lc_oss_host_list
+
+    def lc_hosts_run(self, hosts, func, args, description):
+        """
+        Run func(host, *args) on the hosts concurrently and return the
+        aggregate utils.ParallelResult keyed by hostname
+        """
+        key_args = []
+        for host in hosts:
+            key_args.append((host.sh_hostname, (host,) + tuple(args)))
+        result = utils.parallel_run(func, key_args,
+                                    concurrency=self.lc_parallelism,
+                                    timeout=self.lc_parallel_timeout)
+        for hostname in result.pr_failed_keys():
+            logging.error("failed to %s on host [%s], %s", description,
+                          hostname, result.pr_failure_reason(hostname))
+        logging.debug("tried to %s on [%d] hosts in [%f] seconds",
+                      description, len(hosts), result.pr_duration)
+        return result
+
+    def lc_check_cpt_for_oss(self):
+        """
+        Check whether the cpu_npartitions module param of libcfs is 1
+        """
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_check_cpt, (), "check CPT")
+        return result.pr_status()
 
     def lc_enable_fake_io_for_oss(self):
         """
         Enable fake IO on OSS
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_enable_fake_io()
-            if ret:
-                logging.error("failed to enable fake IO on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_enable_fake_io, (),
+                                   "enable fake IO")
+        return result.pr_status()
 
     def lc_clear_loc_for_oss(self):
         """
         Clear LOC, thus fake IO on OSS will be disabled
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_clear_loc()
-            if ret:
-                logging.error("failed to clear LOC on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_clear_loc, (), "clear LOC")
+        return result.pr_status()
 
     def lc_enable_tbf_for_ost_io(self, tbf_type):
         """
         Change the OST IO NRS policy to TBF
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_enable_tbf_for_ost_io(tbf_type)
-            if ret:
-                logging.error("failed to enable TBF for ost_io on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_enable_tbf_for_ost_io,
+                                   (tbf_type,), "enable TBF for ost_io")
+        return result.pr_status()
 
     def lc_set_jobid_var(self, jobid_var):
         """
@@ -783,94 +1055,107 @@ class LustreCluster(object):
         """
         Change the OST IO NRS policy to FIFO
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_enable_fifo_for_ost_io()
-            if ret:
-                logging.error("failed to disable TBF on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_enable_fifo_for_ost_io, (),
+                                   "disable TBF")
+        return result.pr_status()
+
+    def lc_reset_tbf_for_ost_io(self, tbf_type):
+        """
+        Change the OST IO NRS policy to FIFO and then to TBF, so that all
+        the old TBF rules are removed, with one round trip to each host
+        """
+        operations = [{"op": tbf_agent.OPERATION_POLICY, "policy": "fifo"},
+                      {"op": tbf_agent.OPERATION_POLICY,
+                       "policy": "tbf %s" % tbf_type}]
+        results = self.lc_oss_tbf_operations(operations)
+        for hostname, rets in results.iteritems():
+            if rets != [0] * len(operations):
+                logging.error("failed to reset TBF for ost_io on host [%s]",
+                              hostname)
+                return -1
         return 0
 
     def lc_start_tbf_rule(self, name, expression, rate):
         """
         Start a TBF rule
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_start_tbf_rule(name, expression, rate)
-            if ret:
-                logging.error("failed to start TBF rule [%s] on host [%s]",
-                              name, service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_start_tbf_rule,
+                                   (name, expression, rate),
+                                   "start TBF rule [%s]" % name)
+        return result.pr_status()
 
     def lc_stop_tbf_rule(self, name):
         """
-        Start a TBF rule
+        Stop a TBF rule
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_stop_tbf_rule(name)
-            if ret:
-                logging.error("failed to stop TBF rule [%s] on host [%s]",
-                              name, service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_stop_tbf_rule, (name,),
+                                   "stop TBF rule [%s]" % name)
+        return result.pr_status()
 
     def lc_change_tbf_rate(self, name, rate):
         """
         Change rate of a TBF rule
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_service_type != LustreService.TYPE_OST:
-                continue
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_change_tbf_rate(name, rate)
-            if ret:
-                logging.error("failed to start TBF rule [%s] on host [%s]",
-                              name, service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_change_tbf_rate, (name, rate),
+                                   "change rate of TBF rule [%s]" % name)
+        return result.pr_status()
+
+    def lc_tbf_operations(self, host_operations):
+        """
+        Apply TBF operations on hosts concurrently, with one round trip to
+        each host. host_operations is a list of (host, operations). Return
+        the mapping from hostname to the list of the return values of the
+        operations on that host.
+        """
+        key_args = []
+        for host, operations in host_operations:
+            key_args.append((host.sh_hostname, (host, operations)))
+        result = utils.parallel_run(LustreHost.lh_tbf_operations, key_args,
+                                    concurrency=self.lc_parallelism,
+                                    timeout=self.lc_parallel_timeout)
+        host_rets = {}
+        for host, operations in host_operations:
+            hostname = host.sh_hostname
+            if hostname in result.pr_results:
+                host_rets[hostname] = result.pr_results[hostname]
+            else:
+                logging.error("failed to apply [%d] TBF operations on host "
+                              "[%s]", len(operations), hostname)
+                host_rets[hostname] = [-1] * len(operations)
+        return host_rets
+
+    def lc_oss_tbf_operations(self, operations):
+        """
+        Apply the same TBF operations on all OSS, with one round trip to
+        each host. Return the mapping from hostname to the list of the
+        return values.
+        """
+        host_operations = []
+        for host in self.lc_oss_hosts():
+            host_operations.append((host, operations))
+        return self.lc_tbf_operations(host_operations)
+
+    def lc_start_tbf_agents(self):
+        """
+        Start the TBF agents on OSS
+        """
+        result = self.lc_hosts_run(self.lc_oss_hosts(),
+                                   LustreHost.lh_tbf_agent_start, (),
+                                   "start TBF agent")
+        return result.pr_status()
 
     def lc_restart_collectd(self):
         """
         Restart collectd
         """
-        hosts = []
-        for service_name, service in self.lc_services.iteritems():
-            if service.ls_host.sh_hostname in hosts:
-                continue
-            logging.debug("itering on service [%s]", service_name)
-            ret = service.ls_host.lh_restart_collectd()
-            if ret:
-                logging.error("failed to restart collectd on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            hosts.append(service.ls_host.sh_hostname)
-        return 0
+        result = self.lc_hosts_run(self.lc_service_hosts(),
+                                   LustreHost.lh_restart_collectd, (),
+                                   "restart collectd")
+        return result.pr_status()
 
     def lc_benchmark(self):
         """
@@ -0,0 +1,362 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Ingestion of the metrics posted by Collectd
+
+The HTTP handler only queues the raw payload, and a dedicated thread decodes
+the payloads and applies the datapoints in batches.
+"""
+import re
+import sys
+import collections
+import json
+import logging
+import threading
+import time
+import traceback
+
+# local libs
+import utils
+
+# The max number of payloads waiting to be processed
+INGEST_QUEUE_SIZE = 10000
+# The max number of cached TSDB tag strings
+TAGS_CACHE_SIZE = 100000
+# The TSDB name of job stats of OSTs
+TSDB_NAME_OST_JOBSTATS = "ost_jobstats_samples"
+# The operation type of job stats that the rates are computed from
+OPTYPE_SUM_WRITE_BYTES = "sum_write_bytes"
+# The operation types tracked by default
+DEFAULT_OPTYPES = [OPTYPE_SUM_WRITE_BYTES]
+# The identity of a tag string that is not cached
+IDENTITY_UNKNOWN = object()
+# The separator between the metrics in the list of a payload
+METRIC_SEPARATOR = re.compile(r"\}\s*,\s*\{")
+
+
+def tsdb_tags_parse(tsdb_tags, tag_dict):
+    """
+    Parse a TSDB tag string to dictionary
+    """
+    tags = tsdb_tags.split()
+    for tag in tags:
+        pair = tag.split("=")
+        if len(pair) != 2:
+            logging.error("tsdb tags [%s] is invalid", tsdb_tags)
+            return -1
+        tag_dict[pair[0]] = pair[1]
+    return 0
+
+
+def string_intern(string):
+    """
+    Return the interned copy of a string decoded from JSON
+    """
+    try:
+        return intern(str(string))
+    except UnicodeEncodeError:
+        return string
+
+
+class MetricFilter(object):
+    """
+    Filter of the TSDB tags of job stats. The result of each tag string is
+    cached, so the same tag string is only parsed once until the cache is
+    full.
+    """
+    def __init__(self, optypes=None, cache_size=TAGS_CACHE_SIZE):
+        if optypes is None:
+            optypes = DEFAULT_OPTYPES
+        self.mf_optypes = frozenset(optypes)
+        # Any tag string with a tracked optype contains one of these
+        self.mf_patterns = tuple(["optype=%s" % optype
+                                  for optype in optypes])
+        # Mapping from tag string to (service_id, job_id, optype), or None
+        # if the tag string is not tracked. It is cleared when full, which
+        # is cheaper than LRU for every lookup.
+        self.mf_cache = {}
+        self.mf_cache_size = cache_size
+        # Number of lookups hit in the cache
+        self.mf_hit_count = 0
+        # Number of lookups missed in the cache
+        self.mf_miss_count = 0
+
+    def _mf_tags_parse(self, tsdb_tags):
+        """
+        Parse a tag string, return (service_id, job_id, optype) or None
+        """
+        for pattern in self.mf_patterns:
+            if pattern in tsdb_tags:
+                break
+        else:
+            return None
+        tag_dict = {}
+        ret = tsdb_tags_parse(tsdb_tags, tag_dict)
+        if ret:
+            return None
+        try:
+            optype = tag_dict["optype"]
+            if optype not in self.mf_optypes:
+                return None
+            return (string_intern(tag_dict["ost_index"]),
+                    string_intern(tag_dict["job_id"]),
+                    string_intern(optype))
+        except KeyError:
+            logging.error("tsdb tags [%s] has no ost_index or job_id",
+                          tsdb_tags)
+            return None
+
+    def mf_match(self, tsdb_tags):
+        """
+        Return (service_id, job_id, optype) of a tag string, or None if the
+        tag string is not tracked
+        """
+        cache = self.mf_cache
+        result = cache.get(tsdb_tags, IDENTITY_UNKNOWN)
+        if result is not IDENTITY_UNKNOWN:
+            self.mf_hit_count += 1
+            return result
+        self.mf_miss_count += 1
+        result = self._mf_tags_parse(tsdb_tags)
+        if len(cache) >= self.mf_cache_size:
+            cache.clear()
+        cache[tsdb_tags] = result
+        return result
+
+    def mf_candidates(self, payload):
+        """
+        Return the list of the metrics in a payload that might be tracked,
+        decoding only the metrics whose text has a tracked optype. Return
+        None if the payload has to be decoded as a whole.
+        """
+        body = payload.strip()
+        if not body.startswith("[") or not body.endswith("]"):
+            return None
+        body = body[1:-1].strip()
+        if not body.startswith("{") or not body.endswith("}"):
+            return None
+        patterns = self.mf_patterns
+        metrics = []
+        for text in METRIC_SEPARATOR.split(body[1:-1]):
+            for pattern in patterns:
+                if pattern in text:
+                    break
+            else:
+                continue
+            try:
+                metrics.append(json.loads("{" + text + "}"))
+            except ValueError:
+                # A string has the separator, so the text is not a metric
+                return None
+        return metrics
+
+    def mf_stats(self):
+        """
+        Return the statistics of the filter
+        """
+        return {"cached": len(self.mf_cache),
+                "hits": self.mf_hit_count,
+                "misses": self.mf_miss_count}
+
+
+class MetricIngester(object):
+    """
+    The ingester of the metrics posted by Collectd
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, received_func, queue_size=INGEST_QUEUE_SIZE,
+                 debug=False, optypes=None, consume_thread=True):
+        # The function to call with a list of datapoints, each datapoint is
+        # a tuple of (service_id, job_id, timestamp, value, optype)
+        self.mi_received_func = received_func
+        self.mi_filter = MetricFilter(optypes)
+        self.mi_queue = collections.deque()
+        self.mi_queue_size = queue_size
+        self.mi_condition = threading.Condition()
+        # Whether to dump every metric to debug log
+        self.mi_debug = debug
+        # Number of payloads dropped because the queue is full
+        self.mi_dropped_count = 0
+        # Number of payloads that are not valid
+        self.mi_invalid_count = 0
+        # Number of datapoints applied
+        self.mi_datapoint_count = 0
+        # Number of batches that raised exceptions when being consumed
+        self.mi_exception_count = 0
+        # If consume_thread is False, the payloads are only consumed by
+        # mi_consume()
+        if consume_thread:
+            utils.thread_start(self.mi_consume_thread, ())
+
+    def mi_post(self, payload):
+        """
+        Queue a payload posted by Collectd. Return 0 if queued, -1 if
+        dropped.
+        """
+        if not payload:
+            self.mi_invalid_count += 1
+            return -1
+        self.mi_condition.acquire()
+        if len(self.mi_queue) >= self.mi_queue_size:
+            self.mi_dropped_count += 1
+            self.mi_condition.release()
+            return -1
+        self.mi_queue.append(payload)
+        self.mi_condition.notify()
+        self.mi_condition.release()
+        return 0
+
+    def mi_parse(self, payload, datapoints):
+        """
+        Decode a payload and append its datapoints
+        """
+        # pylint: disable=too-many-branches
+        # Skip decoding payloads that have no job stats of OST at all
+        if TSDB_NAME_OST_JOBSTATS not in payload:
+            return 0
+        metrics = None
+        if not self.mi_debug:
+            metrics = self.mi_filter.mf_candidates(payload)
+        if metrics is None:
+            try:
+                metrics = json.loads(payload)
+            except ValueError:
+                logging.error("invalid metric payload [%s]", payload)
+                self.mi_invalid_count += 1
+                return -1
+        if not isinstance(metrics, list):
+            logging.error("metric payload [%s] is not a list", payload)
+            self.mi_invalid_count += 1
+            return -1
+        if self.mi_debug:
+            logging.debug(json.dumps(metrics, indent=4))
+        tags_match = self.mi_filter.mf_match
+        for metric in metrics:
+            try:
+                meta = metric["meta"]
+                if meta["tsdb_name"] != TSDB_NAME_OST_JOBSTATS:
+                    continue
+                identity = tags_match(meta["tsdb_tags"])
+                if identity is None:
+                    continue
+                service_id, job_id, optype = identity
+                value = metric["values"][0]
+                timestamp = metric["time"]
+            except (KeyError, IndexError, TypeError):
+                logging.error("invalid metric [%s]", metric)
+                self.mi_invalid_count += 1
+                continue
+            if self.mi_debug:
+                logging.debug(json.dumps(metric, indent=4))
+                logging.debug("service_id :%s, job_id: %s, optype: %s, "
+                              "time: %d, value: %d", service_id, job_id,
+                              optype, timestamp, value)
+            datapoints.append((service_id, job_id, timestamp, value,
+                               optype))
+        return 0
+
+    def mi_consume(self, wait=True):
+        """
+        Decode all the queued payloads and apply their datapoints in one
+        batch
+        """
+        self.mi_condition.acquire()
+        while wait and len(self.mi_queue) == 0:
+            self.mi_condition.wait()
+        payloads = self.mi_queue
+        self.mi_queue = collections.deque()
+        self.mi_condition.release()
+
+        datapoints = []
+        for payload in payloads:
+            self.mi_parse(payload, datapoints)
+        if len(datapoints) != 0:
+            self.mi_received_func(datapoints)
+            self.mi_datapoint_count += len(datapoints)
+
+    def mi_consume_thread(self):
+        """
+        The thread that consumes the queued payloads
+        """
+        # pylint: disable=bare-except
+        while True:
+            try:
+                self.mi_consume()
+            except:
+                logging.error("exception when consuming metric payloads: "
+                              "[%s]", traceback.format_exc())
+                self.mi_exception_count += 1
+
+    def mi_stats(self):
+        """
+        Return the statistics of the ingester
+        """
+        return {"queued": len(self.mi_queue),
+                "dropped": self.mi_dropped_count,
+                "invalid": self.mi_invalid_count,
+                "datapoints": self.mi_datapoint_count,
+                "exceptions": self.mi_exception_count,
+                "filter": self.mi_filter.mf_stats()}
+
+
+def benchmark_payload(job_number, optypes, ost_index="OST0000"):
+    """
+    Build a payload of job stats like what Collectd posts
+    """
+    metrics = []
+    for index in range(job_number):
+        for optype in optypes:
+            tags = ("optype=%s fs_name=lime ost_index=%s job_id=dd.%d" %
+                    (optype, ost_index, index))
+            metrics.append({"values": [index * 1048576],
+                            "dstypes": ["derive"], "dsnames": ["value"],
+                            "time": 1500000000.0, "interval": 1.0,
+                            "host": "server1", "plugin": "lustre",
+                            "plugin_instance": "lime-%s" % ost_index,
+                            "type": optype, "type_instance": "dd.%d" % index,
+                            "meta": {"tsdb_name": TSDB_NAME_OST_JOBSTATS,
+                                     "tsdb_tags": tags}})
+    return json.dumps(metrics)
+
+
+def benchmark_parse(seconds=3):
+    """
+    Measure the number of metrics that the ingester parses per second, when
+    only one of the optypes in the payloads is tracked
+    """
+    optypes = ["read_bytes", "write_bytes", "sum_read_bytes",
+               OPTYPE_SUM_WRITE_BYTES, "getattr", "setattr", "punch",
+               "sync", "destroy", "create"]
+    payloads = []
+    for ost_index in range(8):
+        payloads.append(benchmark_payload(100, optypes,
+                                          "OST%04x" % ost_index))
+    metric_number = 100 * len(optypes) * len(payloads)
+    results = []
+    for prefilter in [False, True]:
+        ingester = MetricIngester(lambda datapoints: None,
+                                  consume_thread=False)
+        if not prefilter:
+            # Decode every payload as a whole
+            ingester.mi_filter.mf_candidates = lambda payload: None
+        metrics = 0
+        start_time = time.time()
+        while time.time() - start_time < seconds:
+            datapoints = []
+            for payload in payloads:
+                ingester.mi_parse(payload, datapoints)
+            metrics += metric_number
+        duration = time.time() - start_time
+        results.append(datapoints)
+        print("prefilter %s: parsed %d metrics with %d tracked in %.2f "
+              "seconds, %d metrics per second" %
+              (prefilter, metrics, len(datapoints), duration,
+               metrics / duration))
+    if results[0] != results[1]:
+        print("the datapoints parsed with prefilter are different")
+        return -1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(benchmark_parse())
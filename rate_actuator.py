@@ -0,0 +1,341 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Actuator that applies TBF rate changes to hosts asynchronously
+
+Policies queue rate changes of (host, TBF rule) to the actuator and never
+wait for the remote writes. Changes to the rate that is already applied are
+dropped, and multiple pending changes of the same rule are coalesced to the
+final value. A change that fails to be written is queued again, for at most
+FLUSH_MAX_RETRIES times. After that, it is given up and reported by
+ra_failures_take(), so that the caller can stop assuming the rate.
+
+If the actuator is asynchronous, each host is flushed by its own thread, so
+a slow host doesn't delay the others. Otherwise, the changes are written
+when ra_flush() is called, which waits for all hosts.
+"""
+import collections
+import logging
+import threading
+import time
+import traceback
+
+# local libs
+import tbf_agent
+import utils
+
+# Seconds to wait before flushing again after a flush failed or raised an
+# exception
+FLUSH_RETRY_INTERVAL = 1
+# The max number of times to write a change again after it failed
+FLUSH_MAX_RETRIES = 3
+
+
+class HostActuator(object):
+    """
+    Each host has an object of HostActuator to track its TBF rates
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host):
+        self.ha_host = host
+        # Mapping from TBF rule name to the rate waiting to be applied
+        self.ha_pending = collections.OrderedDict()
+        # Mapping from TBF rule name to the rate applied on the host
+        self.ha_applied = {}
+        # Mapping from TBF rule name to [retries, rate_before] of the change
+        # that failed to be written, rate_before is the rate applied before
+        # the change, or None if unknown
+        self.ha_retries = {}
+        # The changes given up, each is (name, rate, rate_before)
+        self.ha_failures = []
+        self.ha_condition = threading.Condition()
+        self.ha_thread = None
+        # Number of rate changes written to the host
+        self.ha_write_count = 0
+        # Number of rate changes dropped because the rate is already applied
+        self.ha_suppressed_count = 0
+        # Number of rate changes replaced by a later change of the same rule
+        self.ha_coalesced_count = 0
+        # Number of rate changes failed to be written to the host
+        self.ha_failure_count = 0
+        # Number of rate changes given up after all the retries failed
+        self.ha_given_up_count = 0
+        # Number of flushes that raised exceptions
+        self.ha_exception_count = 0
+
+    def ha_rate_change(self, name, rate):
+        """
+        Queue a rate change of a TBF rule. Return True if the host needs to
+        be flushed.
+        """
+        self.ha_condition.acquire()
+        if name in self.ha_pending:
+            self.ha_coalesced_count += 1
+            if self.ha_applied.get(name) == rate:
+                del self.ha_pending[name]
+            else:
+                self.ha_pending[name] = rate
+        elif self.ha_applied.get(name) == rate:
+            self.ha_suppressed_count += 1
+        else:
+            self.ha_pending[name] = rate
+        need_flush = len(self.ha_pending) != 0
+        if need_flush:
+            self.ha_condition.notify()
+        self.ha_condition.release()
+        return need_flush
+
+    def ha_rule_started(self, name, rate):
+        """
+        A TBF rule has been started with the rate on the host
+        """
+        self.ha_condition.acquire()
+        if name in self.ha_pending:
+            del self.ha_pending[name]
+        if name in self.ha_retries:
+            del self.ha_retries[name]
+        self.ha_applied[name] = rate
+        self.ha_condition.release()
+
+    def ha_rule_stopped(self, name):
+        """
+        A TBF rule has been stopped on the host
+        """
+        self.ha_condition.acquire()
+        if name in self.ha_pending:
+            del self.ha_pending[name]
+        if name in self.ha_applied:
+            del self.ha_applied[name]
+        if name in self.ha_retries:
+            del self.ha_retries[name]
+        self.ha_condition.release()
+
+    def _ha_pending_take(self, wait):
+        """
+        Take all the pending changes. If wait is True, wait until there is
+        any pending change.
+        """
+        self.ha_condition.acquire()
+        while wait and len(self.ha_pending) == 0:
+            self.ha_condition.wait()
+        pending = self.ha_pending
+        self.ha_pending = collections.OrderedDict()
+        self.ha_condition.release()
+        return pending
+
+    def _ha_pending_restore(self, pending):
+        """
+        Queue the changes that were taken but not written again, unless
+        they have been replaced by later changes
+        """
+        self.ha_condition.acquire()
+        for name, rate in pending.iteritems():
+            # The rate on the host is unknown
+            if name in self.ha_applied:
+                del self.ha_applied[name]
+            if name not in self.ha_pending:
+                self.ha_pending[name] = rate
+        self.ha_condition.release()
+
+    def ha_flush(self, wait=False):
+        """
+        Write the pending changes to the host in one batch
+        """
+        # pylint: disable=bare-except
+        pending = self._ha_pending_take(wait)
+        operations = []
+        for name, rate in pending.iteritems():
+            operations.append({"op": tbf_agent.OPERATION_CHANGE,
+                               "name": name,
+                               "rate": rate})
+        if len(operations) == 0:
+            return 0
+        try:
+            rets = self.ha_host.lh_tbf_operations(operations)
+        except:
+            self._ha_pending_restore(pending)
+            raise
+        logging.debug("wrote [%d] TBF rate changes to host [%s]",
+                      len(operations), self.ha_host.sh_hostname)
+
+        ret = 0
+        self.ha_condition.acquire()
+        for operation, operation_ret in zip(operations, rets):
+            name = operation["name"]
+            if operation_ret:
+                self._ha_failure(name, operation["rate"])
+                ret = -1
+            else:
+                self.ha_applied[name] = operation["rate"]
+                if name in self.ha_retries:
+                    del self.ha_retries[name]
+                self.ha_write_count += 1
+        self.ha_condition.release()
+        return ret
+
+    def _ha_failure(self, name, rate):
+        """
+        A change failed to be written, queue it again unless it has been
+        replaced by a later change or retried too many times. The caller
+        should hold the condition.
+        """
+        self.ha_failure_count += 1
+        retry = self.ha_retries.get(name)
+        if retry is None:
+            retry = [0, self.ha_applied.get(name)]
+            self.ha_retries[name] = retry
+        # The rate on the host is unknown now, so do not suppress the next
+        # change of the rule
+        if name in self.ha_applied:
+            del self.ha_applied[name]
+        if name in self.ha_pending:
+            return
+        if retry[0] < FLUSH_MAX_RETRIES:
+            retry[0] += 1
+            self.ha_pending[name] = rate
+            return
+        logging.error("failed to change rate of TBF rule [%s] to [%s] on "
+                      "host [%s] after [%d] retries, giving up", name, rate,
+                      self.ha_host.sh_hostname, retry[0])
+        del self.ha_retries[name]
+        self.ha_failures.append((name, rate, retry[1]))
+        self.ha_given_up_count += 1
+
+    def ha_failures_take(self):
+        """
+        Take the changes given up, each is (name, rate, rate_before)
+        """
+        self.ha_condition.acquire()
+        failures = self.ha_failures
+        self.ha_failures = []
+        self.ha_condition.release()
+        return failures
+
+    def ha_flush_thread(self):
+        """
+        The thread that flushes the pending changes of the host
+        """
+        # pylint: disable=bare-except
+        while True:
+            try:
+                ret = self.ha_flush(wait=True)
+                # Do not retry the failed changes immediately
+                if ret:
+                    time.sleep(FLUSH_RETRY_INTERVAL)
+            except:
+                logging.error("exception when flushing TBF rates to host "
+                              "[%s]: [%s]", self.ha_host.sh_hostname,
+                              traceback.format_exc())
+                self.ha_exception_count += 1
+                time.sleep(FLUSH_RETRY_INTERVAL)
+
+    def ha_stats(self):
+        """
+        Return the statistics of the host
+        """
+        return {"writes": self.ha_write_count,
+                "suppressed": self.ha_suppressed_count,
+                "coalesced": self.ha_coalesced_count,
+                "failures": self.ha_failure_count,
+                "given_up": self.ha_given_up_count,
+                "exceptions": self.ha_exception_count,
+                "pending": len(self.ha_pending)}
+
+
+class RateActuator(object):
+    """
+    The actuator of the TBF rates on all hosts
+    """
+    def __init__(self, asynchronous=True):
+        # If asynchronous is False, the changes are only written by
+        # ra_flush()
+        self.ra_asynchronous = asynchronous
+        # Mapping from hostname to HostActuator
+        self.ra_hosts = {}
+        self.ra_condition = threading.Condition()
+
+    def _ra_host_actuator(self, host):
+        """
+        Return the actuator of a host, create it if not exist
+        """
+        self.ra_condition.acquire()
+        hostname = host.sh_hostname
+        if hostname in self.ra_hosts:
+            host_actuator = self.ra_hosts[hostname]
+        else:
+            host_actuator = HostActuator(host)
+            self.ra_hosts[hostname] = host_actuator
+        self.ra_condition.release()
+        return host_actuator
+
+    def ra_rate_change(self, host, name, rate):
+        """
+        Queue a rate change of a TBF rule on a host. The change will be
+        written to the host later.
+        """
+        host_actuator = self._ra_host_actuator(host)
+        need_flush = host_actuator.ha_rate_change(name, rate)
+        if need_flush and self.ra_asynchronous:
+            self.ra_condition.acquire()
+            if host_actuator.ha_thread is None:
+                host_actuator.ha_thread = \
+                    utils.thread_start(host_actuator.ha_flush_thread, ())
+            self.ra_condition.release()
+        return 0
+
+    def ra_rule_started(self, hosts, name, rate):
+        """
+        A TBF rule has been started with the rate on the hosts
+        """
+        for host in hosts:
+            self._ra_host_actuator(host).ha_rule_started(name, rate)
+
+    def ra_rule_stopped(self, name):
+        """
+        A TBF rule has been stopped on all hosts
+        """
+        self.ra_condition.acquire()
+        host_actuators = self.ra_hosts.values()
+        self.ra_condition.release()
+        for host_actuator in host_actuators:
+            host_actuator.ha_rule_stopped(name)
+
+    def ra_flush(self):
+        """
+        Write all the pending changes of all hosts concurrently, and wait
+        until finished
+        """
+        self.ra_condition.acquire()
+        key_args = []
+        for hostname, host_actuator in self.ra_hosts.iteritems():
+            key_args.append((hostname, (host_actuator,)))
+        self.ra_condition.release()
+        result = utils.parallel_run(HostActuator.ha_flush, key_args)
+        return result.pr_status()
+
+    def ra_failures_take(self):
+        """
+        Take the changes given up on all hosts, each is (host, name, rate,
+        rate_before)
+        """
+        self.ra_condition.acquire()
+        host_actuators = self.ra_hosts.values()
+        self.ra_condition.release()
+        failures = []
+        for host_actuator in host_actuators:
+            for name, rate, rate_before in host_actuator.ha_failures_take():
+                failures.append((host_actuator.ha_host, name, rate,
+                                 rate_before))
+        return failures
+
+    def ra_stats(self):
+        """
+        Return the statistics of all hosts
+        """
+        self.ra_condition.acquire()
+        stats = {}
+        for hostname, host_actuator in self.ra_hosts.iteritems():
+            stats[hostname] = host_actuator.ha_stats()
+        self.ra_condition.release()
+        return stats
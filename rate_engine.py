@@ -0,0 +1,438 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Array backed computation of the rates of jobs on services
+
+The counters, timestamps and rates of all the (job, service) pairs are kept
+in 2D arrays, with a row for each watched job and a column for each
+(service_id, optype). Batches of datapoints from the ingestion are applied
+with a few vectorized operations, and the rates of jobs and hosts are summed
+up with vectorized reductions, instead of walking an object for each pair.
+
+The rate of a pair is computed the same way as the scalar code did for each
+datapoint:
+
+    if the pair has a previous datapoint, and the value is not less than the
+    previous value, and the timestamp is later than the previous timestamp:
+        rate = (value - previous value) / (time difference) / 1000000
+    the datapoint becomes the previous datapoint
+
+So if a counter overflows or is reset, the rate is kept unchanged for one
+interval. The datapoints of a pair in a batch are applied in the order they
+are received. The counters are kept as doubles, which are exact up to 2^53.
+"""
+import sys
+import time
+import logging
+import operator
+import itertools
+import numpy
+
+# The initial number of rows and columns of the arrays
+ENGINE_INITIAL_ROWS = 64
+ENGINE_INITIAL_COLUMNS = 64
+# Divisor to convert the rates of counters to MB/s
+RATE_UNIT = 1000000
+# The fields of (service_id, job_id, timestamp, value, optype)
+DATAPOINT_JOB_ID = operator.itemgetter(1)
+DATAPOINT_TIME = operator.itemgetter(2)
+DATAPOINT_VALUE = operator.itemgetter(3)
+DATAPOINT_KEY = operator.itemgetter(0, 4)
+
+
+def array_resize(array, rows, columns):
+    """
+    Return a copy of a 2D array with a new shape, the new cells are NaN
+    """
+    resized = numpy.full((rows, columns), numpy.nan)
+    old_rows, old_columns = array.shape
+    resized[:old_rows, :old_columns] = array
+    return resized
+
+
+class RateEngine(object):
+    """
+    The rates of all jobs on all services
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host_func):
+        # The function to return the hostname of a service ID, or None if
+        # the service is unknown
+        self.re_host_func = host_func
+        # Mapping from job ID to row
+        self.re_rows = {}
+        # The job ID of each row, None if the row is free
+        self.re_row_jobs = []
+        self.re_free_rows = []
+        # Mapping from (service_id, optype) to column
+        self.re_columns = {}
+        # The (service_id, optype) of each column
+        self.re_column_keys = []
+        # The (hostname, service_id, optype) of each column
+        self.re_column_service_keys = []
+        # The host index of each column
+        self.re_column_hosts = numpy.zeros(ENGINE_INITIAL_COLUMNS,
+                                           dtype=numpy.intp)
+        # Mapping from hostname to host index
+        self.re_hosts = {}
+        self.re_hostnames = []
+        shape = (ENGINE_INITIAL_ROWS, ENGINE_INITIAL_COLUMNS)
+        # The previous timestamps, values and the rates of the pairs, NaN if
+        # there is none
+        self.re_times = numpy.full(shape, numpy.nan)
+        self.re_values = numpy.full(shape, numpy.nan)
+        self.re_rates = numpy.full(shape, numpy.nan)
+        # The time that each row got a changed counter or was added
+        self.re_active_times = numpy.zeros(ENGINE_INITIAL_ROWS)
+        # Number of datapoints applied
+        self.re_datapoint_count = 0
+        # Number of datapoints of unknown services
+        self.re_unknown_count = 0
+
+    def _re_resize(self, rows, columns):
+        """
+        Grow the arrays to at least the given number of rows and columns
+        """
+        old_rows, old_columns = self.re_times.shape
+        if rows <= old_rows and columns <= old_columns:
+            return
+        while old_rows < rows:
+            old_rows *= 2
+        while old_columns < columns:
+            old_columns *= 2
+        self.re_times = array_resize(self.re_times, old_rows, old_columns)
+        self.re_values = array_resize(self.re_values, old_rows, old_columns)
+        self.re_rates = array_resize(self.re_rates, old_rows, old_columns)
+        column_hosts = numpy.zeros(old_columns, dtype=numpy.intp)
+        column_hosts[:len(self.re_column_keys)] = \
+            self.re_column_hosts[:len(self.re_column_keys)]
+        self.re_column_hosts = column_hosts
+        active_times = numpy.zeros(old_rows)
+        active_times[:len(self.re_row_jobs)] = \
+            self.re_active_times[:len(self.re_row_jobs)]
+        self.re_active_times = active_times
+
+    def re_job_add(self, job_id):
+        """
+        Add a row for a job
+        """
+        if job_id in self.re_rows:
+            return
+        if len(self.re_free_rows) != 0:
+            row = self.re_free_rows.pop()
+            self.re_row_jobs[row] = job_id
+        else:
+            row = len(self.re_row_jobs)
+            self._re_resize(row + 1, len(self.re_column_keys))
+            self.re_row_jobs.append(job_id)
+        self.re_rows[job_id] = row
+        self.re_active_times[row] = time.time()
+
+    def re_job_remove(self, job_id):
+        """
+        Free the row of a job
+        """
+        row = self.re_rows.pop(job_id, None)
+        if row is None:
+            return
+        self.re_times[row] = numpy.nan
+        self.re_values[row] = numpy.nan
+        self.re_rates[row] = numpy.nan
+        self.re_row_jobs[row] = None
+        self.re_free_rows.append(row)
+
+    def _re_column_add(self, key):
+        """
+        Add a column for a (service_id, optype), return -1 if the service is
+        unknown
+        """
+        hostname = self.re_host_func(key[0])
+        if hostname is None:
+            return -1
+        if hostname not in self.re_hosts:
+            self.re_hosts[hostname] = len(self.re_hostnames)
+            self.re_hostnames.append(hostname)
+        column = len(self.re_column_keys)
+        self._re_resize(len(self.re_row_jobs), column + 1)
+        self.re_column_hosts[column] = self.re_hosts[hostname]
+        self.re_column_keys.append(key)
+        self.re_column_service_keys.append((hostname, key[0], key[1]))
+        self.re_columns[key] = column
+        return column
+
+    def re_datapoints_add(self, datapoints):
+        """
+        Apply a batch of datapoints, each datapoint is a tuple of
+        (service_id, job_id, timestamp, value, optype). The datapoints of
+        jobs that are not added are ignored. Return the list of
+        (job_id, service_id, optype) that got their first datapoints.
+        """
+        # pylint: disable=too-many-locals
+        number = len(datapoints)
+        if number == 0:
+            return []
+        # Split the fields with C loops rather than a Python loop
+        missing = itertools.repeat(-1, number)
+        rows = numpy.array(map(self.re_rows.get,
+                               map(DATAPOINT_JOB_ID, datapoints), missing),
+                           dtype=numpy.intp)
+        keys = map(DATAPOINT_KEY, datapoints)
+        missing = itertools.repeat(-1, number)
+        columns = numpy.array(map(self.re_columns.get, keys, missing),
+                              dtype=numpy.intp)
+        wanted = rows >= 0
+        # Add the columns of the new services of watched jobs
+        for index in numpy.nonzero(wanted & (columns < 0))[0].tolist():
+            key = keys[index]
+            column = self.re_columns.get(key, -1)
+            if column < 0:
+                column = self._re_column_add(key)
+                if column < 0:
+                    self.re_unknown_count += 1
+                    wanted[index] = False
+                    continue
+            columns[index] = column
+        indexes = numpy.nonzero(wanted)[0]
+        number = len(indexes)
+        if number == 0:
+            return []
+        self.re_datapoint_count += number
+
+        # Sort the datapoints by pair, keeping the order of the datapoints
+        # of each pair
+        width = self.re_times.shape[1]
+        cells = rows[indexes] * width + columns[indexes]
+        order = numpy.argsort(cells, kind="mergesort")
+        cells = cells[order]
+        indexes = indexes[order]
+        times = numpy.array(map(DATAPOINT_TIME, datapoints),
+                            dtype=numpy.float64)[indexes]
+        values = numpy.array(map(DATAPOINT_VALUE, datapoints),
+                             dtype=numpy.float64)[indexes]
+        first = numpy.ones(number, dtype=bool)
+        first[1:] = cells[1:] != cells[:-1]
+        last = numpy.ones(number, dtype=bool)
+        last[:-1] = first[1:]
+
+        # The previous datapoint of each datapoint is the one before it in
+        # the batch, or the saved one for the first datapoint of a pair
+        flat_times = self.re_times.reshape(-1)
+        flat_values = self.re_values.reshape(-1)
+        flat_rates = self.re_rates.reshape(-1)
+        first_cells = cells[first]
+        prev_times = numpy.empty(number)
+        prev_times[1:] = times[:-1]
+        prev_times[first] = flat_times[first_cells]
+        prev_values = numpy.empty(number)
+        prev_values[1:] = values[:-1]
+        prev_values[first] = flat_values[first_cells]
+        with numpy.errstate(invalid="ignore"):
+            valid = (values >= prev_values) & (times > prev_times)
+
+        # The rate of a pair is computed from its last valid datapoint
+        valid_indexes = numpy.nonzero(valid)[0]
+        if len(valid_indexes) != 0:
+            valid_cells = cells[valid_indexes]
+            valid_last = numpy.ones(len(valid_indexes), dtype=bool)
+            valid_last[:-1] = valid_cells[1:] != valid_cells[:-1]
+            selected = valid_indexes[valid_last]
+            flat_rates[cells[selected]] = \
+                ((values[selected] - prev_values[selected]) /
+                 (times[selected] - prev_times[selected]) / RATE_UNIT)
+
+        new_cells = first_cells[numpy.isnan(prev_times[first])]
+        # A job is active if any of its counters changed, NaN never equals
+        changed_cells = cells[values != prev_values]
+        self.re_active_times[changed_cells // width] = time.time()
+        flat_times[cells[last]] = times[last]
+        flat_values[cells[last]] = values[last]
+
+        added = []
+        for cell in new_cells.tolist():
+            row, column = divmod(cell, width)
+            service_id, optype = self.re_column_keys[column]
+            added.append((self.re_row_jobs[row], service_id, optype))
+        return added
+
+    def re_idle_jobs(self, before):
+        """
+        Return the IDs of the jobs that have not been active since a time
+        """
+        row_number = len(self.re_row_jobs)
+        rows = numpy.nonzero(self.re_active_times[:row_number] < before)[0]
+        row_jobs = self.re_row_jobs
+        return [row_jobs[row] for row in rows.tolist()
+                if row_jobs[row] is not None]
+
+    def re_job_rates(self):
+        """
+        Return a dict from job ID to a dict of "rate", "hosts" which maps
+        hostname to rate, and "services" which maps (hostname, service_id,
+        optype) to rate. The hosts that have any datapoint of the job are
+        included, even if no rate is computed yet.
+        """
+        # pylint: disable=too-many-locals
+        row_number = len(self.re_row_jobs)
+        column_number = len(self.re_column_keys)
+        host_number = len(self.re_hostnames)
+        result = {}
+        for job_id in self.re_rows:
+            result[job_id] = {"rate": 0, "hosts": {}, "services": {}}
+        if row_number == 0 or column_number == 0:
+            return result
+        rates = self.re_rates[:row_number, :column_number]
+        has_rate = ~numpy.isnan(rates)
+        filled = numpy.where(has_rate, rates, 0.0)
+        job_rates = filled.sum(axis=1).tolist()
+
+        # Sum up the rates of each (job, host) with one bincount
+        column_hosts = self.re_column_hosts[:column_number]
+        indexes = (numpy.arange(row_number)[:, numpy.newaxis] * host_number +
+                   column_hosts[numpy.newaxis, :]).reshape(-1)
+        host_rates = numpy.bincount(indexes, weights=filled.reshape(-1),
+                                    minlength=row_number * host_number)
+        seen = ~numpy.isnan(self.re_times[:row_number, :column_number])
+        host_seen = numpy.bincount(indexes, weights=seen.reshape(-1),
+                                   minlength=row_number * host_number)
+        host_rates = host_rates.reshape(row_number, host_number)
+        host_seen = host_seen.reshape(row_number, host_number)
+
+        hostnames = self.re_hostnames
+        service_keys = self.re_column_service_keys
+        for job_id, row in self.re_rows.iteritems():
+            job_result = result[job_id]
+            job_result["rate"] = job_rates[row]
+            hosts = numpy.nonzero(host_seen[row])[0]
+            job_result["hosts"] = dict(zip(
+                map(hostnames.__getitem__, hosts.tolist()),
+                host_rates[row, hosts].tolist()))
+            columns = numpy.nonzero(has_rate[row])[0]
+            job_result["services"] = dict(zip(
+                map(service_keys.__getitem__, columns.tolist()),
+                rates[row, columns].tolist()))
+        return result
+
+    def re_stats(self):
+        """
+        Return the statistics of the engine
+        """
+        return {"jobs": len(self.re_rows),
+                "columns": len(self.re_column_keys),
+                "hosts": len(self.re_hostnames),
+                "shape": list(self.re_times.shape),
+                "bytes": (self.re_times.nbytes + self.re_values.nbytes +
+                          self.re_rates.nbytes),
+                "datapoints": self.re_datapoint_count,
+                "unknown": self.re_unknown_count}
+
+
+def scalar_datapoints_add(pairs, datapoints):
+    """
+    Apply datapoints one by one to a dict from (job_id, service_id, optype)
+    to [timestamp, value, rate], to check the results of the engine
+    """
+    for service_id, job_id, timestamp, value, optype in datapoints:
+        key = (job_id, service_id, optype)
+        if key not in pairs:
+            pairs[key] = [None, None, None]
+        pair = pairs[key]
+        if (pair[0] is not None and value >= pair[1] and
+                timestamp > pair[0]):
+            pair[2] = float(value - pair[1]) / (timestamp - pair[0]) / \
+                RATE_UNIT
+        pair[0] = timestamp
+        pair[1] = value
+
+
+def scalar_job_rates(pairs, host_func):
+    """
+    Sum up the rates of the pairs by job and host one by one
+    """
+    job_rates = {}
+    for (job_id, service_id, _), pair in pairs.iteritems():
+        if job_id not in job_rates:
+            job_rates[job_id] = [0, {}]
+        job_rate = job_rates[job_id]
+        hostname = host_func(service_id)
+        host_rate = job_rate[1].get(hostname, 0)
+        if pair[2] is not None:
+            job_rate[0] += pair[2]
+            host_rate += pair[2]
+        job_rate[1][hostname] = host_rate
+    return job_rates
+
+
+def benchmark_datapoints(job_number, ost_number, timestamp, counters):
+    """
+    Return the datapoints of one interval of all jobs on all OSTs
+    """
+    datapoints = []
+    for ost_index in range(ost_number):
+        service_id = "OST%04x" % ost_index
+        for job_index in range(job_number):
+            job_id = "dd.%d" % job_index
+            key = (job_index, ost_index)
+            value = counters.get(key, 0) + (job_index + 1) * 1048576
+            # Reset a few counters to exercise the overflow handling
+            if (job_index + ost_index + int(timestamp)) % 97 == 0:
+                value = 0
+            counters[key] = value
+            datapoints.append((service_id, job_id, timestamp, value,
+                               "sum_write_bytes"))
+    return datapoints
+
+
+def benchmark_engine(job_number=2000, ost_number=200, intervals=5):
+    """
+    Compare the engine with the scalar computation, and measure the time
+    of applying the datapoints and summing up the rates
+    """
+    # pylint: disable=too-many-locals
+    hostnames = {}
+    for ost_index in range(ost_number):
+        hostnames["OST%04x" % ost_index] = "oss%d" % (ost_index % 8)
+    engine = RateEngine(hostnames.get)
+    for job_index in range(job_number):
+        engine.re_job_add("dd.%d" % job_index)
+    pairs = {}
+    counters = {}
+    engine_time = 0
+    scalar_time = 0
+    for interval in range(intervals):
+        datapoints = benchmark_datapoints(job_number, ost_number,
+                                          1000.0 + interval, counters)
+        start_time = time.time()
+        engine.re_datapoints_add(datapoints)
+        job_rates = engine.re_job_rates()
+        engine_time += time.time() - start_time
+        start_time = time.time()
+        scalar_datapoints_add(pairs, datapoints)
+        scalar_rates = scalar_job_rates(pairs, hostnames.get)
+        scalar_time += time.time() - start_time
+
+    mismatches = 0
+    for (job_id, service_id, optype), pair in pairs.iteritems():
+        services = job_rates[job_id]["services"]
+        hostname = hostnames[service_id]
+        rate = services.get((hostname, service_id, optype))
+        if rate != pair[2] and abs(rate - pair[2]) > 1e-9 * abs(pair[2]):
+            mismatches += 1
+    for job_id, (rate, host_rates) in scalar_rates.iteritems():
+        if (abs(job_rates[job_id]["rate"] - rate) > 1e-9 * rate or
+                sorted(job_rates[job_id]["hosts"]) != sorted(host_rates)):
+            mismatches += 1
+    datapoint_number = job_number * ost_number * intervals
+    print("%d jobs x %d OSTs, %d datapoints, %d mismatches" %
+          (job_number, ost_number, datapoint_number, mismatches))
+    print("engine: %.3f seconds, %d datapoints per second, %d bytes" %
+          (engine_time, datapoint_number / engine_time,
+           engine.re_stats()["bytes"]))
+    print("scalar: %.3f seconds, %d datapoints per second" %
+          (scalar_time, datapoint_number / scalar_time))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    benchmark_engine()
+    sys.exit(0)
@@ -0,0 +1,760 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+History of the rates of jobs, hosts and OSTs
+
+Each series is identified by (job_id, hostname, service_id, metric). The
+levels of series are:
+
+    job:  (job_id, None, None, metric), metric is "rate" or "limit"
+    host: (job_id, hostname, None, metric), metric is "rate" or "limit"
+    OST:  (job_id, hostname, service_id, optype)
+
+The series of a level are stored column by column. Each level has a ring of
+slots, one slot for each snapshot of the rate task, and the values of all
+its series are kept in a 2D array of (slot, row), with a row for each
+series. A snapshot is written with one vectorized assignment of the slot,
+and the series without datapoint in the snapshot are NaN in that slot. The
+arrays are allocated with zeros and filled slot by slot, so the memory of
+the slots is only touched when the ring gets to them.
+
+The job level is recorded by default. The host level has series for each
+job on each host, and the OST level for each (job, OST) pair, which are
+many more than the series of jobs, so they are only recorded if enabled.
+
+Besides the datapoints, each level has rollup tiers of coarser resolutions,
+e.g. 10 seconds, 1 minute and 10 minutes. Each bucket of a tier keeps the
+min, max, average and last value of the datapoints in it. When a bucket is
+closed, it is reduced with vectorized operations of all series from the
+datapoints, or from the buckets of the finer tier, so recording a snapshot
+only writes a slot of datapoints in most ticks. Each tier has its own
+retention, so long ranges can be kept without keeping every datapoint. A
+query uses the datapoints or a tier whose retention covers its range, and
+can ask for a number of points to use the coarsest of them that still
+gives that many points in the range.
+
+Run this file to measure the time of recording the snapshots.
+"""
+import sys
+import math
+import time
+import itertools
+import threading
+import collections
+import numpy
+
+# The default seconds of datapoints kept in each series
+RATE_HISTORY_RETENTION = 600
+# The default seconds between datapoints
+RATE_HISTORY_INTERVAL = 1
+# The default rollup tiers, each is (resolution, retention) in seconds
+RATE_HISTORY_TIERS = [(10, 3600), (60, 6 * 3600), (600, 2 * 86400)]
+# The initial number of rows of the arrays of a level
+LEVEL_INITIAL_ROWS = 64
+# The dtype of the values
+VALUE_DTYPE = numpy.float32
+METRIC_RATE = "rate"
+METRIC_LIMIT = "limit"
+LEVEL_JOB = "job"
+LEVEL_HOST = "host"
+LEVEL_OST = "ost"
+LEVELS = [LEVEL_JOB, LEVEL_HOST, LEVEL_OST]
+# The levels recorded by default
+RATE_HISTORY_LEVELS = [LEVEL_JOB]
+# The columns of rollup buckets after time
+ROLLUP_COLUMNS = ["min", "max", "avg", "last"]
+# The sub keys of the series of job level
+JOB_RATE_SUB_KEYS = [METRIC_RATE]
+JOB_SUB_KEYS = [METRIC_RATE, METRIC_LIMIT]
+
+
+def level_key(level, job_id, sub_key):
+    """
+    Return the series key of a sub key of a job in a level. The sub key is
+    the metric for job level, (hostname, metric) for host level, and
+    (hostname, service_id, optype) for OST level.
+    """
+    if level == LEVEL_JOB:
+        return (job_id, None, None, sub_key)
+    elif level == LEVEL_HOST:
+        return (job_id, sub_key[0], None, sub_key[1])
+    return (job_id,) + sub_key
+
+
+def snapshot_level_series(snapshot, levels):
+    """
+    Return a dict from level to the list of (job_id, sub_keys, values) of
+    the series of the level in a snapshot of the rate task. The sub keys of
+    OST level are the keys of the services dict of the job snapshot, so no
+    key is built for each (job, OST) pair.
+    """
+    level_series = {}
+    for level in levels:
+        level_series[level] = []
+    job_series = level_series.get(LEVEL_JOB)
+    host_series = level_series.get(LEVEL_HOST)
+    ost_series = level_series.get(LEVEL_OST)
+    for job_id, job_snapshot in snapshot["jobs"].iteritems():
+        if job_series is not None:
+            if job_snapshot["limit"] is None:
+                job_series.append((job_id, JOB_RATE_SUB_KEYS,
+                                   [job_snapshot["rate"]]))
+            else:
+                job_series.append((job_id, JOB_SUB_KEYS,
+                                   [job_snapshot["rate"],
+                                    job_snapshot["limit"]]))
+        if host_series is not None:
+            hosts = job_snapshot["hosts"]
+            host_series.append((job_id,
+                                [(hostname, METRIC_RATE)
+                                 for hostname in hosts],
+                                hosts.values()))
+            host_limits = job_snapshot["host_limits"]
+            host_series.append((job_id,
+                                [(hostname, METRIC_LIMIT)
+                                 for hostname in host_limits],
+                                host_limits.values()))
+        if ost_series is not None:
+            services = job_snapshot["services"]
+            ost_series.append((job_id, services.keys(), services.values()))
+    return level_series
+
+
+def series_indexes(job_indexes, series, index_add, dtype=VALUE_DTYPE):
+    """
+    Return the array of the indexes of the series, each is (job_id,
+    sub_keys, values), and the array of their values. The indexes are
+    looked up in a mapping from job ID to a mapping from sub key to index,
+    one map() for each job. index_add(job_id, sub_key) is called to add
+    the index of a series that is not in the mapping yet. The values are
+    of the dtype.
+    """
+    job_indexes_list = []
+    number = 0
+    for job_id, sub_keys, _ in series:
+        sub_indexes = job_indexes.get(job_id)
+        if sub_indexes is None:
+            sub_indexes = {}
+            job_indexes[job_id] = sub_indexes
+        job_indexes_list.append(map(sub_indexes.get, sub_keys,
+                                    itertools.repeat(-1, len(sub_keys))))
+        number += len(sub_keys)
+    indexes = numpy.fromiter(itertools.chain.from_iterable(job_indexes_list),
+                             dtype=numpy.intp, count=number)
+    values = numpy.fromiter(itertools.chain.from_iterable(
+        [sub_values for _, _, sub_values in series]), dtype=dtype,
+                            count=number)
+    missing = numpy.nonzero(indexes < 0)[0].tolist()
+    if len(missing) != 0:
+        # Find the series of the missing indexes
+        keys = []
+        for job_id, sub_keys, _ in series:
+            keys.extend(itertools.izip(itertools.repeat(job_id), sub_keys))
+        for index in missing:
+            indexes[index] = index_add(*keys[index])
+    return indexes, values
+
+
+def ring_slots(count, capacity):
+    """
+    Return the array of the slots of a ring from old to new, count is the
+    number of slots ever written
+    """
+    first = max(0, count - capacity)
+    return numpy.arange(first, count) % capacity
+
+
+def array_rows_grow(array, rows, written):
+    """
+    Return a copy of a 2D array of (slot, row) with more rows. The new rows
+    of the slots that are written are NaN, the others are left untouched.
+    """
+    grown = numpy.zeros((array.shape[0], rows), dtype=array.dtype)
+    grown[:written, :array.shape[1]] = array[:written]
+    grown[:written, array.shape[1]:] = numpy.nan
+    return grown
+
+
+def rollup_reduce(blocks, numbers=None):
+    """
+    Return the list of the rollup columns reduced from the list of blocks,
+    each block is an array of (bucket, row) of a rollup column, and the
+    array of the numbers of datapoints in the buckets. The numbers of the
+    buckets weight the averages, and are 1 for each value if not given.
+    NaN values are ignored, and a row without value is NaN in all columns.
+    """
+    min_block, max_block, avg_block, last_block = blocks
+    if min_block.shape[0] == 0:
+        empty = numpy.full(min_block.shape[1], numpy.nan, dtype=VALUE_DTYPE)
+        return ([empty, empty.copy(), empty.copy(), empty.copy()],
+                numpy.zeros(min_block.shape[1], dtype=VALUE_DTYPE))
+    valid = ~numpy.isnan(avg_block)
+    if numbers is None:
+        number = valid.sum(axis=0, dtype=VALUE_DTYPE)
+        total = numpy.where(valid, avg_block, 0).sum(axis=0,
+                                                      dtype=numpy.float64)
+    else:
+        number = numbers.sum(axis=0, dtype=VALUE_DTYPE)
+        total = numpy.where(valid, avg_block * numbers, 0).sum(
+            axis=0, dtype=numpy.float64)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        avg = (total / number).astype(VALUE_DTYPE)
+    # The last bucket that has value, or the last bucket if none has
+    last_valid = ~numpy.isnan(last_block[::-1])
+    last_index = last_block.shape[0] - 1 - last_valid.argmax(axis=0)
+    last = last_block[last_index, numpy.arange(last_block.shape[1])]
+    return ([numpy.fmin.reduce(min_block, axis=0),
+             numpy.fmax.reduce(max_block, axis=0), avg, last], number)
+
+
+class HistoryTier(object):
+    """
+    A rollup tier of a level. The buckets are kept in a ring of slots like
+    the datapoints. The source of the buckets is the datapoints of the
+    level for the finest tier, and the buckets of the finer tier for the
+    others. When a bucket is closed, it is reduced from the slots of the
+    source since the bucket started, so nothing is done for the tier in
+    the ticks in between.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, resolution, retention, rows, source):
+        self.ht_resolution = resolution
+        self.ht_retention = retention
+        self.ht_capacity = int(math.ceil(float(retention) / resolution)) + 1
+        # HistoryLevel or the finer HistoryTier
+        self.ht_source = source
+        # The start time of the bucket of each slot
+        self.ht_times = numpy.zeros(self.ht_capacity)
+        # Mapping from rollup column to array of (slot, row)
+        self.ht_columns = collections.OrderedDict()
+        for name in ROLLUP_COLUMNS:
+            self.ht_columns[name] = numpy.zeros((self.ht_capacity, rows),
+                                                dtype=VALUE_DTYPE)
+        # The number of datapoints of (slot, row), to weight the averages
+        self.ht_numbers = numpy.zeros((self.ht_capacity, rows),
+                                      dtype=VALUE_DTYPE)
+        # Number of buckets ever closed
+        self.ht_count = 0
+        # The start time of the open bucket
+        self.ht_bucket = None
+        # The number of slots of the source when the open bucket started
+        self.ht_first = 0
+
+    def ht_rows_grow(self, rows):
+        """
+        Grow the arrays to the number of rows
+        """
+        written = min(self.ht_count, self.ht_capacity)
+        for name, column in self.ht_columns.items():
+            self.ht_columns[name] = array_rows_grow(column, rows, written)
+        numbers = numpy.zeros((self.ht_capacity, rows), dtype=VALUE_DTYPE)
+        numbers[:, :self.ht_numbers.shape[1]] = self.ht_numbers
+        self.ht_numbers = numbers
+
+    def ht_rows_clear(self, rows):
+        """
+        Clear the buckets of rows that are freed
+        """
+        for column in self.ht_columns.values():
+            column[:, rows] = numpy.nan
+        self.ht_numbers[:, rows] = 0
+
+    def ht_blocks(self, first, rows=None, bucket=False):
+        """
+        Return the list of the rollup blocks and the numbers of datapoints
+        of the buckets closed since the index first, and of the open bucket
+        if asked
+        """
+        slots = numpy.arange(max(first, self.ht_count - self.ht_capacity),
+                             self.ht_count) % self.ht_capacity
+        if rows is None:
+            index = slots
+        else:
+            index = numpy.ix_(slots, rows)
+        blocks = [column[index] for column in self.ht_columns.values()]
+        numbers = self.ht_numbers[index]
+        if bucket and self.ht_bucket is not None:
+            bucket_columns, number = self.ht_bucket_columns(rows)
+            blocks = [numpy.vstack([block, bucket_column])
+                      for block, bucket_column in zip(blocks, bucket_columns)]
+            numbers = numpy.vstack([numbers, number])
+        return blocks, numbers
+
+    def ht_bucket_columns(self, rows=None, bucket=True):
+        """
+        Return the list of the rollup columns of the open bucket, and the
+        numbers of its datapoints. If bucket is False, the open bucket of
+        the source is not included.
+        """
+        if isinstance(self.ht_source, HistoryTier):
+            blocks, numbers = self.ht_source.ht_blocks(self.ht_first, rows,
+                                                       bucket=bucket)
+        else:
+            blocks, numbers = self.ht_source.hl_blocks(self.ht_first, rows)
+        return rollup_reduce(blocks, numbers=numbers)
+
+    def _ht_source_count(self):
+        """
+        Return the number of slots ever written of the source
+        """
+        if isinstance(self.ht_source, HistoryTier):
+            return self.ht_source.ht_count
+        return self.ht_source.hl_count
+
+    def ht_tick(self, timestamp):
+        """
+        Called before the source gets the datapoints of a time. If the time
+        belongs to a new bucket, the open bucket is reduced from the source
+        and written to the ring. The finer tier should be ticked first.
+        """
+        bucket = timestamp - timestamp % self.ht_resolution
+        if bucket == self.ht_bucket:
+            return
+        if self.ht_bucket is not None:
+            slot = self.ht_count % self.ht_capacity
+            self.ht_times[slot] = self.ht_bucket
+            # The open bucket of the source belongs to the new bucket
+            bucket_columns, number = self.ht_bucket_columns(bucket=False)
+            for column, bucket_column in zip(self.ht_columns.values(),
+                                             bucket_columns):
+                column[slot] = bucket_column
+            self.ht_numbers[slot] = number
+            self.ht_count += 1
+        self.ht_bucket = bucket
+        self.ht_first = self._ht_source_count()
+
+    def ht_range(self, rows, start, end):
+        """
+        Return the bucket times in [start, end], and the list of the
+        rollup columns of the rows, each is an array of (bucket, row). The
+        open bucket is included.
+        """
+        slots = ring_slots(self.ht_count, self.ht_capacity)
+        times = self.ht_times[slots]
+        selected = (times >= start) & (times <= end)
+        slots = slots[selected]
+        times = times[selected]
+        columns = [column[numpy.ix_(slots, rows)]
+                   for column in self.ht_columns.values()]
+        if self.ht_bucket is not None and start <= self.ht_bucket <= end:
+            times = numpy.append(times, self.ht_bucket)
+            bucket_columns, _ = self.ht_bucket_columns(rows)
+            for index, column in enumerate(columns):
+                columns[index] = numpy.vstack([column,
+                                               bucket_columns[index]])
+        return times, columns
+
+    def ht_nbytes(self):
+        """
+        Return the bytes of the arrays
+        """
+        nbytes = self.ht_times.nbytes + self.ht_numbers.nbytes
+        for column in self.ht_columns.values():
+            nbytes += column.nbytes
+        return nbytes
+
+
+class HistoryLevel(object):
+    """
+    The datapoints and the rollup tiers of the series of a level
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, level, capacity, tiers):
+        self.hl_level = level
+        self.hl_capacity = capacity
+        rows = LEVEL_INITIAL_ROWS
+        # Mapping from job ID to a mapping from sub key to row
+        self.hl_rows = {}
+        # Number of rows used
+        self.hl_row_number = 0
+        # The (job_id, sub_key) of each row, None if the row is free
+        self.hl_row_keys = []
+        self.hl_free_rows = []
+        # The time of the latest datapoint of each row, NaN if free
+        self.hl_row_times = numpy.full(rows, numpy.nan)
+        # The time of each slot
+        self.hl_times = numpy.zeros(capacity)
+        # The values of (slot, row)
+        self.hl_values = numpy.zeros((capacity, rows), dtype=VALUE_DTYPE)
+        # Number of slots ever written
+        self.hl_count = 0
+        self.hl_tiers = []
+        source = self
+        for resolution, retention in tiers:
+            source = HistoryTier(resolution, retention, rows, source)
+            self.hl_tiers.append(source)
+
+    def _hl_rows_grow(self, rows):
+        """
+        Grow the arrays to at least the number of rows
+        """
+        old_rows = self.hl_values.shape[1]
+        if rows <= old_rows:
+            return
+        while old_rows < rows:
+            old_rows *= 2
+        written = min(self.hl_count, self.hl_capacity)
+        self.hl_values = array_rows_grow(self.hl_values, old_rows, written)
+        row_times = numpy.full(old_rows, numpy.nan)
+        row_times[:len(self.hl_row_times)] = self.hl_row_times
+        self.hl_row_times = row_times
+        for tier in self.hl_tiers:
+            tier.ht_rows_grow(old_rows)
+
+    def _hl_rows(self, series):
+        """
+        Return the array of the rows of the series, each is (job_id,
+        sub_keys, values), and the array of their values. Add the rows of
+        new series.
+        """
+        return series_indexes(self.hl_rows, series, self._hl_row_add)
+
+    def _hl_row_add(self, job_id, sub_key):
+        """
+        Add the row of a series, return the row
+        """
+        job_rows = self.hl_rows[job_id]
+        row = job_rows.get(sub_key, -1)
+        if row >= 0:
+            return row
+        if len(self.hl_free_rows) != 0:
+            row = self.hl_free_rows.pop()
+            self.hl_row_keys[row] = (job_id, sub_key)
+        else:
+            row = len(self.hl_row_keys)
+            self._hl_rows_grow(row + 1)
+            self.hl_row_keys.append((job_id, sub_key))
+        job_rows[sub_key] = row
+        self.hl_row_number += 1
+        return row
+
+    def hl_record(self, timestamp, series):
+        """
+        Write the values of the series at a time to a new slot, each series
+        is (job_id, sub_keys, values)
+        """
+        rows, values = self._hl_rows(series)
+        for tier in self.hl_tiers:
+            tier.ht_tick(timestamp)
+        slot = self.hl_count % self.hl_capacity
+        slot_values = self.hl_values[slot]
+        slot_values.fill(numpy.nan)
+        slot_values[rows] = values
+        self.hl_times[slot] = timestamp
+        self.hl_count += 1
+        self.hl_row_times[rows] = timestamp
+
+    def hl_expire(self, before):
+        """
+        Free the rows of the series that have no datapoint since a time,
+        return the number of them
+        """
+        with numpy.errstate(invalid="ignore"):
+            rows = numpy.nonzero(self.hl_row_times < before)[0]
+        if len(rows) == 0:
+            return 0
+        self.hl_row_times[rows] = numpy.nan
+        self.hl_values[:, rows] = numpy.nan
+        for tier in self.hl_tiers:
+            tier.ht_rows_clear(rows)
+        for row in rows.tolist():
+            job_id, sub_key = self.hl_row_keys[row]
+            job_rows = self.hl_rows[job_id]
+            del job_rows[sub_key]
+            if len(job_rows) == 0:
+                del self.hl_rows[job_id]
+            self.hl_row_keys[row] = None
+            self.hl_free_rows.append(row)
+        self.hl_row_number -= len(rows)
+        return len(rows)
+
+    def hl_select(self, job_ids=None, hostname=None, metric=None):
+        """
+        Return the lists of the keys and rows of the matched series
+        """
+        keys = []
+        rows = []
+        if job_ids is None:
+            job_ids = self.hl_rows.keys()
+        for job_id in job_ids:
+            job_rows = self.hl_rows.get(job_id)
+            if job_rows is None:
+                continue
+            for sub_key, row in job_rows.iteritems():
+                key = level_key(self.hl_level, job_id, sub_key)
+                if hostname is not None and key[1] != hostname:
+                    continue
+                if metric is not None and key[3] != metric:
+                    continue
+                keys.append(key)
+                rows.append(row)
+        return keys, rows
+
+    def hl_blocks(self, first, rows=None):
+        """
+        Return the list of the rollup blocks of the datapoints written
+        since the index first, the datapoints are the block of every column
+        and each counts as one datapoint
+        """
+        slots = numpy.arange(max(first, self.hl_count - self.hl_capacity),
+                             self.hl_count) % self.hl_capacity
+        if rows is None:
+            block = self.hl_values[slots]
+        else:
+            block = self.hl_values[numpy.ix_(slots, rows)]
+        return [block] * len(ROLLUP_COLUMNS), None
+
+    def hl_range(self, rows, start, end):
+        """
+        Return the times of the datapoints in [start, end], and the list of
+        the value array of (datapoint, row) of the rows
+        """
+        slots = ring_slots(self.hl_count, self.hl_capacity)
+        times = self.hl_times[slots]
+        selected = (times >= start) & (times <= end)
+        slots = slots[selected]
+        return times[selected], [self.hl_values[numpy.ix_(slots, rows)]]
+
+    def hl_nbytes(self):
+        """
+        Return the bytes of the arrays
+        """
+        nbytes = (self.hl_values.nbytes + self.hl_times.nbytes +
+                  self.hl_row_times.nbytes)
+        for tier in self.hl_tiers:
+            nbytes += tier.ht_nbytes()
+        return nbytes
+
+
+class RateHistory(object):
+    """
+    The history of all series
+    """
+    def __init__(self, retention=RATE_HISTORY_RETENTION,
+                 interval=RATE_HISTORY_INTERVAL, tiers=None, levels=None):
+        if tiers is None:
+            tiers = RATE_HISTORY_TIERS
+        if levels is None:
+            levels = RATE_HISTORY_LEVELS
+        self.rh_retention = retention
+        self.rh_interval = interval
+        self.rh_capacity = int(math.ceil(float(retention) / interval)) + 1
+        # Rollup tiers of (resolution, retention), from fine to coarse
+        self.rh_tiers = sorted([(resolution, tier_retention)
+                                for resolution, tier_retention in tiers])
+        # Series are kept as long as the longest retention
+        self.rh_max_retention = max([retention] +
+                                    [tier[1] for tier in self.rh_tiers])
+        # Mapping from level to HistoryLevel, in the order of LEVELS
+        self.rh_levels = collections.OrderedDict()
+        for level in LEVELS:
+            if level in levels:
+                self.rh_levels[level] = HistoryLevel(level, self.rh_capacity,
+                                                     self.rh_tiers)
+        # The time of the latest snapshot recorded
+        self.rh_time = None
+        self.rh_condition = threading.Condition()
+
+    def rh_snapshot_record(self, snapshot):
+        """
+        Record the rates and limits in a snapshot of the rate task
+        """
+        timestamp = snapshot["time"]
+        level_series = snapshot_level_series(snapshot, self.rh_levels)
+        self.rh_condition.acquire()
+        for level, history_level in self.rh_levels.iteritems():
+            history_level.hl_record(timestamp, level_series[level])
+        self.rh_time = timestamp
+        self.rh_condition.release()
+
+    def rh_expire(self, now):
+        """
+        Remove the series that have no datapoint in the longest retention
+        """
+        before = now - self.rh_max_retention
+        self.rh_condition.acquire()
+        expired = 0
+        for history_level in self.rh_levels.itervalues():
+            expired += history_level.hl_expire(before)
+        self.rh_condition.release()
+        return expired
+
+    def rh_tier_select(self, start, end, points):
+        """
+        Return the index of the rollup tier to query [start, end], or None
+        if the datapoints should be used. Only the datapoints and the tiers
+        whose retention covers start are considered, or the one with the
+        longest retention if none covers. Of them, the coarsest one that has
+        at least the number of points in the range is used, or the finest
+        one if points is not given or none has that many points.
+        """
+        latest = self.rh_time
+        if latest is None:
+            latest = end
+        candidates = [(None, self.rh_interval, self.rh_retention)]
+        for index, (resolution, retention) in enumerate(self.rh_tiers):
+            candidates.append((index, resolution, retention))
+        covering = [candidate for candidate in candidates
+                    if start >= latest - candidate[2]]
+        if len(covering) == 0:
+            covering = [max(candidates, key=lambda candidate: candidate[2])]
+        selected = covering[0]
+        if points is not None and points > 0:
+            for candidate in covering:
+                if (end - start) / candidate[1] >= points:
+                    selected = candidate
+        return selected[0]
+
+    def rh_query(self, start, end, job_ids=None, level=None, hostname=None,
+                 metric=None, points=None):
+        """
+        Return the datapoints in [start, end] of the matched series. Each
+        series is a dict with the key fields and lists of times and values.
+        The datapoints or the tier are selected by rh_tier_select(). If a
+        tier is used, the values are the averages of the buckets, and the
+        series also has the lists of min, max and last values.
+        """
+        # pylint: disable=too-many-arguments,too-many-locals
+        tier = self.rh_tier_select(start, end, points)
+        if tier is None:
+            resolution = self.rh_interval
+        else:
+            resolution = self.rh_tiers[tier][0]
+        self.rh_condition.acquire()
+        matched = []
+        for level_name, history_level in self.rh_levels.iteritems():
+            if level is not None and level_name != level:
+                continue
+            keys, rows = history_level.hl_select(job_ids=job_ids,
+                                                 hostname=hostname,
+                                                 metric=metric)
+            if len(rows) == 0:
+                continue
+            if tier is None:
+                times, columns = history_level.hl_range(rows, start, end)
+            else:
+                times, columns = \
+                    history_level.hl_tiers[tier].ht_range(rows, start, end)
+            for index, key in enumerate(keys):
+                matched.append((key, times,
+                                [column[:, index] for column in columns]))
+        self.rh_condition.release()
+
+        result = []
+        for key, times, columns in sorted(matched, key=lambda item: item[0]):
+            # The series has no datapoint in the slots that are NaN
+            if tier is None:
+                valid = ~numpy.isnan(columns[0])
+            else:
+                valid = ~numpy.isnan(columns[ROLLUP_COLUMNS.index("avg")])
+            series = {"job_id": key[0],
+                      "host": key[1],
+                      "ost": key[2],
+                      "metric": key[3],
+                      "resolution": resolution,
+                      "times": times[valid].tolist()}
+            if tier is None:
+                series["values"] = columns[0][valid].tolist()
+            else:
+                for name, column in zip(ROLLUP_COLUMNS, columns):
+                    series[name] = column[valid].tolist()
+                series["values"] = series["avg"]
+            result.append(series)
+        return result
+
+    def rh_stats(self):
+        """
+        Return the statistics of the history
+        """
+        self.rh_condition.acquire()
+        series = 0
+        nbytes = 0
+        for history_level in self.rh_levels.itervalues():
+            series += history_level.hl_row_number
+            nbytes += history_level.hl_nbytes()
+        self.rh_condition.release()
+        return {"series": series,
+                "levels": self.rh_levels.keys(),
+                "capacity": self.rh_capacity,
+                "retention": self.rh_retention,
+                "tiers": self.rh_tiers,
+                "bytes": nbytes}
+
+
+def benchmark_snapshot(job_number, ost_number, host_number, timestamp):
+    """
+    Return a snapshot of the rate task with all jobs on all OSTs
+    """
+    jobs = collections.OrderedDict()
+    for job_index in range(job_number):
+        job_id = "dd.%d" % job_index
+        hosts = {}
+        host_limits = {}
+        services = {}
+        for ost_index in range(ost_number):
+            hostname = "oss%d" % (ost_index % host_number)
+            rate = float((job_index + ost_index + int(timestamp)) % 100)
+            services[(hostname, "OST%04x" % ost_index,
+                      "sum_write_bytes")] = rate
+            hosts[hostname] = hosts.get(hostname, 0) + rate
+            host_limits[hostname] = 10000
+        jobs[job_id] = {"rate": sum(hosts.values()), "limit": None,
+                        "hosts": hosts, "host_limits": host_limits,
+                        "services": services}
+    return {"time": timestamp, "jobs": jobs}
+
+
+def benchmark_history(job_number=500, ost_number=200, host_number=8,
+                      ticks=30):
+    """
+    Measure the time of recording snapshots and expiring series in each
+    tick, with the default levels and with all levels
+    """
+    snapshots = []
+    for tick in range(2):
+        snapshots.append(benchmark_snapshot(job_number, ost_number,
+                                            host_number, 1000.0 + tick))
+    for levels in [RATE_HISTORY_LEVELS, LEVELS]:
+        history = RateHistory(levels=levels)
+        record_time = 0
+        expire_time = 0
+        for tick in range(ticks):
+            snapshot = snapshots[tick % 2]
+            snapshot["time"] = 1000.0 + tick
+            start_time = time.time()
+            history.rh_snapshot_record(snapshot)
+            record_time += time.time() - start_time
+            start_time = time.time()
+            history.rh_expire(snapshot["time"])
+            expire_time += time.time() - start_time
+        stats = history.rh_stats()
+        print("levels %s: %d series, record %.1f ms, expire %.2f ms per "
+              "tick, %d bytes" %
+              (",".join(levels), stats["series"], record_time * 1000 / ticks,
+               expire_time * 1000 / ticks, stats["bytes"]))
+        series = history.rh_query(1000.0, 1000.0 + ticks, job_ids=["dd.0"],
+                                  level=LEVEL_JOB, metric=METRIC_RATE)
+        if len(series) != 1 or len(series[0]["values"]) != ticks:
+            print("unexpected query result %s" % series)
+            return -1
+        # The buckets of the finest tier, the last one is open
+        resolution = RATE_HISTORY_TIERS[0][0]
+        buckets = int(math.ceil(float(ticks) / resolution))
+        tier_series = history.rh_query(1000.0, 1000.0 + ticks,
+                                       job_ids=["dd.0"], level=LEVEL_JOB,
+                                       metric=METRIC_RATE, points=buckets)
+        values = series[0]["values"]
+        averages = [sum(values[index:index + resolution]) /
+                    len(values[index:index + resolution])
+                    for index in range(0, ticks, resolution)]
+        if (len(tier_series) != 1 or
+                tier_series[0]["resolution"] != resolution or
+                not numpy.allclose(tier_series[0]["avg"], averages)):
+            print("unexpected tier query result %s" % tier_series)
+            return -1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_history())
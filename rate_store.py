@@ -0,0 +1,676 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+On-disk store of rates, limits and control actions
+
+The rows are appended to segment files. Each segment is preallocated for a
+fixed number of rows and memory-mapped, with the columns stored one after
+another:
+
+    header | time (f8) | value (f8) | series (u4) | aux (i4) | kind (u1)
+
+The header has the number of committed rows, which is updated after the
+rows are written, so a reader never sees a partially written row. The keys
+of the series used in a segment are kept in a sidecar file as JSON lines of
+[series_id, key], written before the rows using them are committed.
+
+The kinds of rows are:
+
+    rate:   key (job_id, hostname, service_id, metric), value is the rate
+    limit:  key (job_id, hostname, None, "limit"), value is the limit
+    action: key (action_job_id, hostname, job_id, action_type), value is the
+            limit after the action, aux is the limit before it
+    result: key same as action, value is 1 if the action is good, otherwise
+            0, aux is the number of failures
+
+The snapshots of the rate task are only queued by the rate task, and the
+rows are built by a dedicated thread, which looks up the series IDs of
+each job with one map() and writes the columns with vectorized
+assignments. The pages are written back to disk by the kernel, so
+recording never waits for the disk.
+
+A snapshot has a row for every series of the levels stored, so only one
+snapshot is stored in each interval, and the OST level, which has a row
+for every (job, OST) pair, is only stored if enabled. The default sizes
+of the segments and the store are computed from the expected rows of a
+snapshot, so the default retention is kept by the default size.
+
+A segment is closed when it is full or too old, and the oldest segments are
+removed when the store is too large or too old.
+
+Run this file to print the rows in a time range.
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import errno
+import struct
+import functools
+import logging
+import optparse
+import threading
+import traceback
+import collections
+import numpy
+
+# local libs
+import utils
+import rate_history
+
+# The default directory of the segments
+STORE_DIRECTORY = "rate_store"
+# The default levels of the rates stored
+STORE_LEVELS = [rate_history.LEVEL_JOB, rate_history.LEVEL_HOST]
+# The default seconds between the snapshots stored
+STORE_INTERVAL = 10
+# The expected rows of a snapshot with the default levels, e.g. 500 jobs on
+# 8 OSS hosts have a rate and a limit of each job and of each job on a host
+STORE_SNAPSHOT_ROWS = 10000
+# The default max seconds that a segment is written to
+STORE_SEGMENT_SECONDS = 3600
+# The default number of rows of each segment, enough for the snapshots
+# stored in STORE_SEGMENT_SECONDS
+STORE_SEGMENT_ROWS = (STORE_SNAPSHOT_ROWS * STORE_SEGMENT_SECONDS //
+                      STORE_INTERVAL)
+# The default max age of segments in seconds
+STORE_MAX_AGE = 86400
+# The max number of records waiting to be written
+STORE_QUEUE_SIZE = 1000
+# The max number of snapshots waiting to be written, each keeps the rates of
+# all pairs in memory until it is written
+STORE_QUEUE_SNAPSHOTS = 6
+SEGMENT_MAGIC = "LIMESEG1"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".seg"
+SERIES_SUFFIX = ".series"
+# magic, version, capacity, count, start_time, end_time
+SEGMENT_HEADER = struct.Struct("<8sIIQdd")
+SEGMENT_HEADER_SIZE = 64
+# The offset of the count in the header
+SEGMENT_COUNT_OFFSET = 16
+# The count and the time range of rows are updated together when committing
+SEGMENT_COMMIT = struct.Struct("<Qdd")
+SEGMENT_COLUMNS = [("time", "<f8"), ("value", "<f8"), ("series", "<u4"),
+                   ("aux", "<i4"), ("kind", "u1")]
+# The bytes of each row in a segment
+SEGMENT_ROW_SIZE = sum([numpy.dtype(dtype).itemsize
+                        for _, dtype in SEGMENT_COLUMNS])
+# The default max bytes of all segments, enough for the segments of
+# STORE_MAX_AGE and the one being written
+STORE_MAX_BYTES = ((SEGMENT_HEADER_SIZE +
+                    SEGMENT_ROW_SIZE * STORE_SEGMENT_ROWS) *
+                   (STORE_MAX_AGE // STORE_SEGMENT_SECONDS + 1))
+KIND_RATE = 0
+KIND_LIMIT = 1
+KIND_ACTION = 2
+KIND_RESULT = 3
+KIND_NAMES = ["rate", "limit", "action", "result"]
+# The types of the records queued
+RECORD_ROWS = "rows"
+RECORD_SNAPSHOT = "snapshot"
+# The initial number of series IDs of a segment
+SEGMENT_INITIAL_SERIES = 1024
+
+
+def segment_size(capacity):
+    """
+    Return the file size of a segment
+    """
+    return SEGMENT_HEADER_SIZE + SEGMENT_ROW_SIZE * capacity
+
+
+def segment_columns(buf, capacity):
+    """
+    Return the dict of column arrays on the buffer of a segment
+    """
+    columns = {}
+    offset = SEGMENT_HEADER_SIZE
+    for name, dtype in SEGMENT_COLUMNS:
+        columns[name] = numpy.frombuffer(buf, dtype=dtype, count=capacity,
+                                         offset=offset)
+        offset += numpy.dtype(dtype).itemsize * capacity
+    return columns
+
+
+class StoreSegment(object):
+    """
+    A segment that is being written
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, path, capacity, start_time):
+        self.ss_path = path
+        self.ss_capacity = capacity
+        # The time that the segment is opened at
+        self.ss_start_time = start_time
+        # The time range of the rows in the segment
+        self.ss_first_time = start_time
+        self.ss_last_time = start_time
+        self.ss_count = 0
+        # Mapping from series key to series ID, of the rows of actions
+        self.ss_series = {}
+        # Mapping from level to a mapping from job ID to a mapping from sub
+        # key to series ID, of the rows of snapshots
+        self.ss_level_series = {}
+        # The kind of the rows of each series ID of snapshots
+        self.ss_series_kinds = numpy.zeros(SEGMENT_INITIAL_SERIES,
+                                           dtype=numpy.uint8)
+        # Number of series IDs
+        self.ss_series_number = 0
+        self.ss_file = None
+        self.ss_mmap = None
+        self.ss_columns = None
+        self.ss_series_file = None
+
+    def ss_create(self):
+        """
+        Create the segment file. The file is renamed to its name after the
+        header is written, so a crash never leaves a segment without header.
+        """
+        tmp_path = self.ss_path + ".tmp"
+        size = segment_size(self.ss_capacity)
+        try:
+            segment_file = open(tmp_path, "w+b")
+            segment_file.truncate(size)
+            header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION,
+                                         self.ss_capacity, 0,
+                                         self.ss_start_time,
+                                         self.ss_start_time)
+            segment_file.write(header)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+            os.rename(tmp_path, self.ss_path)
+            self.ss_series_file = open(self.ss_path + SERIES_SUFFIX, "a")
+        except (IOError, OSError) as error:
+            logging.error("failed to create segment [%s]: %s",
+                          self.ss_path, error)
+            return -1
+        self.ss_file = segment_file
+        self.ss_mmap = mmap.mmap(segment_file.fileno(), size)
+        self.ss_columns = segment_columns(self.ss_mmap, self.ss_capacity)
+        return 0
+
+    def _ss_series_add(self, key):
+        """
+        Return a new series ID of a key, and add it to the sidecar
+        """
+        series_id = self.ss_series_number
+        self.ss_series_number += 1
+        self.ss_series_file.write(json.dumps([series_id, key]) + "\n")
+        return series_id
+
+    def _ss_series_id(self, key):
+        """
+        Return the ID of a series key, add it to the sidecar if new
+        """
+        series_id = self.ss_series.get(key)
+        if series_id is None:
+            series_id = self._ss_series_add(key)
+            self.ss_series[key] = series_id
+        return series_id
+
+    def _ss_level_series_add(self, level, job_id, sub_key):
+        """
+        Return the ID of a new series of a level in snapshots
+        """
+        key = rate_history.level_key(level, job_id, sub_key)
+        series_id = self._ss_series_add(key)
+        self.ss_level_series[level][job_id][sub_key] = series_id
+        if series_id == len(self.ss_series_kinds):
+            kinds = numpy.zeros(series_id * 2, dtype=numpy.uint8)
+            kinds[:series_id] = self.ss_series_kinds
+            self.ss_series_kinds = kinds
+        if key[3] == rate_history.METRIC_LIMIT:
+            self.ss_series_kinds[series_id] = KIND_LIMIT
+        else:
+            self.ss_series_kinds[series_id] = KIND_RATE
+        return series_id
+
+    def _ss_columns_append(self, times, kinds, series_ids, values, aux):
+        """
+        Append the columns of rows and commit them, each argument is an
+        array or a value of all rows. The number of rows is the length of
+        series_ids, which should fit in the segment.
+        """
+        first = self.ss_count
+        last = first + len(series_ids)
+        columns = self.ss_columns
+        columns["time"][first:last] = times
+        columns["kind"][first:last] = kinds
+        columns["series"][first:last] = series_ids
+        columns["value"][first:last] = values
+        columns["aux"][first:last] = aux
+        self.ss_count = last
+        times = columns["time"][first:last]
+        if first == 0:
+            self.ss_first_time = times.min()
+            self.ss_last_time = times.max()
+        else:
+            self.ss_first_time = min(self.ss_first_time, times.min())
+            self.ss_last_time = max(self.ss_last_time, times.max())
+        SEGMENT_COMMIT.pack_into(self.ss_mmap, SEGMENT_COUNT_OFFSET,
+                                 self.ss_count, self.ss_first_time,
+                                 self.ss_last_time)
+        return len(series_ids)
+
+    def ss_append(self, rows):
+        """
+        Append rows of (time, kind, key, value, aux) and commit them.
+        Return the number of rows appended, which is less than the number
+        of rows if the segment is full.
+        """
+        number = min(len(rows), self.ss_capacity - self.ss_count)
+        if number == 0:
+            return 0
+        rows = rows[:number]
+        series_ids = [self._ss_series_id(row[2]) for row in rows]
+        # The keys have to be on disk before the rows using them
+        self.ss_series_file.flush()
+        return self._ss_columns_append([row[0] for row in rows],
+                                       [row[1] for row in rows], series_ids,
+                                       [row[3] for row in rows],
+                                       [row[4] for row in rows])
+
+    def ss_series_append(self, timestamp, level, series, first):
+        """
+        Append the rows of the series of a level at a time, each is
+        (job_id, sub_keys, values), except the rows before the index first,
+        which have been appended to the former segment. Return the number
+        of rows appended, which is less than the number of rows left if
+        the segment is full.
+        """
+        if self.ss_count == self.ss_capacity:
+            return 0
+        job_series = self.ss_level_series.setdefault(level, {})
+        series_ids, values = rate_history.series_indexes(
+            job_series, series,
+            functools.partial(self._ss_level_series_add, level),
+            dtype=numpy.float64)
+        number = min(len(series_ids) - first, self.ss_capacity - self.ss_count)
+        if number <= 0:
+            return 0
+        series_ids = series_ids[first:first + number]
+        self.ss_series_file.flush()
+        return self._ss_columns_append(timestamp,
+                                       self.ss_series_kinds[series_ids],
+                                       series_ids,
+                                       values[first:first + number], 0)
+
+    def ss_close(self):
+        """
+        Flush and close the segment
+        """
+        if self.ss_mmap is None:
+            return
+        # The arrays have to be released before the mmap is closed
+        self.ss_columns = None
+        self.ss_mmap.flush()
+        self.ss_mmap.close()
+        self.ss_mmap = None
+        self.ss_file.close()
+        self.ss_series_file.close()
+
+
+class RateStore(object):
+    """
+    The writer of the segments
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, directory=STORE_DIRECTORY,
+                 segment_rows=STORE_SEGMENT_ROWS,
+                 segment_seconds=STORE_SEGMENT_SECONDS,
+                 max_bytes=STORE_MAX_BYTES, max_age=STORE_MAX_AGE,
+                 levels=None, interval=STORE_INTERVAL):
+        if levels is None:
+            levels = STORE_LEVELS
+        self.rst_directory = directory
+        self.rst_segment_rows = segment_rows
+        self.rst_segment_seconds = segment_seconds
+        self.rst_max_bytes = max_bytes
+        self.rst_max_age = max_age
+        # The levels of the rates stored, in the order of LEVELS
+        self.rst_levels = [level for level in rate_history.LEVELS
+                           if level in levels]
+        self.rst_interval = interval
+        # The interval of the latest snapshot queued
+        self.rst_snapshot_bucket = None
+        self.rst_segment = None
+        self.rst_sequence = 0
+        # Records waiting to be written, each is (RECORD_ROWS, rows) or
+        # (RECORD_SNAPSHOT, snapshot)
+        self.rst_queue = collections.deque()
+        # Number of snapshots in the queue
+        self.rst_queued_snapshots = 0
+        self.rst_condition = threading.Condition()
+        # Number of records dropped because the queue is full
+        self.rst_dropped_count = 0
+        # Number of rows written
+        self.rst_row_count = 0
+        # Number of segments removed by retention
+        self.rst_removed_count = 0
+        # Number of records that failed to be written
+        self.rst_exception_count = 0
+
+    def rst_start(self):
+        """
+        Create the directory and start the writing thread
+        """
+        if not os.path.isdir(self.rst_directory):
+            try:
+                os.makedirs(self.rst_directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    logging.error("failed to create directory [%s]: %s",
+                                  self.rst_directory, error)
+                    return -1
+        utils.thread_start(self.rst_write_thread, ())
+        return 0
+
+    def _rst_put(self, record_type, record):
+        """
+        Queue a record to be written
+        """
+        self.rst_condition.acquire()
+        if (len(self.rst_queue) >= STORE_QUEUE_SIZE or
+                (record_type == RECORD_SNAPSHOT and
+                 self.rst_queued_snapshots >= STORE_QUEUE_SNAPSHOTS)):
+            self.rst_dropped_count += 1
+            self.rst_condition.release()
+            return -1
+        if record_type == RECORD_SNAPSHOT:
+            self.rst_queued_snapshots += 1
+        self.rst_queue.append((record_type, record))
+        self.rst_condition.notify()
+        self.rst_condition.release()
+        return 0
+
+    def rst_snapshot_record(self, snapshot):
+        """
+        Queue the rates and limits in a snapshot of the rate task, if it is
+        the first one in its interval. The snapshot is queued as it is, and
+        should not be changed afterwards.
+        """
+        bucket = snapshot["time"] // self.rst_interval
+        if bucket == self.rst_snapshot_bucket:
+            return 0
+        self.rst_snapshot_bucket = bucket
+        return self._rst_put(RECORD_SNAPSHOT, snapshot)
+
+    def rst_action_record(self, kind, key, value, aux):
+        """
+        Queue a control action or its result
+        """
+        return self._rst_put(RECORD_ROWS,
+                             [(time.time(), kind, key, value, aux)])
+
+    def _rst_segment_open(self, now):
+        """
+        Close the current segment and open a new one
+        """
+        if self.rst_segment is not None:
+            self.rst_segment.ss_close()
+            self.rst_segment = None
+        self._rst_retention_apply(now)
+        self.rst_sequence += 1
+        name = "rates_%013d_%04d%s" % (int(now * 1000), self.rst_sequence,
+                                       SEGMENT_SUFFIX)
+        segment = StoreSegment(os.path.join(self.rst_directory, name),
+                               self.rst_segment_rows, now)
+        ret = segment.ss_create()
+        if ret:
+            return ret
+        self.rst_segment = segment
+        logging.info("opened segment [%s]", segment.ss_path)
+        return 0
+
+    def _rst_segment_writable(self, now):
+        """
+        Return the segment to write to, open a new one if the current one
+        is full or too old. Return None on failure.
+        """
+        segment = self.rst_segment
+        if (segment is None or
+                segment.ss_count == segment.ss_capacity or
+                now - segment.ss_start_time > self.rst_segment_seconds):
+            ret = self._rst_segment_open(now)
+            if ret:
+                return None
+            segment = self.rst_segment
+        return segment
+
+    def rst_rows_write(self, rows):
+        """
+        Write rows to segments, rolling over if needed
+        """
+        now = time.time()
+        while len(rows) != 0:
+            segment = self._rst_segment_writable(now)
+            if segment is None:
+                return -1
+            number = segment.ss_append(rows)
+            self.rst_row_count += number
+            rows = rows[number:]
+        return 0
+
+    def rst_snapshot_write(self, snapshot):
+        """
+        Write the rates and limits of the levels in a snapshot of the rate
+        task to segments, rolling over if needed
+        """
+        timestamp = snapshot["time"]
+        level_series = rate_history.snapshot_level_series(snapshot,
+                                                          self.rst_levels)
+        now = time.time()
+        for level in self.rst_levels:
+            series = level_series[level]
+            number = sum([len(sub_keys) for _, sub_keys, _ in series])
+            written = 0
+            while written < number:
+                segment = self._rst_segment_writable(now)
+                if segment is None:
+                    return -1
+                appended = segment.ss_series_append(timestamp, level, series,
+                                                    written)
+                self.rst_row_count += appended
+                written += appended
+        return 0
+
+    def _rst_retention_apply(self, now):
+        """
+        Remove the oldest segments if the store would be too large or too
+        old after opening a new segment
+        """
+        segments = []
+        total = segment_size(self.rst_segment_rows)
+        for path in store_segments(self.rst_directory):
+            size = os.path.getsize(path)
+            segments.append((path, size, os.path.getmtime(path)))
+            total += size
+        for path, size, mtime in segments:
+            if total <= self.rst_max_bytes and mtime >= now - self.rst_max_age:
+                break
+            logging.info("removing segment [%s] by retention", path)
+            for fpath in [path, path + SERIES_SUFFIX]:
+                try:
+                    os.remove(fpath)
+                except OSError as error:
+                    logging.error("failed to remove [%s]: %s", fpath, error)
+            total -= size
+            self.rst_removed_count += 1
+
+    def _rst_segment_drop(self):
+        """
+        Close the current segment after a failed write. The keys in the
+        sidecar might not match the rows any more, so the following rows
+        go to a new segment.
+        """
+        # pylint: disable=bare-except
+        segment = self.rst_segment
+        if segment is None:
+            return
+        self.rst_segment = None
+        try:
+            segment.ss_close()
+        except:
+            logging.error("exception when closing segment [%s]: [%s]",
+                          segment.ss_path, traceback.format_exc())
+
+    def rst_write_thread(self):
+        """
+        The thread that writes the queued records
+        """
+        # pylint: disable=bare-except
+        while True:
+            self.rst_condition.acquire()
+            while len(self.rst_queue) == 0:
+                self.rst_condition.wait()
+            records = self.rst_queue
+            self.rst_queue = collections.deque()
+            self.rst_queued_snapshots = 0
+            self.rst_condition.release()
+            for record_type, record in records:
+                try:
+                    if record_type == RECORD_SNAPSHOT:
+                        self.rst_snapshot_write(record)
+                    else:
+                        self.rst_rows_write(record)
+                except:
+                    logging.error("exception when writing [%s] record to "
+                                  "store [%s]: [%s]", record_type,
+                                  self.rst_directory, traceback.format_exc())
+                    self.rst_exception_count += 1
+                    self._rst_segment_drop()
+
+    def rst_stats(self):
+        """
+        Return the statistics of the store
+        """
+        stats = {"queued": len(self.rst_queue),
+                 "dropped": self.rst_dropped_count,
+                 "rows": self.rst_row_count,
+                 "removed_segments": self.rst_removed_count,
+                 "exceptions": self.rst_exception_count}
+        if self.rst_segment is not None:
+            stats["segment"] = self.rst_segment.ss_path
+            stats["segment_rows"] = self.rst_segment.ss_count
+        return stats
+
+
+def store_segments(directory):
+    """
+    Return the paths of the segments in a directory, from old to new
+    """
+    paths = []
+    for fname in sorted(os.listdir(directory)):
+        if fname.endswith(SEGMENT_SUFFIX):
+            paths.append(os.path.join(directory, fname))
+    return paths
+
+
+def segment_scan(path, start, end, kinds=None, job_ids=None):
+    """
+    Return the rows of a segment in [start, end] as a list of (time, kind,
+    key, value, aux). Only the time and kind columns are read for rows out
+    of the range.
+    """
+    # pylint: disable=too-many-locals
+    with open(path, "rb") as segment_file:
+        header = segment_file.read(SEGMENT_HEADER.size)
+        if len(header) != SEGMENT_HEADER.size:
+            logging.error("segment [%s] has no header", path)
+            return []
+        magic, version, capacity, count, start_time, end_time = \
+            SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            logging.error("segment [%s] has unknown format", path)
+            return []
+        if count == 0 or end_time < start or start_time > end:
+            return []
+        buf = mmap.mmap(segment_file.fileno(), segment_size(capacity),
+                        access=mmap.ACCESS_READ)
+    columns = segment_columns(buf, capacity)
+    times = columns["time"][:count]
+    mask = (times >= start) & (times <= end)
+    if kinds is not None:
+        mask &= numpy.in1d(columns["kind"][:count], kinds)
+    indexes = numpy.nonzero(mask)[0]
+    # Fancy indexing copies the rows, so the mmap can be closed
+    selected = {}
+    for name, _ in SEGMENT_COLUMNS:
+        selected[name] = columns[name][indexes].tolist()
+    del columns, times
+    buf.close()
+
+    keys = {}
+    try:
+        with open(path + SERIES_SUFFIX) as series_file:
+            for line in series_file:
+                try:
+                    series_id, key = json.loads(line)
+                except ValueError:
+                    # The last line might be partially written
+                    continue
+                keys[series_id] = key
+    except IOError as error:
+        logging.error("failed to read series of segment [%s]: %s", path,
+                      error)
+
+    rows = []
+    for index in range(len(indexes)):
+        key = keys.get(selected["series"][index])
+        if job_ids is not None and (key is None or key[0] not in job_ids):
+            continue
+        rows.append((selected["time"][index], selected["kind"][index], key,
+                     selected["value"][index], selected["aux"][index]))
+    return rows
+
+
+def store_scan(directory, start, end, kinds=None, job_ids=None):
+    """
+    Return the rows of all segments in [start, end], sorted by time
+    """
+    rows = []
+    for path in store_segments(directory):
+        rows += segment_scan(path, start, end, kinds=kinds, job_ids=job_ids)
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def main():
+    """
+    Print the rows in a time range
+    """
+    parser = optparse.OptionParser(usage="%prog [options] directory")
+    parser.add_option("--start", dest="start", type="float", default=0,
+                      help="start of the time range, seconds since epoch")
+    parser.add_option("--end", dest="end", type="float", default=None,
+                      help="end of the time range, seconds since epoch")
+    parser.add_option("--job", dest="job_ids", action="append",
+                      default=None, help="job to print, can be repeated")
+    parser.add_option("--kind", dest="kinds", action="append",
+                      default=None, choices=KIND_NAMES,
+                      help="kind of rows to print, can be repeated")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        return -1
+    end = options.end
+    if end is None:
+        end = time.time()
+    kinds = None
+    if options.kinds is not None:
+        kinds = [KIND_NAMES.index(kind) for kind in options.kinds]
+    rows = store_scan(args[0], options.start, end, kinds=kinds,
+                      job_ids=options.job_ids)
+    for timestamp, kind, key, value, aux in rows:
+        print("%s %s %s %s %d" %
+              (time.strftime("%Y-%m-%d %H:%M:%S",
+                             time.localtime(timestamp)),
+               KIND_NAMES[kind], json.dumps(key), value, aux))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
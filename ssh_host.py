@@ -10,6 +10,7 @@ import logging
 import os
 import glob
 import shutil
+import threading
 
 # local libs
 import utils
@@ -30,6 +31,16 @@ LONGEST_SIMPLE_COMMAND_TIME = 600
 LONGEST_TIME_YUM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 # RPM install is slow, so use a larger timeout value
 LONGEST_TIME_RPM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
+# The directory to save the control sockets of the SSH master connections
+SSH_CONTROL_DIR = "/tmp/lime_ssh"
+# How long an idle SSH master connection is kept in background
+SSH_CONTROL_PERSIST = 600
+# The interval to check whether an SSH master connection is still healthy
+SSH_CONTROL_CHECK_INTERVAL = 30
+# The longest time that starting an SSH master connection should take
+SSH_CONTROL_START_TIMEOUT = 30
+# The exit status of ssh when an error of the SSH connection itself happens
+SSH_EXIT_STATUS_ERROR = 255
 
 
 def sh_escape(command):
@@ -83,13 +94,21 @@ def scp_remote_escape(filename):
     return sh_escape("".join(new_name))
 
 
-def ssh_command(hostname, command, login_name="root", identity_file=None):
+def ssh_command(hostname, command, login_name="root", identity_file=None,
+                control_path=None):
     """
     Return the ssh command on a remote host
+
+    If control_path is not None, the command will reuse the SSH master
+    connection listening on that socket. If the master connection is not
+    alive, ssh falls back to a normal connection.
     """
     extra_option = ""
     if identity_file is not None:
         extra_option = ("-i %s" % identity_file)
+    if control_path is not None:
+        extra_option += (" -o ControlMaster=no -o ControlPath=%s" %
+                         control_path)
     full_command = ("ssh %s -l %s -o StrictHostKeyChecking=no %s \"%s\"" %
                     (hostname, login_name, extra_option, sh_escape(command)))
     return full_command
@@ -98,28 +117,171 @@ def ssh_command(hostname, command, login_name="root", identity_file=None):
 def ssh_run(hostname, command, login_name="root", timeout=None,
             stdout_tee=None, stderr_tee=None, stdin=None,
             return_stdout=True, return_stderr=True,
-            quit_func=None, identity_file=None):
+            quit_func=None, identity_file=None, control_path=None):
     """
     Use ssh to run command on a remote host
     """
     # pylint: disable=too-many-arguments
-    full_command = ssh_command(hostname, command, login_name, identity_file)
+    full_command = ssh_command(hostname, command, login_name, identity_file,
+                               control_path=control_path)
     return utils.run(full_command, timeout=timeout, stdout_tee=stdout_tee,
                      stderr_tee=stderr_tee, stdin=stdin,
                      return_stdout=return_stdout, return_stderr=return_stderr,
                      quit_func=quit_func)
 
 
+class SSHControlMaster(object):
+    """
+    Each SSH master connection that commands to a host multiplex on has an
+    object of SSHControlMaster
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, hostname, login_name, identity_file=None):
+        self.scm_hostname = hostname
+        self.scm_login_name = login_name
+        self.scm_identity_file = identity_file
+        # The socket that the master connection listens on
+        self.scm_socket_path = ("%s/%s@%s" % (SSH_CONTROL_DIR, login_name,
+                                              hostname))
+        # The last time that the master connection was found to be healthy
+        self.scm_check_time = None
+        self.scm_condition = threading.Condition()
+
+    def _scm_command(self, option):
+        """
+        Return the ssh command to start or control the master connection
+        """
+        extra_option = ""
+        if self.scm_identity_file is not None:
+            extra_option = ("-i %s" % self.scm_identity_file)
+        return ("ssh %s -l %s -o StrictHostKeyChecking=no -o ControlPath=%s "
+                "%s %s" % (self.scm_hostname, self.scm_login_name,
+                           self.scm_socket_path, extra_option, option))
+
+    def _scm_check(self):
+        """
+        Check whether the master connection is alive
+        """
+        ret = utils.run(self._scm_command("-O check"),
+                        timeout=SSH_CONTROL_START_TIMEOUT)
+        return ret.cr_exit_status == 0
+
+    def _scm_start(self):
+        """
+        Start the master connection in background
+        """
+        if not os.path.isdir(SSH_CONTROL_DIR):
+            try:
+                os.makedirs(SSH_CONTROL_DIR, 0700)
+            except OSError:
+                if not os.path.isdir(SSH_CONTROL_DIR):
+                    logging.error("failed to create directory [%s]",
+                                  SSH_CONTROL_DIR)
+                    return -1
+        # A stale socket left by a dead master would prevent a new one
+        if os.path.exists(self.scm_socket_path):
+            os.remove(self.scm_socket_path)
+        command = self._scm_command("-M -N -f -o ControlPersist=%d" %
+                                    SSH_CONTROL_PERSIST)
+        ret = utils.run(command, timeout=SSH_CONTROL_START_TIMEOUT)
+        if ret.cr_exit_status != 0:
+            logging.error("failed to start SSH master connection to host "
+                          "[%s], command = [%s], ret = [%d], stdout = [%s], "
+                          "stderr = [%s]", self.scm_hostname, command,
+                          ret.cr_exit_status, ret.cr_stdout, ret.cr_stderr)
+            return -1
+        logging.debug("started SSH master connection to host [%s] with "
+                      "control path [%s]", self.scm_hostname,
+                      self.scm_socket_path)
+        return 0
+
+    def _scm_ensure(self, force_check):
+        """
+        Check the master connection if needed, and (re-)establish it if it
+        is not alive. Return (control_path, restarted), control_path is
+        None if the master connection can't be established, restarted is
+        True if a dead master connection has been replaced by a new one.
+        """
+        self.scm_condition.acquire()
+        now = time.time()
+        restarted = False
+        if (force_check or self.scm_check_time is None or
+                now - self.scm_check_time > SSH_CONTROL_CHECK_INTERVAL):
+            if not self._scm_check():
+                ret = self._scm_start()
+                if ret:
+                    self.scm_check_time = None
+                    self.scm_condition.release()
+                    return None, False
+                restarted = True
+            self.scm_check_time = time.time()
+        self.scm_condition.release()
+        return self.scm_socket_path, restarted
+
+    def scm_control_path(self):
+        """
+        Return the control path of a healthy master connection. The master
+        connection will be (re-)established if it is not alive. If the
+        master connection can't be established, return None.
+        """
+        return self._scm_ensure(False)[0]
+
+    def scm_reestablish(self):
+        """
+        Check the master connection now. Return the control path if the
+        master connection was dead and has been re-established, otherwise
+        return None.
+        """
+        control_path, restarted = self._scm_ensure(True)
+        if not restarted:
+            return None
+        return control_path
+
+    def scm_stop(self):
+        """
+        Stop the master connection
+        """
+        self.scm_condition.acquire()
+        utils.run(self._scm_command("-O exit"),
+                  timeout=SSH_CONTROL_START_TIMEOUT)
+        self.scm_check_time = None
+        self.scm_condition.release()
+
+
+class HostTransport(object):
+    """
+    The transport that runs the commands of SSHHost in place of SSH, e.g. a
+    fake host that is emulated in process
+    """
+    # pylint: disable=too-few-public-methods
+    def ht_run(self, hostname, command, login_name="root", timeout=None):
+        """
+        Run a command on the host, return utils.CommandResult
+        """
+        # pylint: disable=no-self-use,unused-argument
+        logging.error("transport can't run command [%s] on host [%s]",
+                      command, hostname)
+        return utils.CommandResult(stderr="not implemented",
+                                   exit_status=-1)
+
+
 class SSHHost(object):
     """
     Each SSH host has an object of SSHHost
     """
     # pylint: disable=too-many-public-methods
-    def __init__(self, hostname, identity_file=None):
+    def __init__(self, hostname, identity_file=None, multiplex=True,
+                 transport=None):
         self.sh_hostname = hostname
         self.sh_never_up = True
         self.sh_distro_cache = None
         self.sh_identity_file = identity_file
+        # Whether to multiplex the commands on SSH master connections
+        self.sh_multiplex = multiplex
+        # Mapping from login name to SSHControlMaster
+        self.sh_control_masters = {}
+        # The HostTransport to run the commands with, None means SSH
+        self.sh_transport = transport
 
     def sh_is_up(self, timeout=60):
         """
@@ -707,12 +869,43 @@ class SSHHost(object):
         Run a command on the host
         """
         # pylint: disable=too-many-arguments
+        if self.sh_transport is not None:
+            ret = self.sh_transport.ht_run(self.sh_hostname, command,
+                                           login_name=login_name,
+                                           timeout=timeout)
+            if not silent:
+                logging.debug("ran [%s] on host [%s], ret = [%d], "
+                              "stdout = [%s], stderr = [%s]",
+                              command, self.sh_hostname, ret.cr_exit_status,
+                              ret.cr_stdout, ret.cr_stderr)
+            return ret
+        control_path = self.sh_control_path(login_name)
         ret = ssh_run(self.sh_hostname, command, login_name=login_name,
                       timeout=timeout,
                       stdout_tee=stdout_tee, stderr_tee=stderr_tee,
                       stdin=stdin, return_stdout=return_stdout,
                       return_stderr=return_stderr, quit_func=quit_func,
-                      identity_file=self.sh_identity_file)
+                      identity_file=self.sh_identity_file,
+                      control_path=control_path)
+        if (control_path is not None and
+                ret.cr_exit_status == SSH_EXIT_STATUS_ERROR and
+                ret.cr_stdout == ""):
+            # The master connection might have been broken when running the
+            # command. Retry only if it was really dead, because the command
+            # itself could exit with the same status.
+            control_path = self.sh_control_reestablish(login_name)
+            if control_path is not None:
+                logging.debug("reestablished SSH master connection to host "
+                              "[%s], rerunning command [%s]",
+                              self.sh_hostname, command)
+                ret = ssh_run(self.sh_hostname, command,
+                              login_name=login_name, timeout=timeout,
+                              stdout_tee=stdout_tee, stderr_tee=stderr_tee,
+                              stdin=stdin, return_stdout=return_stdout,
+                              return_stderr=return_stderr,
+                              quit_func=quit_func,
+                              identity_file=self.sh_identity_file,
+                              control_path=control_path)
         if not silent:
             logging.debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
                           "stderr = [%s]",
@@ -801,7 +994,47 @@ class SSHHost(object):
         Return the command job on a host
         """
         # pylint: disable=too-many-arguments
-        full_command = ssh_command(self.sh_hostname, command)
+        full_command = ssh_command(self.sh_hostname, command,
+                                   identity_file=self.sh_identity_file,
+                                   control_path=self.sh_control_path("root"))
         job = utils.CommandJob(full_command, timeout, stdout_tee, stderr_tee,
                                stdin)
         return job
+
+    def _sh_control_master(self, login_name):
+        """
+        Return the SSH master connection for the login name
+        """
+        if login_name not in self.sh_control_masters:
+            master = SSHControlMaster(self.sh_hostname, login_name,
+                                      identity_file=self.sh_identity_file)
+            self.sh_control_masters[login_name] = master
+        else:
+            master = self.sh_control_masters[login_name]
+        return master
+
+    def sh_control_path(self, login_name):
+        """
+        Return the control path of the SSH master connection for the login
+        name, or None if multiplexing is disabled or not working
+        """
+        if not self.sh_multiplex or self.sh_transport is not None:
+            return None
+        return self._sh_control_master(login_name).scm_control_path()
+
+    def sh_control_reestablish(self, login_name):
+        """
+        Return the control path of the SSH master connection for the login
+        name if it was dead and has been re-established, otherwise None
+        """
+        if not self.sh_multiplex or self.sh_transport is not None:
+            return None
+        return self._sh_control_master(login_name).scm_reestablish()
+
+    def sh_control_masters_stop(self):
+        """
+        Stop all the SSH master connections to this host
+        """
+        for master in self.sh_control_masters.values():
+            master.scm_stop()
+
@@ -52,6 +52,10 @@ function QoS(lime)
     this.qos_websocket = null;
     this.qos_time_chart = null;
     this.qos_time_option = null;
+    // Dictionary and values of the compact stream
+    this.qos_stream_jobs = [];
+    this.qos_stream_hosts = [];
+    this.qos_stream_values = [];
 }
 
 QoS.prototype.qos_page_init = function()
@@ -189,7 +193,7 @@ QoS.prototype.qos_policy_init = function()
     $(table_string).appendTo("#content");
 
     var value_select = '';
-    policies = ["priority", "independent", "GRL"];
+    policies = ["priority", "independent", "GRL", "fair share", "PID"];
     for (var i = 0; i < policies.length; i++) {
         value_select += "<option value='" + policies[i] + "'>" +
             policies[i] + "</option>";
@@ -229,6 +233,117 @@ QoS.prototype.qos_policy_init = function()
     });
 };
 
+QoS.prototype.qos_datapoint_add = function(job_id, timestamp, rate)
+{
+    var job = this.qos_job_id_dict[job_id];
+    // Jobs discovered on the server are broadcasted too
+    if (job === undefined) {
+        return;
+    }
+    $(job.j_id_perf).html(Math.round(rate));
+
+    var millisecond = Math.round(timestamp * 1000);
+    while (job.j_time_data.length >= 60) {
+        job.j_time_data.shift();
+    }
+    job.j_time_data.push({
+        name: millisecond,
+        value: [millisecond, Math.round(rate)]
+    });
+};
+
+/*
+ * Decode a compact frame. Each entry is
+ * [job_index, rate, limit, host_index, host_rate, ...]. A keyframe has all
+ * the jobs, a delta frame only has the changed values.
+ */
+QoS.prototype.qos_compact_frame_decode = function(message)
+{
+    if (message.t == "k") {
+        this.qos_stream_values = [];
+    }
+    for (var i = 0; i < message.d.length; i++) {
+        var entry = message.d[i];
+        var job_index = entry[0];
+        var value = this.qos_stream_values[job_index];
+        if (value === undefined) {
+            value = {rate: 0, limit: null, hosts: {}};
+            this.qos_stream_values[job_index] = value;
+        }
+        value.rate = entry[1];
+        value.limit = entry[2];
+        for (var j = 3; j + 1 < entry.length; j += 2) {
+            value.hosts[this.qos_stream_hosts[entry[j]]] = entry[j + 1];
+        }
+    }
+
+    for (var job_index = 0; job_index < this.qos_stream_jobs.length;
+         job_index++) {
+        var job_id = this.qos_stream_jobs[job_index];
+        var value = this.qos_stream_values[job_index];
+        if (value !== undefined && job_id in this.qos_job_id_dict) {
+            this.qos_datapoint_add(job_id, message.time, value.rate);
+        }
+    }
+    this.qos_time_chart.setOption(this.qos_time_option);
+};
+
+/*
+ * Fill the charts with the history of job rates on the server, so that the
+ * charts are not empty after reconnecting. Datapoints that are not older
+ * than the datapoints already received are skipped.
+ */
+QoS.prototype.qos_history_load = function()
+{
+    var that = this;
+    var job_ids = [];
+    for (var job_id in this.qos_job_id_dict) {
+        job_ids.push(job_id);
+    }
+    $.ajax({
+        url: "rate_history",
+        type: "GET",
+        data: {job_id: job_ids, level: "job", metric: "rate",
+               seconds: 60},
+        traditional: true,
+        dataType: "json",
+        success: function(data) {
+            for (var i = 0; i < data.series.length; i++) {
+                var series = data.series[i];
+                if (!(series.job_id in that.qos_job_id_dict)) {
+                    continue;
+                }
+                var job = that.qos_job_id_dict[series.job_id];
+                var first = Infinity;
+                if (job.j_time_data.length > 0) {
+                    first = job.j_time_data[0].value[0];
+                }
+                var points = [];
+                for (var j = 0; j < series.times.length; j++) {
+                    var millisecond = Math.round(series.times[j] * 1000);
+                    if (millisecond >= first) {
+                        break;
+                    }
+                    points.push({
+                        name: millisecond,
+                        value: [millisecond, Math.round(series.values[j])]
+                    });
+                }
+                // Keep the array object, since the chart refers to it
+                var data_array = job.j_time_data;
+                Array.prototype.unshift.apply(data_array, points);
+                while (data_array.length > 60) {
+                    data_array.shift();
+                }
+            }
+            that.qos_time_chart.setOption(that.qos_time_option);
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
+            console.error("failed to load rate history", textStatus);
+        }
+    });
+};
+
 QoS.prototype.qos_console_init = function()
 {
     if (window.WebSocket === undefined) {
@@ -254,45 +369,56 @@ QoS.prototype.qos_console_init = function()
     string = '<pre id="' + QOS.NAME_CONSOLE +
         '" class="console"></pre>';
     $(string).appendTo(QOS.ID_CONSOLE_CONTAINER);
-    var data_string = JSON.stringify(
-        this.qos_lime.l_control_table.ct_config,
-        null, 4);
+    // Ask for the compact encoding of the datapoints
+    var config = $.extend({}, this.qos_lime.l_control_table.ct_config,
+                          {encoding: "compact"});
+    var data_string = JSON.stringify(config, null, 4);
 
     var workspace = this.rc_result_title;
     var that = this;
     websocket.onopen = function(evt) {
         websocket.send(data_string);
+        that.qos_history_load();
     };
     websocket.onclose = function(evt) {
     };
     websocket.onmessage = function(evt) {
         var message = JSON.parse(evt.data);
+        if (message.t !== undefined) {
+            // Compact frames are not shown in the console
+            that.qos_compact_frame_decode(message);
+            return;
+        }
         var type = message.type;
         var console_message = JSON.stringify(message) + "\n";
         var string = $(QOS.ID_CONSOLE).text() + console_message;
         $(QOS.ID_CONSOLE).text(string);
         $(QOS.ID_CONSOLE_CONTAINER).scrollTop($(QOS.ID_CONSOLE_CONTAINER)[0].scrollHeight);
         if (type == "datapoint") {
-            var rate = message.rate;
-            var job_id = message.job_id;
-            var timestamp = message.time;
-            if (!(job_id in that.qos_job_id_dict)) {
-                console.error("unexpected datapoint for job", job_id);
+            if (!(message.job_id in that.qos_job_id_dict)) {
+                console.error("unexpected datapoint for job",
+                              message.job_id);
                 return;
             }
-            job = that.qos_job_id_dict[job_id];
-            $(job.j_id_perf).html(Math.round(rate));
-
-            millisecond = Math.round(timestamp * 1000);
-            while (job.j_time_data.length >= 60) {
-                job.j_time_data.shift();
+            that.qos_datapoint_add(message.job_id, message.time,
+                                   message.rate);
+            that.qos_time_chart.setOption(that.qos_time_option);
+        } else if (type == "datapoints") {
+            // The frame has the datapoints of all jobs on the server, skip
+            // the jobs that are not watched by this page
+            var datapoints = message.datapoints;
+            for (var i = 0; i < datapoints.length; i++) {
+                if (datapoints[i].job_id in that.qos_job_id_dict) {
+                    that.qos_datapoint_add(datapoints[i].job_id,
+                                           message.time,
+                                           datapoints[i].rate);
+                }
             }
-            job.j_time_data.push({
-                name: millisecond,
-                value: [millisecond, Math.round(rate)]
-            });
-
             that.qos_time_chart.setOption(that.qos_time_option);
+        } else if (type == "dictionary") {
+            that.qos_stream_jobs = message.jobs;
+            that.qos_stream_hosts = message.hosts;
+            that.qos_stream_values = [];
         } else if (type == "command_result") {
         }
     };
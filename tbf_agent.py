@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+TBF agent that runs on OSS
+
+The agent keeps the NRS proc files of ost_io open and applies batches of TBF
+operations. Each batch is a JSON line read from stdin:
+
+    {"id": 1, "operations": [{"op": "change", "name": "dd_0", "rate": 100}]}
+
+And the results are written to stdout as one JSON line per batch:
+
+    {"id": 1, "results": [{"status": 0}]}
+
+The agent only depends on standard libraries, because it is copied to and
+run by the Python of the OSS. Use --proc-root to run it against a fake proc
+directory on a local machine.
+"""
+import os
+import sys
+import json
+import errno
+import optparse
+
+# The version of the protocol between the agent and LIME
+AGENT_PROTOCOL_VERSION = 1
+# The root directory of Lustre proc entries
+PROC_ROOT = "/proc/fs/lustre"
+# The directory of ost_io service under proc root
+OST_IO_DIR = "ost/OSS/ost_io"
+# The proc file to change TBF rules
+NRS_TBF_RULE = "nrs_tbf_rule"
+# The proc file to change NRS policies
+NRS_POLICIES = "nrs_policies"
+# Start a TBF rule, arguments: name, expression, rate
+OPERATION_START = "start"
+# Change the rate of a TBF rule, arguments: name, rate
+OPERATION_CHANGE = "change"
+# Stop a TBF rule, arguments: name
+OPERATION_STOP = "stop"
+# Change the NRS policy, arguments: policy
+OPERATION_POLICY = "policy"
+
+
+def tbf_operation_command(operation, legacy_syntax=False):
+    """
+    Return the proc file name and the command string to write into it for
+    a TBF operation. If legacy_syntax is True, use the syntax of Lustre
+    versions older than 2.8.54. Return (None, None) if the operation is
+    invalid.
+    """
+    # pylint: disable=too-many-return-statements
+    try:
+        op_type = operation["op"]
+        if op_type == OPERATION_START:
+            if legacy_syntax:
+                command = ("start %s {%s} %d" %
+                           (operation["name"], operation["expression"],
+                            operation["rate"]))
+            else:
+                command = ("start %s jobid={%s} rate=%d" %
+                           (operation["name"], operation["expression"],
+                            operation["rate"]))
+            return NRS_TBF_RULE, command
+        elif op_type == OPERATION_CHANGE:
+            if legacy_syntax:
+                command = ("change %s %d" %
+                           (operation["name"], operation["rate"]))
+            else:
+                command = ("change %s rate=%d" %
+                           (operation["name"], operation["rate"]))
+            return NRS_TBF_RULE, command
+        elif op_type == OPERATION_STOP:
+            return NRS_TBF_RULE, "stop %s" % operation["name"]
+        elif op_type == OPERATION_POLICY:
+            return NRS_POLICIES, operation["policy"]
+    except (KeyError, TypeError, ValueError):
+        return None, None
+    return None, None
+
+
+class TBFAgent(object):
+    """
+    The agent that applies TBF operations on an OSS
+    """
+    def __init__(self, proc_root=PROC_ROOT, legacy_syntax=False):
+        self.tag_proc_root = proc_root
+        self.tag_legacy_syntax = legacy_syntax
+        # Mapping from proc file name to the opened file descriptor
+        self.tag_fds = {}
+
+    def tag_fd(self, fname):
+        """
+        Return the file descriptor of a proc file, open it if not opened yet
+        """
+        if fname not in self.tag_fds:
+            path = os.path.join(self.tag_proc_root, OST_IO_DIR, fname)
+            self.tag_fds[fname] = os.open(path, os.O_WRONLY)
+        return self.tag_fds[fname]
+
+    def tag_fd_close(self, fname):
+        """
+        Close the file descriptor of a proc file
+        """
+        if fname not in self.tag_fds:
+            return
+        try:
+            os.close(self.tag_fds[fname])
+        except OSError:
+            pass
+        del self.tag_fds[fname]
+
+    def tag_operation_apply(self, operation):
+        """
+        Apply a TBF operation, return the result of it
+        """
+        fname, command = tbf_operation_command(operation,
+                                               self.tag_legacy_syntax)
+        if fname is None:
+            return {"status": -errno.EINVAL,
+                    "error": "invalid operation %s" % json.dumps(operation)}
+        try:
+            written = os.write(self.tag_fd(fname), command)
+        except (OSError, IOError) as error:
+            # Reopen the file next time in case the descriptor is broken
+            self.tag_fd_close(fname)
+            return {"status": -error.errno,
+                    "error": "failed to write [%s] to [%s]: %s" %
+                             (command, fname, error.strerror)}
+        if written != len(command):
+            return {"status": -errno.EIO,
+                    "error": "short write of [%s] to [%s]" % (command, fname)}
+        return {"status": 0}
+
+    def tag_batch_apply(self, batch):
+        """
+        Apply a batch of TBF operations, return the response of it
+        """
+        results = []
+        for operation in batch.get("operations", []):
+            results.append(self.tag_operation_apply(operation))
+        return {"id": batch.get("id"), "results": results}
+
+    def tag_serve(self, input_file, output_file):
+        """
+        Serve the batches until the input is closed
+        """
+        output_file.write(json.dumps({"ready": True,
+                                      "version": AGENT_PROTOCOL_VERSION}))
+        output_file.write("\n")
+        output_file.flush()
+        while True:
+            line = input_file.readline()
+            if line == "":
+                break
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                batch = json.loads(line)
+                if not isinstance(batch, dict):
+                    raise ValueError("batch is not an object")
+            except ValueError as error:
+                response = {"id": None,
+                            "error": "invalid batch: %s" % error}
+            else:
+                response = self.tag_batch_apply(batch)
+            output_file.write(json.dumps(response))
+            output_file.write("\n")
+            output_file.flush()
+        for fname in list(self.tag_fds.keys()):
+            self.tag_fd_close(fname)
+
+
+def main():
+    """
+    Run the TBF agent
+    """
+    parser = optparse.OptionParser()
+    parser.add_option("--proc-root", dest="proc_root", default=PROC_ROOT,
+                      help="root directory of Lustre proc entries")
+    parser.add_option("--legacy-syntax", dest="legacy_syntax",
+                      action="store_true", default=False,
+                      help="use TBF syntax of Lustre older than 2.8.54")
+    options, _ = parser.parse_args()
+    agent = TBFAgent(proc_root=options.proc_root,
+                     legacy_syntax=options.legacy_syntax)
+    agent.tag_serve(sys.stdin, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
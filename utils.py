@@ -7,6 +7,9 @@ Misc utility library
 
 import os
 import time
+import ctypes
+import ctypes.util
+import collections
 import signal
 import subprocess
 import StringIO
@@ -18,10 +21,67 @@ import datetime
 import dateutil.tz
 import threading
 import traceback
+import gevent
+import gevent.event
+import gevent.lock
 from gevent import monkey
 
 monkey.patch_all()
 
+# The default number of functions that parallel_run() runs concurrently
+PARALLEL_CONCURRENCY = 32
+# The clock ID of CLOCK_MONOTONIC on Linux
+CLOCK_MONOTONIC = 1
+# The status of a step of dependency_run() that hasn't finished
+STEP_PENDING = "pending"
+# The status of a step that returned 0 or None
+STEP_SUCCEEDED = "succeeded"
+# The status of a step that returned other values or raised an exception
+STEP_FAILED = "failed"
+# The status of a step that didn't run because a dependency didn't succeed
+STEP_SKIPPED = "skipped"
+
+
+class _Timespec(ctypes.Structure):
+    """
+    struct timespec of C library
+    """
+    # pylint: disable=too-few-public-methods
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime_load():
+    """
+    Return clock_gettime() of C library, or None if not available
+    """
+    # pylint: disable=bare-except
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        timespec = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            return None
+        return clock_gettime
+    except:
+        return None
+
+
+CLOCK_GETTIME = _clock_gettime_load()
+
+
+def monotonic_time():
+    """
+    Return the seconds of a monotonic clock, which is not affected by
+    changes of system time. Fall back to time.time() if the monotonic
+    clock is not available.
+    """
+    if CLOCK_GETTIME is None:
+        return time.time()
+    timespec = _Timespec()
+    CLOCK_GETTIME(CLOCK_MONOTONIC, ctypes.byref(timespec))
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
 
 def read_one_line(filename):
     """
@@ -386,6 +446,15 @@ def local_strftime(utc_datetime, fmt):
     local_datetime = utc_datetime.astimezone(dateutil.tz.tzlocal())
     return local_datetime.strftime(fmt)
 
+
+def resident_bytes():
+    """
+    Return the resident set size of this process in bytes
+    """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
 def thread_start(target, args):
     """
     Wrap the target function and start a thread to run it
@@ -408,3 +477,383 @@ def thread_start(target, args):
     run_thread.setDaemon(True)
     run_thread.start()
     return run_thread
+
+
+class ParallelResult(object):
+    """
+    The aggregate result of running a function on multiple keys in parallel
+    """
+    def __init__(self):
+        # Mapping from key to the return value of the function
+        self.pr_results = collections.OrderedDict()
+        # Keys whose functions didn't finish before the deadline
+        self.pr_timeout_keys = []
+        # Keys whose functions raised exceptions
+        self.pr_exception_keys = []
+        self.pr_duration = 0
+
+    def pr_failed_keys(self):
+        """
+        Return the keys whose functions failed, i.e. timed out, raised an
+        exception or returned a value other than 0
+        """
+        failed = self.pr_timeout_keys + self.pr_exception_keys
+        for key, ret in self.pr_results.iteritems():
+            if ret != 0 and key not in failed:
+                failed.append(key)
+        return failed
+
+    def pr_failure_reason(self, key):
+        """
+        Return why the function of a failed key failed
+        """
+        if key in self.pr_timeout_keys:
+            return "timeout"
+        if key in self.pr_exception_keys:
+            return "exception"
+        return "ret = [%s]" % (self.pr_results.get(key),)
+
+    def pr_status(self):
+        """
+        Return 0 if all the functions succeeded, otherwise -1
+        """
+        if len(self.pr_failed_keys()) != 0:
+            return -1
+        return 0
+
+
+def parallel_run(func, key_args, concurrency=PARALLEL_CONCURRENCY,
+                 timeout=None):
+    """
+    Run func(*args) for each (key, args) in key_args concurrently, with at
+    most concurrency functions running at the same time. If timeout is not
+    None, return when timeout seconds passed even if some functions haven't
+    finished. Functions which are running at the deadline are left to finish
+    in background, functions which haven't started will never start.
+    """
+    # pylint: disable=bare-except
+    result = ParallelResult()
+    semaphore = gevent.lock.BoundedSemaphore(concurrency)
+    running = {}
+
+    def worker(key, args):
+        """
+        Run the function of a key
+        """
+        semaphore.acquire()
+        running[key] = True
+        try:
+            result.pr_results[key] = func(*args)
+        except:
+            logging.error("exception when running parallel function on "
+                          "[%s]: [%s]", key, traceback.format_exc())
+            result.pr_exception_keys.append(key)
+        finally:
+            running[key] = False
+            semaphore.release()
+
+    start_time = time.time()
+    greenlets = collections.OrderedDict()
+    for key, args in key_args:
+        greenlets[key] = gevent.spawn(worker, key, args)
+    gevent.joinall(greenlets.values(), timeout=timeout)
+    for key, greenlet in greenlets.iteritems():
+        if greenlet.ready():
+            continue
+        result.pr_timeout_keys.append(key)
+        if key not in running:
+            greenlet.kill(block=False)
+    result.pr_duration = time.time() - start_time
+    return result
+
+
+class DependencyStep(object):
+    """
+    A step of dependency_run(), which runs func(*args) after all the steps
+    it depends on succeeded
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, name, func, args=(), dependencies=None):
+        self.ds_name = name
+        self.ds_func = func
+        self.ds_args = args
+        # The names of the steps that this step depends on
+        if dependencies is None:
+            dependencies = []
+        self.ds_dependencies = dependencies
+        self.ds_status = STEP_PENDING
+        self.ds_ret = None
+        # The seconds since the start of the run that the step started and
+        # finished at, None if not started or finished
+        self.ds_start = None
+        self.ds_end = None
+        self.ds_event = gevent.event.Event()
+
+    def ds_duration(self):
+        """
+        Return the seconds that the step ran, None if not finished
+        """
+        if self.ds_start is None or self.ds_end is None:
+            return None
+        return self.ds_end - self.ds_start
+
+
+class DependencyResult(object):
+    """
+    The result of running steps by dependency_run()
+    """
+    def __init__(self, steps):
+        # Mapping from step name to DependencyStep
+        self.dr_steps = collections.OrderedDict()
+        for step in steps:
+            self.dr_steps[step.ds_name] = step
+        self.dr_duration = 0
+
+    def dr_status(self):
+        """
+        Return 0 if all the steps succeeded, otherwise -1
+        """
+        for step in self.dr_steps.values():
+            if step.ds_status != STEP_SUCCEEDED:
+                return -1
+        return 0
+
+    def dr_serial_duration(self):
+        """
+        Return the seconds that the steps would take if run one by one
+        """
+        duration = 0
+        for step in self.dr_steps.values():
+            if step.ds_duration() is not None:
+                duration += step.ds_duration()
+        return duration
+
+    def dr_stats(self):
+        """
+        Return the timing of the steps
+        """
+        steps = collections.OrderedDict()
+        for name, step in self.dr_steps.iteritems():
+            steps[name] = {"status": step.ds_status,
+                           "start": step.ds_start,
+                           "duration": step.ds_duration(),
+                           "dependencies": step.ds_dependencies}
+        return {"duration": self.dr_duration,
+                "serial_duration": self.dr_serial_duration(),
+                "steps": steps}
+
+    def dr_report(self):
+        """
+        Return the timing of the steps as a table
+        """
+        lines = ["%-24s %10s %8s %8s  %s" % ("step", "status", "start",
+                                             "duration", "dependencies")]
+        for name, step in self.dr_steps.iteritems():
+            start = "-"
+            if step.ds_start is not None:
+                start = "%.3f" % step.ds_start
+            duration = "-"
+            if step.ds_duration() is not None:
+                duration = "%.3f" % step.ds_duration()
+            lines.append("%-24s %10s %8s %8s  %s" %
+                         (name, step.ds_status, start, duration,
+                          ",".join(step.ds_dependencies)))
+        lines.append("total %.3f seconds, %.3f seconds if run serially" %
+                     (self.dr_duration, self.dr_serial_duration()))
+        return "\n".join(lines)
+
+
+def dependency_run(steps):
+    """
+    Run the DependencyStep list concurrently, each step starts as soon as
+    all its dependencies succeeded. If a step fails, the steps that depend
+    on it are skipped. Return DependencyResult, or None if a dependency is
+    unknown or the dependencies have a cycle.
+    """
+    # pylint: disable=bare-except
+    result = DependencyResult(steps)
+    # Check the dependencies by removing the steps in topological order
+    remaining = dict((name, set(step.ds_dependencies))
+                     for name, step in result.dr_steps.iteritems())
+    for name, dependencies in remaining.iteritems():
+        for dependency in dependencies:
+            if dependency not in remaining:
+                logging.error("step [%s] depends on unknown step [%s]",
+                              name, dependency)
+                return None
+    while len(remaining) != 0:
+        ready = [name for name, dependencies in remaining.iteritems()
+                 if len(dependencies) == 0]
+        if len(ready) == 0:
+            logging.error("steps %s have cyclic dependencies",
+                          sorted(remaining.keys()))
+            return None
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+    def worker(step):
+        """
+        Run a step after its dependencies
+        """
+        try:
+            for dependency in step.ds_dependencies:
+                depended = result.dr_steps[dependency]
+                depended.ds_event.wait()
+                if depended.ds_status != STEP_SUCCEEDED:
+                    logging.error("skipping step [%s] because step [%s] "
+                                  "didn't succeed", step.ds_name,
+                                  dependency)
+                    step.ds_status = STEP_SKIPPED
+                    return
+            step.ds_start = time.time() - start_time
+            try:
+                step.ds_ret = step.ds_func(*step.ds_args)
+            except:
+                logging.error("exception when running step [%s]: [%s]",
+                              step.ds_name, traceback.format_exc())
+                step.ds_ret = -1
+            step.ds_end = time.time() - start_time
+            if step.ds_ret:
+                logging.error("step [%s] failed, ret = [%s]", step.ds_name,
+                              step.ds_ret)
+                step.ds_status = STEP_FAILED
+            else:
+                step.ds_status = STEP_SUCCEEDED
+        finally:
+            step.ds_event.set()
+
+    start_time = time.time()
+    greenlets = [gevent.spawn(worker, step)
+                 for step in result.dr_steps.values()]
+    gevent.joinall(greenlets)
+    result.dr_duration = time.time() - start_time
+    return result
+
+
+class PeriodicTask(object):
+    """
+    A function that is called periodically by its own thread. The ticks are
+    scheduled at absolute deadlines of a monotonic clock, so the period
+    doesn't drift with the duration of the function. If a tick finishes
+    after the deadlines of the following ticks, the missed ticks are skipped
+    and merged into the next tick.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name, func, period):
+        self.pt_name = name
+        self.pt_func = func
+        # Seconds between the deadlines of two ticks
+        self.pt_period = period
+        self.pt_thread = None
+        # The monotonic time of the first deadline
+        self.pt_start_time = None
+        # The index of the current tick since the first deadline
+        self.pt_tick_index = 0
+        # The monotonic time that the current tick is scheduled at
+        self.pt_tick_deadline = None
+        # Number of ticks finished
+        self.pt_tick_count = 0
+        # Number of ticks that finished after the deadline of the next tick
+        self.pt_overrun_count = 0
+        # Number of ticks skipped because of overruns
+        self.pt_skipped_count = 0
+        # Number of ticks that raised exceptions
+        self.pt_exception_count = 0
+        self.pt_duration_last = 0
+        self.pt_duration_max = 0
+        self.pt_duration_total = 0
+        # Jitter is the delay of starting a tick after its deadline
+        self.pt_jitter_last = 0
+        self.pt_jitter_max = 0
+        self.pt_jitter_total = 0
+
+    def pt_tick(self):
+        """
+        Call the function once, return the duration of it
+        """
+        # pylint: disable=bare-except
+        start_time = monotonic_time()
+        if self.pt_tick_deadline is not None:
+            jitter = max(start_time - self.pt_tick_deadline, 0)
+            self.pt_jitter_last = jitter
+            self.pt_jitter_total += jitter
+            if jitter > self.pt_jitter_max:
+                self.pt_jitter_max = jitter
+        try:
+            self.pt_func()
+        except:
+            logging.error("exception when running periodic task [%s]: [%s]",
+                          self.pt_name, traceback.format_exc())
+            self.pt_exception_count += 1
+        duration = monotonic_time() - start_time
+        self.pt_tick_count += 1
+        self.pt_duration_last = duration
+        self.pt_duration_total += duration
+        if duration > self.pt_duration_max:
+            self.pt_duration_max = duration
+        return duration
+
+    def _pt_next_deadline(self):
+        """
+        Move to the next tick whose deadline has not passed, return the
+        seconds to wait until the deadline
+        """
+        now = monotonic_time()
+        index = self.pt_tick_index + 1
+        deadline = self.pt_start_time + index * self.pt_period
+        if now > deadline:
+            # The ticks whose deadlines have passed are merged into one
+            missed = int((now - deadline) / self.pt_period) + 1
+            self.pt_overrun_count += 1
+            self.pt_skipped_count += missed
+            logging.debug("periodic task [%s] overran, skipping [%d] ticks",
+                          self.pt_name, missed)
+            index += missed
+            deadline = self.pt_start_time + index * self.pt_period
+        self.pt_tick_index = index
+        self.pt_tick_deadline = deadline
+        return deadline - now
+
+    def pt_run(self):
+        """
+        Call the function at the deadline of every tick
+        """
+        self.pt_start_time = monotonic_time()
+        self.pt_tick_index = 0
+        self.pt_tick_deadline = self.pt_start_time
+        while True:
+            self.pt_tick()
+            wait_time = self._pt_next_deadline()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+    def pt_start(self):
+        """
+        Start the thread of the task
+        """
+        if self.pt_thread is None:
+            self.pt_thread = thread_start(self.pt_run, ())
+
+    def pt_stats(self):
+        """
+        Return the statistics of the task
+        """
+        if self.pt_tick_count == 0:
+            duration_avg = 0
+            jitter_avg = 0
+        else:
+            duration_avg = self.pt_duration_total / self.pt_tick_count
+            jitter_avg = self.pt_jitter_total / self.pt_tick_count
+        return {"period": self.pt_period,
+                "ticks": self.pt_tick_count,
+                "overruns": self.pt_overrun_count,
+                "skipped": self.pt_skipped_count,
+                "exceptions": self.pt_exception_count,
+                "duration_last": self.pt_duration_last,
+                "duration_max": self.pt_duration_max,
+                "duration_avg": duration_avg,
+                "jitter_last": self.pt_jitter_last,
+                "jitter_max": self.pt_jitter_max,
+                "jitter_avg": jitter_avg}